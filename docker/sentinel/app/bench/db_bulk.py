@@ -0,0 +1,65 @@
+"""
+Сравнение способов массовой записи в БД: склейка строк в один BEGIN; ...; COMMIT; (как раньше), execute_values и COPY.
+
+Запуск (из /app): python3 -m bench.db_bulk --rows 100000
+"""
+import argparse
+import time
+import uuid
+
+import config
+from db_service import DBConnection
+
+TABLE = 'bench_bulk_datasets'
+
+
+def _rows(count: int):
+    for i in range(count):
+        yield str(uuid.uuid4()), f'S2A_MSIL2A_20210913T083601_N0301_R064_T37UCS_{i:08d}', i * 1024
+
+
+def _string_join(db: DBConnection, count: int, page_size: int):
+    batch = []
+    for guid, title, size in _rows(count):
+        batch.append(f"INSERT INTO {TABLE} (guid, title, size) VALUES ('{guid}', '{title}', {size})")
+        if len(batch) >= page_size:
+            db.execute(batch)
+            batch = []
+    if batch:
+        db.execute(batch)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--page-size', type=int, default=1000)
+    args = parser.parse_args()
+
+    db = DBConnection(dbname=config.DB_NAME,
+                      user=config.DB_USER,
+                      password=config.DB_PASSWORD,
+                      host=config.DB_IP,
+                      port=config.DB_PORT)
+    db.execute(f'CREATE UNLOGGED TABLE IF NOT EXISTS {TABLE} (guid uuid PRIMARY KEY, title text, size bigint)')
+    columns = ('guid', 'title', 'size')
+    cases = [
+        ('string join', lambda: _string_join(db, args.rows, args.page_size)),
+        ('execute_values', lambda: db.bulk_insert(TABLE, columns, _rows(args.rows), page_size=args.page_size)),
+        ('execute_values upsert', lambda: db.bulk_upsert(TABLE, columns, _rows(args.rows), ['guid'],
+                                                         page_size=args.page_size)),
+        ('copy', lambda: db.bulk_insert(TABLE, columns, _rows(args.rows), use_copy=True)),
+        ('copy upsert', lambda: db.bulk_upsert(TABLE, columns, _rows(args.rows), ['guid'], use_copy=True)),
+    ]
+    try:
+        for name, case in cases:
+            db.execute(f'TRUNCATE {TABLE}')
+            start = time.perf_counter()
+            case()
+            elapsed = time.perf_counter() - start
+            print(f'{name:<24} {args.rows} rows: {elapsed:8.3f} s, {args.rows / elapsed:10.0f} rows/s')
+    finally:
+        db.execute(f'DROP TABLE IF EXISTS {TABLE}')
+
+
+if __name__ == '__main__':
+    main()
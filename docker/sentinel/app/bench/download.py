@@ -0,0 +1,220 @@
+"""
+Бенчмарк загрузки датасетов на локальном bench.fake_odata: пропускная способность, p50/p99 времени задачи
+и процессорное время на гигабайт для разных размеров куска, количества параллельных загрузок и типов пула.
+
+direct - download_dataset в пуле потоков этого процесса (CPU - только этот процесс, сервер живёт в отдельном).
+celery - задача downloader:sentinel через локальный redis и отдельно запущенный воркер
+         (CPU - воркер со всеми дочерними процессами, включая его запуск).
+
+Запуск (из /app):
+    python3 -m bench.download direct --files 8 --size 104857600 --chunk-sizes 8192,1048576 --concurrency 1,4
+    python3 -m bench.download celery --redis redis://localhost:6379/15 --pools prefork,threads --concurrency 4
+
+ВНИМАНИЕ: режим celery очищает базу redis, переданную в --redis.
+"""
+import argparse
+import logging
+import os
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Tuple
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+GB = 1024 * 1024 * 1024
+# Все задачи прогона идут в одну полосу, чтобы мерить воркер, а не маршрутизацию
+BENCH_QUEUE = 'downloader.fast'
+
+logger = logging.getLogger('bench.download')
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _percentile(values: list, percent: float) -> float:
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(round(percent / 100.0 * len(values) + 0.5)) - 1))]
+
+
+def _titles(count: int):
+    for _ in range(count):
+        guid = str(uuid.uuid4())
+        yield guid, f'S2A_MSIL2A_20210913T083601_N0301_R064_T37UCS_{guid[:8]}'
+
+
+def _start_server(args) -> Tuple[subprocess.Popen, str]:
+    port = _free_port()
+    command = [sys.executable, '-m', 'bench.fake_odata', '--port', str(port), '--size', str(args.size),
+               '--bandwidth', str(args.bandwidth), '--latency', str(args.latency),
+               '--error-rate', str(args.error_rate), '--abort-rate', str(args.abort_rate)]
+    server = subprocess.Popen(command, cwd=APP_DIR, stdout=subprocess.PIPE, text=True)
+    line = server.stdout.readline()
+    if not line.startswith('Serving'):
+        server.kill()
+        raise RuntimeError(f'fake_odata не запустился: {line}')
+    return server, line.split()[-1]
+
+
+def _environment(args, server_url: str, data_dir: str, chunk_size: int, segments: int) -> dict:
+    """
+    Переменные окружения для config: локальный сервер, одна учётная запись без ограничений, без БД и метрик
+    """
+    env = dict(os.environ)
+    env.update({'CELERY_BROKER_URL': args.redis,
+                'CELERY_BACKEND_URL': args.redis,
+                'COPERNICUS_URL': server_url,
+                'COPERNICUS_CREDENTIALS': 'bench:bench',
+                'COPERNICUS_DEFAULT_SEGMENTS': str(segments),
+                'COPERNICUS_SEGMENTS': '',
+                'COPERNICUS_MAX_CONNECTIONS': '100000',
+                'COPERNICUS_DOWNLOADS_PER_SECOND': '100000',
+                'COPERNICUS_DOWNLOADS_BURST': '100000',
+                'DOWNLOAD_CHUNK_SIZE': str(chunk_size),
+                'DATA_DIR': data_dir,
+                'DB_POOL_MIN_SIZE': '0',
+                'METRICS_PORT': '0'})
+    env.pop('PROMETHEUS_MULTIPROC_DIR', None)
+    return env
+
+
+def _report(mode: str, pool: str, concurrency: int, chunk_size: int, segments: int,
+            latencies: list, failed: int, elapsed: float, cpu: float, size: int):
+    total = len(latencies) * size
+    print(f'{mode:<7} {pool:<8} c={concurrency:<3} chunk={chunk_size:<8} seg={segments:<2} '
+          f'ok={len(latencies):<4} failed={failed:<3} '
+          f'{total / elapsed / 1024 / 1024:9.1f} MB/s  '
+          f'p50={_percentile(latencies, 50):7.2f} s  p99={_percentile(latencies, 99):7.2f} s  '
+          f'cpu={cpu / (total / GB) if total else float("nan"):7.2f} s/GB', flush=True)
+
+
+def run_direct(args, server_url: str, chunk_size: int, concurrency: int, segments: int):
+    data_dir = tempfile.mkdtemp(dir=args.tmp_dir)
+    os.environ.update(_environment(args, server_url, data_dir, chunk_size, segments))
+    from sentinel import downloader, segmented
+    downloader.PRODUCT_URL = server_url + "/Products('{}')"
+    downloader.STREAM_CHUNK_SIZE = chunk_size
+    segmented.SEGMENT_CHUNK_SIZE = max(chunk_size, 64 * 1024)
+
+    def download(product):
+        started = time.perf_counter()
+        downloader.download_dataset(None, product[0], product[1], 'bench:bench', data_dir, logger,
+                                    segments=segments)
+        return time.perf_counter() - started
+
+    latencies, failed = [], 0
+    try:
+        cpu_start, started = time.process_time(), time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = [executor.submit(download, product) for product in _titles(args.files)]
+        for future in futures:
+            if future.exception() is None:
+                latencies.append(future.result())
+            else:
+                failed += 1
+                logger.warning(f'Загрузка упала: {future.exception()}')
+        elapsed, cpu = time.perf_counter() - started, time.process_time() - cpu_start
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+    _report('direct', 'threads', concurrency, chunk_size, segments, latencies, failed, elapsed, cpu, args.size)
+
+
+def run_celery(args, server_url: str, chunk_size: int, concurrency: int, segments: int, pool: str):
+    import redis
+    from celery import Celery
+
+    redis.Redis.from_url(args.redis).flushdb()
+    data_dir = tempfile.mkdtemp(dir=args.tmp_dir)
+    env = _environment(args, server_url, data_dir, chunk_size, segments)
+    worker = subprocess.Popen([sys.executable, '-m', 'celery', '-A', 'tasks.celery_app.app', 'worker',
+                               f'--queues={BENCH_QUEUE}', f'--pool={pool}',
+                               f'--concurrency={concurrency}', '--prefetch-multiplier=1', '-O', 'fair',
+                               '--loglevel=WARNING', f'--hostname=bench-{uuid.uuid4().hex[:8]}@%h'],
+                              cwd=APP_DIR, env=env)
+    # Клиенту не нужен весь tasks.celery_app - хватает брокера и бэкенда
+    app = Celery('bench', broker=args.redis, backend=args.redis)
+    latencies, failed = [], 0
+    try:
+        cpu_start = resource.getrusage(resource.RUSAGE_CHILDREN)
+        deadline = time.monotonic() + 60
+        while not app.control.ping(timeout=1.0):
+            if worker.poll() is not None or time.monotonic() > deadline:
+                raise RuntimeError('Воркер не запустился')
+
+        started = time.perf_counter()
+        pending = {}
+        for guid, title in _titles(args.files):
+            result = app.send_task('downloader:sentinel', args=[guid, title], kwargs={'size': args.size},
+                                   queue=BENCH_QUEUE)
+            pending[result] = time.perf_counter()
+        deadline = time.monotonic() + args.timeout
+        while pending and time.monotonic() < deadline:
+            for result, sent_at in list(pending.items()):
+                if result.ready():
+                    del pending[result]
+                    if result.successful():
+                        latencies.append(time.perf_counter() - sent_at)
+                    else:
+                        failed += 1
+            time.sleep(0.05)
+        failed += len(pending)
+        elapsed = time.perf_counter() - started
+    finally:
+        worker.terminate()
+        worker.wait()
+        shutil.rmtree(data_dir, ignore_errors=True)
+    cpu_end = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = (cpu_end.ru_utime + cpu_end.ru_stime) - (cpu_start.ru_utime + cpu_start.ru_stime)
+    _report('celery', pool, concurrency, chunk_size, segments, latencies, failed, elapsed, cpu, args.size)
+
+
+def _ints(value: str) -> list:
+    return [int(v) for v in value.split(',') if v]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('mode', choices=('direct', 'celery'))
+    parser.add_argument('--files', type=int, default=8)
+    parser.add_argument('--size', type=int, default=64 * 1024 * 1024, help='размер датасета, байт')
+    parser.add_argument('--chunk-sizes', type=_ints, default=[8192, 65536, 1024 * 1024])
+    parser.add_argument('--concurrency', type=_ints, default=[1, 4])
+    parser.add_argument('--segments', type=_ints, default=[1])
+    parser.add_argument('--pools', default='prefork,threads', help='типы пула celery через запятую')
+    parser.add_argument('--bandwidth', type=float, default=0, help='байт/с на соединение, 0 - без ограничения')
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--abort-rate', type=float, default=0)
+    parser.add_argument('--redis', default='redis://localhost:6379/15')
+    parser.add_argument('--tmp-dir', default=None)
+    parser.add_argument('--timeout', type=float, default=600, help='ожидание задач одного прогона, с')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    server, server_url = _start_server(args)
+    try:
+        for chunk_size in args.chunk_sizes:
+            for concurrency in args.concurrency:
+                for segments in args.segments:
+                    if args.mode == 'direct':
+                        run_direct(args, server_url, chunk_size, concurrency, segments)
+                        continue
+                    for pool in args.pools.split(','):
+                        run_celery(args, server_url, chunk_size, concurrency, segments, pool)
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == '__main__':
+    main()
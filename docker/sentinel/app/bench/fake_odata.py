@@ -0,0 +1,290 @@
+"""
+Локальная замена OData API copernicus для тестов и бенчмарков загрузки.
+
+Отдаёт Products('<guid>') (метаданные с MD5 в Checksum), Products('<guid>')/$value и
+Products('<guid>')/Online/$value: Content-Disposition, ETag, Range/If-Range
+(content-range, 206), 202 для датасетов не в онлайне. Пропускная способность на соединение, задержка ответа
+и ошибки (500 и обрыв соединения посреди файла) настраиваются. Содержимое файла детерминировано: байт по смещению
+i равен PATTERN[i % len(PATTERN)], так что любой диапазон можно проверить.
+
+Запуск (из /app): python3 -m bench.fake_odata --port 8080 --size 104857600 --bandwidth 20971520
+Для воркера: COPERNICUS_URL=http://localhost:8080/odata/v1
+"""
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional, Tuple
+from urllib.parse import unquote
+
+PATTERN = random.Random(0).randbytes(1024 * 1024)
+WRITE_SIZE = 64 * 1024
+
+_PATH_RE = re.compile(r"^/odata/v1/Products\('([^']+)'\)(?:/(\$value|Online/\$value))?$")
+_RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def product_content(offset: int, size: int) -> bytes:
+    """ Функция возвращает кусок содержимого датасета
+
+    :param offset: смещение от начала файла
+    :param size: размер куска
+    :return: байты файла [offset, offset + size)
+    """
+    start = offset % len(PATTERN)
+    data = PATTERN[start:start + size]
+    while len(data) < size:
+        data += PATTERN[:size - len(data)]
+    return data
+
+
+class FakeODataServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int],
+                 size: int,
+                 bandwidth: float = 0,
+                 latency: float = 0,
+                 error_rate: float = 0,
+                 abort_rate: float = 0,
+                 offline_rate: float = 0,
+                 restore_delay: float = 0,
+                 ranges: bool = True,
+                 seed: Optional[int] = None):
+        """
+        :param address: (хост, порт)
+        :param size: размер каждого датасета, байт
+        :param bandwidth: пропускная способность одного соединения, байт/с (0 - без ограничения)
+        :param latency: задержка перед ответом, с
+        :param error_rate: доля запросов $value, на которые сервер отвечает 500
+        :param abort_rate: доля загрузок, которые обрываются посреди файла
+        :param offline_rate: доля датасетов, лежащих в архиве (определяется по guid)
+        :param restore_delay: через сколько секунд после запроса датасет из архива становится онлайн
+        :param ranges: поддерживать ли Range
+        :param seed: seed генератора ошибок
+        """
+        super().__init__(address, FakeODataHandler)
+        self.size = size
+        self.bandwidth = bandwidth
+        self.latency = latency
+        self.error_rate = error_rate
+        self.abort_rate = abort_rate
+        self.offline_rate = offline_rate
+        self.restore_delay = restore_delay
+        self.ranges = ranges
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        # guid -> время, когда датасет из архива станет онлайн
+        self.restores = {}
+        self.__md5 = None
+        self.stats = {'requests': 0, 'bytes': 0, 'errors': 0, 'aborts': 0, 'restores': 0}
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}/odata/v1'
+
+    def chance(self, rate: float) -> bool:
+        if rate <= 0:
+            return False
+        with self.lock:
+            return self.random.random() < rate
+
+    def count(self, name: str, value: int = 1):
+        with self.lock:
+            self.stats[name] += value
+
+    def is_online(self, guid: str) -> bool:
+        if self.offline_rate <= 0:
+            return True
+        if int(hashlib.md5(guid.encode()).hexdigest(), 16) % 10000 >= self.offline_rate * 10000:
+            return True
+        with self.lock:
+            restored_at = self.restores.get(guid)
+        return restored_at is not None and time.monotonic() >= restored_at
+
+    def md5(self) -> str:
+        """ Функция возвращает MD5 датасета (содержимое у всех датасетов одинаковое, считается один раз)
+        """
+        with self.lock:
+            if self.__md5 is None:
+                md5 = hashlib.md5()
+                for offset in range(0, self.size, len(PATTERN)):
+                    md5.update(product_content(offset, min(len(PATTERN), self.size - offset)))
+                self.__md5 = md5.hexdigest()
+            return self.__md5
+
+    def restore(self, guid: str):
+        with self.lock:
+            if guid not in self.restores:
+                self.restores[guid] = time.monotonic() + self.restore_delay
+                self.stats['restores'] += 1
+
+    def start(self) -> threading.Thread:
+        """ Функция запускает сервер в фоновом потоке
+
+        :return: поток сервера
+        """
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+
+class FakeODataHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server: FakeODataServer
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.server.count('requests')
+        match = _PATH_RE.match(unquote(self.path.split('?')[0]))
+        if match is None:
+            return self.__reply(404, b'Not found')
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        guid, resource = match.groups()
+        if resource is None:
+            return self.__send_metadata(guid)
+        if resource == 'Online/$value':
+            return self.__reply(200, b'true' if self.server.is_online(guid) else b'false')
+        if not self.server.is_online(guid):
+            self.server.restore(guid)
+            return self.__reply(202, b'Offline product retrieval accepted')
+        if self.server.chance(self.server.error_rate):
+            self.server.count('errors')
+            return self.__reply(500, b'Internal server error')
+        self.__send_product(guid)
+
+    def __reply(self, status: int, body: bytes):
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def __send_metadata(self, guid: str):
+        meta = {'d': {'Id': guid,
+                      'ContentLength': str(self.server.size),
+                      'Online': self.server.is_online(guid),
+                      'Checksum': {'Algorithm': 'MD5', 'Value': self.server.md5().upper()}}}
+        body = json.dumps(meta).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def __send_product(self, guid: str):
+        size = self.server.size
+        etag = f'"{guid}-{size}"'
+        start, end = 0, size - 1
+        partial = False
+        requested = self.__requested_range(size)
+        if requested is not None and self.headers.get('If-Range') in (None, etag):
+            if requested == 'invalid':
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{size}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            start, end = requested
+            partial = True
+
+        self.send_response(206 if partial else 200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Disposition', f'inline; filename="{guid}.SAFE.zip"')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('ETag', etag)
+        if self.server.ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        if partial:
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        self.end_headers()
+
+        # Обрываем соединение где-то посреди файла
+        abort_at = None
+        if self.server.chance(self.server.abort_rate):
+            abort_at = start + (end - start + 1) // 2
+        bandwidth = self.server.bandwidth
+        sent_at = time.monotonic()
+        sent = 0
+        pos = start
+        while pos <= end:
+            chunk_end = min(end + 1, pos + WRITE_SIZE)
+            if abort_at is not None and chunk_end > abort_at:
+                self.wfile.write(product_content(pos, abort_at - pos))
+                self.server.count('bytes', abort_at - pos)
+                self.server.count('aborts')
+                self.close_connection = True
+                return
+            self.wfile.write(product_content(pos, chunk_end - pos))
+            sent += chunk_end - pos
+            self.server.count('bytes', chunk_end - pos)
+            pos = chunk_end
+            if bandwidth:
+                delay = sent / bandwidth - (time.monotonic() - sent_at)
+                if delay > 0:
+                    time.sleep(delay)
+
+    def __requested_range(self, size: int):
+        """
+        Диапазон из заголовка Range: (начало, конец) / 'invalid' / None, если Range нет или он не поддерживается
+        """
+        header = self.headers.get('Range')
+        if not header or not self.server.ranges:
+            return None
+        match = _RANGE_RE.match(header.strip())
+        if match is None or match.groups() == ('', ''):
+            return None
+        first, last = match.groups()
+        if first == '':
+            start, end = max(0, size - int(last)), size - 1
+        else:
+            start, end = int(first), min(int(last), size - 1) if last else size - 1
+        if start >= size or start > end:
+            return 'invalid'
+        return start, end
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--size', type=int, default=100 * 1024 * 1024, help='размер датасета, байт')
+    parser.add_argument('--bandwidth', type=float, default=0, help='байт/с на соединение, 0 - без ограничения')
+    parser.add_argument('--latency', type=float, default=0, help='задержка ответа, с')
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--abort-rate', type=float, default=0)
+    parser.add_argument('--offline-rate', type=float, default=0)
+    parser.add_argument('--restore-delay', type=float, default=0)
+    parser.add_argument('--no-ranges', action='store_true')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    server = FakeODataServer((args.host, args.port), args.size,
+                             bandwidth=args.bandwidth,
+                             latency=args.latency,
+                             error_rate=args.error_rate,
+                             abort_rate=args.abort_rate,
+                             offline_rate=args.offline_rate,
+                             restore_delay=args.restore_delay,
+                             ranges=not args.no_ranges,
+                             seed=args.seed)
+    print(f'Serving {server.url}', flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(server.stats)
+
+
+if __name__ == '__main__':
+    main()
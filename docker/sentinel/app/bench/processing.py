@@ -0,0 +1,177 @@
+"""
+Бенчмарк расчёта индексов: тайлов в секунду на ядро для разного количества потоков.
+
+engine  - только IndexEngine на синтетических тайлах в памяти (сравнивается с "наивным" расчётом NumPy,
+          где каждое выражение создаёт временные массивы, а NDVI для FAPAR считается заново).
+product - compute_indices по синтетическому продукту на диске: чтение окон, маска SCL, запись GeoTIFF.
+          Каналы пишутся несжатыми (читаются через memmap) и в deflate (читаются через GDAL).
+
+Запуск (из /app):
+    python3 -m bench.processing engine --tiles 64 --tile 1024 --threads 1,2,4,8
+    python3 -m bench.processing product --size 10980 --tile 1024 --threads 1,4,8
+"""
+import argparse
+import os
+import resource
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+import numpy as np
+
+from processing.indices import INDEX_BANDS, IndexEngine, required_bands
+from processing.raster import compute_indices
+
+INDICES = tuple(INDEX_BANDS)
+
+
+def _cpu_seconds() -> float:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _tiles(count: int, tile: int, seed: int = 0) -> List[Dict[str, np.ndarray]]:
+    rng = np.random.default_rng(seed)
+    bands = required_bands(INDICES)
+    # Тайлы повторяются по кругу - на генерацию не тратим время и память
+    unique = [{band: rng.integers(1, 10000, (tile, tile), dtype=np.uint16) for band in bands} for _ in range(4)]
+    scl = [rng.integers(0, 12, (tile, tile), dtype=np.uint8) for _ in range(4)]
+    return [dict(unique[i % 4], SCL=scl[i % 4]) for i in range(count)]
+
+
+def _naive(tile: Dict[str, np.ndarray], offset: float) -> Dict[str, np.ndarray]:
+    r = {band: (tile[band].astype(np.float32) + offset) / 10000 for band in required_bands(INDICES)}
+    invalid = np.isin(tile['SCL'], (0, 1, 3, 8, 9, 10))
+    for band in r:
+        invalid |= tile[band] == 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        result = {
+            'ndvi': (r['B08'] - r['B04']) / (r['B08'] + r['B04']),
+            'gndvi': (r['B08'] - r['B03']) / (r['B08'] + r['B03']),
+            'lai': 3.618 * 2.5 * (r['B08'] - r['B04']) / (r['B08'] + 6 * r['B04'] - 7.5 * r['B02'] + 1) - 0.118,
+            'fapar': np.clip(1.24 * (r['B08'] - r['B04']) / (r['B08'] + r['B04']) - 0.168, 0, 1),
+        }
+    for value in result.values():
+        value[invalid] = np.nan
+    return result
+
+
+def _run(tiles: list, threads: int, make_compute) -> tuple:
+    chunks = [tiles[i::threads] for i in range(threads)]
+
+    def work(chunk):
+        compute = make_compute()
+        for tile in chunk:
+            compute(tile)
+
+    cpu = _cpu_seconds()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(work, chunks))
+    return time.perf_counter() - started, _cpu_seconds() - cpu
+
+
+def bench_engine(args):
+    tiles = _tiles(args.tiles, args.tile)
+    offset = -1000.0
+
+    def engine():
+        engine = IndexEngine(INDICES, (args.tile, args.tile), offset)
+        return lambda tile: engine.compute(tile, tile['SCL'])
+
+    # Проверка, что быстрый расчёт совпадает с наивным
+    expected = _naive(tiles[0], offset)
+    got = engine()(tiles[0])
+    for index in INDICES:
+        assert np.array_equal(np.isnan(got[index]), np.isnan(expected[index])), f'{index}: маски не совпали'
+        # На случайных каналах знаменатель LAI бывает около нуля - там float32 расходится с наивным расчётом
+        stable = np.abs(expected[index]) < 100
+        np.testing.assert_allclose(got[index][stable], expected[index][stable], rtol=1e-3, atol=1e-5)
+
+    print(f'{args.tiles} tiles {args.tile}x{args.tile}, indices {",".join(INDICES)}, {os.cpu_count()} cores')
+    print(f'{"mode":>8} {"threads":>7} {"tiles/s":>9} {"tiles/s/core":>12} {"tiles/cpu-s":>11} {"speedup":>7}')
+    for name, make_compute in (('naive', lambda: lambda tile: _naive(tile, offset)), ('engine', engine)):
+        base = None
+        for threads in args.threads:
+            elapsed, cpu = _run(tiles, threads, make_compute)
+            rate = len(tiles) / elapsed
+            base = base or rate
+            print(f'{name:>8} {threads:>7} {rate:>9.1f} {rate / threads:>12.1f} {len(tiles) / cpu:>11.1f} '
+                  f'{rate / base:>7.2f}')
+
+
+def _write_product(root: str, size: int, compress: bool) -> str:
+    import rasterio
+    from rasterio.transform import from_origin
+
+    rng = np.random.default_rng(0)
+    safe = os.path.join(root, 'S2A_MSIL2A_BENCH.SAFE')
+    image_dir = os.path.join(safe, 'GRANULE', 'L2A_T37UCS', 'IMG_DATA')
+    options = {'compress': 'deflate', 'tiled': True, 'blockxsize': 1024, 'blockysize': 1024} if compress else {}
+    for resolution, bands, scale in (('10m', required_bands(INDICES), 1), ('20m', ('SCL',), 2)):
+        os.makedirs(os.path.join(image_dir, f'R{resolution}'), exist_ok=True)
+        for band in bands:
+            shape = (size // scale, size // scale)
+            data = rng.integers(0, 12, shape, dtype=np.uint8) if band == 'SCL' else \
+                rng.integers(0, 10000, shape, dtype=np.uint16)
+            # Настоящие каналы в JPEG2000, здесь GeoTIFF под тем же именем - GDAL определяет формат по содержимому
+            filename = os.path.join(image_dir, f'R{resolution}', f'T37UCS_20210913T083601_{band}_{resolution}.jp2')
+            with rasterio.open(filename, 'w', driver='GTiff', height=shape[0], width=shape[1], count=1,
+                               dtype=data.dtype, crs='EPSG:32637',
+                               transform=from_origin(300000, 5900040, 10 * scale, 10 * scale), **options) as ds:
+                ds.write(data, 1)
+    with open(os.path.join(safe, 'MTD_MSIL2A.xml'), 'w') as f:
+        f.write('<Level-2A_User_Product><BOA_ADD_OFFSET_VALUES_LIST>'
+                '<BOA_ADD_OFFSET band_id="0">-1000</BOA_ADD_OFFSET>'
+                '</BOA_ADD_OFFSET_VALUES_LIST></Level-2A_User_Product>')
+    return safe
+
+
+def bench_product(args):
+    root = tempfile.mkdtemp(prefix='bench-processing-')
+    try:
+        print(f'product {args.size}x{args.size}, tile {args.tile}, {os.cpu_count()} cores')
+        print(f'{"bands":>8} {"threads":>7} {"seconds":>8} {"tiles/s":>9} {"tiles/s/core":>12} {"tiles/cpu-s":>11}')
+        tiles = (-(-args.size // args.tile)) ** 2
+        for compress in (False, True):
+            product = _write_product(os.path.join(root, 'deflate' if compress else 'raw'), args.size, compress)
+            for threads in args.threads:
+                output_dir = os.path.join(root, 'out')
+                cpu = _cpu_seconds()
+                started = time.perf_counter()
+                compute_indices(product, INDICES, output_dir, 'bench', tile=args.tile, threads=threads)
+                elapsed = time.perf_counter() - started
+                cpu = _cpu_seconds() - cpu
+                shutil.rmtree(output_dir)
+                print(f'{"deflate" if compress else "raw":>8} {threads:>7} {elapsed:>8.2f} {tiles / elapsed:>9.2f} '
+                      f'{tiles / elapsed / threads:>12.2f} {tiles / cpu:>11.2f}')
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='mode', required=True)
+    threads = [str(n) for n in (1, 2, 4, 8) if n <= (os.cpu_count() or 1)]
+
+    engine = subparsers.add_parser('engine')
+    engine.add_argument('--tiles', type=int, default=64)
+    engine.add_argument('--tile', type=int, default=1024)
+    engine.add_argument('--threads', default=','.join(threads))
+    engine.set_defaults(func=bench_engine)
+
+    product = subparsers.add_parser('product')
+    product.add_argument('--size', type=int, default=10980, help='размер каналов 10m, пикс.')
+    product.add_argument('--tile', type=int, default=1024)
+    product.add_argument('--threads', default=','.join(threads))
+    product.set_defaults(func=bench_product)
+
+    args = parser.parse_args()
+    args.threads = [int(n) for n in args.threads.split(',')]
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
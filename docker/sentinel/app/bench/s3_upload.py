@@ -0,0 +1,113 @@
+"""
+Проверка и замер загрузки на S3 по ходу скачивания на локальном minio (сервис minio в docker-compose).
+
+Сравнивает "скачать целиком, потом загрузить" с MultipartUpload, в который куски пишутся по мере скачивания,
+проверяет содержимое объекта и то, что при ошибке upload прерывается без висящих частей.
+
+Запуск (из /app): python3 -m bench.s3_upload --endpoint http://localhost:9000 --size 268435456 --bandwidth 52428800
+"""
+import argparse
+import hashlib
+import os
+import tempfile
+import time
+import uuid
+
+from botocore.exceptions import ClientError
+
+from sentinel.s3_upload import MultipartUpload
+from tools.s3 import get_s3_client
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def _chunks(size: int, bandwidth: float):
+    """
+    Имитация скачивания: случайные куски с заданной скоростью
+    """
+    block = os.urandom(CHUNK_SIZE)
+    started = time.monotonic()
+    sent = 0
+    while sent < size:
+        chunk = block[:min(CHUNK_SIZE, size - sent)]
+        sent += len(chunk)
+        if bandwidth:
+            delay = sent / bandwidth - (time.monotonic() - started)
+            if delay > 0:
+                time.sleep(delay)
+        yield chunk
+
+
+def _object_md5(client, bucket: str, key: str) -> str:
+    md5 = hashlib.md5()
+    for chunk in client.get_object(Bucket=bucket, Key=key)['Body'].iter_chunks(CHUNK_SIZE):
+        md5.update(chunk)
+    return md5.hexdigest()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--endpoint', default='http://localhost:9000')
+    parser.add_argument('--access-key', default='minio')
+    parser.add_argument('--secret-key', default='minio123')
+    parser.add_argument('--bucket', default='sentinel-bench')
+    parser.add_argument('--size', type=int, default=256 * 1024 * 1024)
+    parser.add_argument('--bandwidth', type=float, default=50 * 1024 * 1024, help='скорость "скачивания", байт/с')
+    parser.add_argument('--part-size', type=int, default=16 * 1024 * 1024)
+    parser.add_argument('--threads', type=int, default=4)
+    args = parser.parse_args()
+
+    client = get_s3_client(args.endpoint, args.access_key, args.secret_key)
+    try:
+        client.create_bucket(Bucket=args.bucket)
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('BucketAlreadyOwnedByYou', 'BucketAlreadyExists'):
+            raise
+
+    # Как было задумано раньше: сначала файл на диск, потом upload_file
+    key = f'bench/{uuid.uuid4()}.zip'
+    md5 = hashlib.md5()
+    started = time.perf_counter()
+    with tempfile.NamedTemporaryFile() as f:
+        for chunk in _chunks(args.size, args.bandwidth):
+            f.write(chunk)
+            md5.update(chunk)
+        f.flush()
+        client.upload_file(f.name, args.bucket, key)
+    sequential = time.perf_counter() - started
+    assert _object_md5(client, args.bucket, key) == md5.hexdigest(), 'содержимое объекта не совпало'
+    client.delete_object(Bucket=args.bucket, Key=key)
+
+    # Части уходят на S3 по ходу скачивания
+    key = f'bench/{uuid.uuid4()}.zip'
+    md5 = hashlib.md5()
+    started = time.perf_counter()
+    with MultipartUpload(client, args.bucket, key, args.part_size, args.threads) as upload:
+        for chunk in _chunks(args.size, args.bandwidth):
+            upload.write(chunk)
+            md5.update(chunk)
+        result = upload.complete()
+    streaming = time.perf_counter() - started
+    assert _object_md5(client, args.bucket, key) == md5.hexdigest(), 'содержимое объекта не совпало'
+    client.delete_object(Bucket=args.bucket, Key=key)
+
+    # Ошибка посреди скачивания: upload прерывается, частей на S3 не остаётся
+    key = f'bench/{uuid.uuid4()}.zip'
+    try:
+        with MultipartUpload(client, args.bucket, key, args.part_size, args.threads) as upload:
+            for i, chunk in enumerate(_chunks(args.size, 0)):
+                upload.write(chunk)
+                if i * CHUNK_SIZE > 2 * args.part_size:
+                    raise RuntimeError('обрыв соединения')
+    except RuntimeError:
+        pass
+    uploads = client.list_multipart_uploads(Bucket=args.bucket, Prefix=key).get('Uploads', [])
+    assert not uploads, f'после ошибки остались незавершённые upload: {uploads}'
+
+    print(f'{args.size / 1024 / 1024:.0f} MB at {args.bandwidth / 1024 / 1024:.0f} MB/s: '
+          f'download then upload {sequential:.2f} s, streaming upload {streaming:.2f} s '
+          f'(ETag {result["etag"]}), abort OK')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,7 @@
 from datetime import timedelta
+import json
 import os
+import socket
 
 
 try:
@@ -10,6 +12,7 @@ try:
     CELERY_BACKEND_URL = os.environ["CELERY_BACKEND_URL"]
 except:
     CELERY_BACKEND_URL = None
+REDIS_URL = os.environ.get('REDIS_URL', CELERY_BROKER_URL)
 
 # DB ===================================================================================================================
 DB_NAME = os.environ.get('DB_NAME_SATELLITE')
@@ -22,9 +25,136 @@ DB_URL = f'postgresql://{DB_USER}:{DB_PASSWORD}@{DB_IP}:{DB_PORT}/{DB_NAME}'
 
 MAX_QUERY_RETRY_COUNT = 2
 
+DB_POOL_MIN_SIZE = int(os.environ.get('DB_POOL_MIN_SIZE', 1))
+DB_POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', 10))
+DB_POOL_IDLE_TIMEOUT = timedelta(seconds=int(os.environ.get('DB_POOL_IDLE_TIMEOUT', 300)))
+# Размер кэша серверных prepared statements на одно подключение (0 - выключен, включается явно)
+DB_PREPARED_CACHE_SIZE = int(os.environ.get('DB_PREPARED_CACHE_SIZE', 0))
+
 DB_CACHE_TTL = timedelta(seconds=60)
+# Количество закэшированных результатов читающих запросов (0 - кэш выключен, включается явно).
+# Кэшируются только запросы с cached=True: сброс при записи работает только внутри процесса
+DB_CACHE_SIZE = int(os.environ.get('DB_CACHE_SIZE', 0))
 
 DB_DEFAULT_MAX_STR_LEN = 5000
 DB_MAX_NAME_STR_LEN = 255
 
 COPERNICUS_CREDENTIALS = os.environ.get('COPERNICUS_CREDENTIALS')
+# Адрес OData API copernicus (для тестов и бенчмарков - адрес bench.fake_odata)
+COPERNICUS_URL = os.environ.get('COPERNICUS_URL', 'https://scihub.copernicus.eu/dhus/odata/v1')
+# Размер буфера чтения при загрузке датасета одним потоком, байт
+DOWNLOAD_CHUNK_SIZE = int(os.environ.get('DOWNLOAD_CHUNK_SIZE', 1024 * 1024))
+# Сверять ли MD5 скачанного датасета с контрольной суммой из метаданных OData (считается по ходу загрузки)
+DOWNLOAD_VERIFY_CHECKSUM = os.environ.get('DOWNLOAD_VERIFY_CHECKSUM', 'true').lower() in ('1', 'true', 'yes')
+
+# Каталог, в который складываются скачанные датасеты
+DATA_DIR = os.environ.get('DATA_DIR', '/data')
+
+# Количество параллельных соединений на один файл для каждой учётной записи copernicus.
+# Задаётся в виде "user1=4,user2=2", для остальных учётных записей используется COPERNICUS_DEFAULT_SEGMENTS
+COPERNICUS_DEFAULT_SEGMENTS = int(os.environ.get('COPERNICUS_DEFAULT_SEGMENTS', 1))
+COPERNICUS_SEGMENTS = {account.split('=')[0].strip(): int(account.split('=')[1])
+                       for account in os.environ.get('COPERNICUS_SEGMENTS', '').split(',') if '=' in account}
+
+# Восстановление датасетов из долгосрочного архива (LTA)
+RESTORE_POLL_INTERVAL = timedelta(seconds=int(os.environ.get('RESTORE_POLL_INTERVAL', 300)))
+RESTORE_RETRIGGER_INTERVAL = timedelta(seconds=int(os.environ.get('RESTORE_RETRIGGER_INTERVAL', 12 * 3600)))
+RESTORE_BATCH_SIZE = int(os.environ.get('RESTORE_BATCH_SIZE', 100))
+
+# Массовая постановка задач на скачивание
+ENQUEUE_PAGE_SIZE = int(os.environ.get('ENQUEUE_PAGE_SIZE', 1000))
+ENQUEUE_TTL = timedelta(seconds=int(os.environ.get('ENQUEUE_TTL', 24 * 3600)))
+
+# Учётные записи copernicus: одна - COPERNICUS_CREDENTIALS="user:password", несколько - JSON-список
+# COPERNICUS_CREDENTIALS='["user1:password1", "user2:password2"]' (в паролях может быть любой символ, в т.ч. запятая)
+COPERNICUS_ACCOUNTS = [cred for cred in (json.loads(COPERNICUS_CREDENTIALS)
+                                         if (COPERNICUS_CREDENTIALS or '').lstrip().startswith('[')
+                                         else [COPERNICUS_CREDENTIALS or '']) if cred.strip()]
+# Ограничения на одну учётную запись, общие для всех воркеров (COPERNICUS_DOWNLOADS_PER_SECOND=0 - частота
+# запуска загрузок не ограничена)
+COPERNICUS_MAX_CONNECTIONS = int(os.environ.get('COPERNICUS_MAX_CONNECTIONS', 2))
+COPERNICUS_DOWNLOADS_PER_SECOND = float(os.environ.get('COPERNICUS_DOWNLOADS_PER_SECOND', 0.5))
+COPERNICUS_DOWNLOADS_BURST = int(os.environ.get('COPERNICUS_DOWNLOADS_BURST', 2))
+# Через сколько секунд повторить задачу, если все учётные записи заняты
+DOWNLOAD_LIMIT_RETRY_DELAY = int(os.environ.get('DOWNLOAD_LIMIT_RETRY_DELAY', 30))
+
+# Полосы очереди downloader: датасеты от DOWNLOAD_BULK_SIZE байт идут в downloader.bulk, меньше - в downloader.fast.
+# Если размер неизвестен, полоса выбирается по уровню обработки из названия: "MSIL1C=bulk,MSIL2A=fast"
+DOWNLOAD_BULK_SIZE = int(os.environ.get('DOWNLOAD_BULK_SIZE', 300 * 1024 * 1024))
+DOWNLOAD_LEVEL_LANES = {level.split('=')[0].strip(): level.split('=')[1].strip()
+                        for level in os.environ.get('DOWNLOAD_LEVEL_LANES', '').split(',') if '=' in level}
+
+# S3, на который датасеты загружаются по ходу скачивания (S3_BUCKET не задан - только локальная ФС)
+S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL')
+S3_ACCESS_KEY = os.environ.get('S3_ACCESS_KEY')
+S3_SECRET_KEY = os.environ.get('S3_SECRET_KEY')
+S3_REGION = os.environ.get('S3_REGION')
+S3_BUCKET = os.environ.get('S3_BUCKET')
+S3_PREFIX = os.environ.get('S3_PREFIX', 'ZIP')
+S3_PART_SIZE = int(os.environ.get('S3_PART_SIZE', 16 * 1024 * 1024))
+S3_UPLOAD_THREADS = int(os.environ.get('S3_UPLOAD_THREADS', 4))
+# Сколько готовых частей может ждать отправки в памяти, дальше скачивание притормаживает
+S3_QUEUE_PARTS = int(os.environ.get('S3_QUEUE_PARTS', 8))
+# Сохранять ли датасеты на локальную ФС, если включена загрузка на S3
+DOWNLOAD_KEEP_LOCAL = os.environ.get('DOWNLOAD_KEEP_LOCAL', 'true').lower() in ('1', 'true', 'yes')
+
+# Состояние загрузок пишется в datasets пачками: раз в STATUS_FLUSH_INTERVAL секунд или по STATUS_BATCH_SIZE датасетов
+STATUS_FLUSH_INTERVAL = float(os.environ.get('STATUS_FLUSH_INTERVAL', 1.0))
+STATUS_BATCH_SIZE = int(os.environ.get('STATUS_BATCH_SIZE', 500))
+
+# Поиск датасетов по полям (OpenSearch copernicus)
+COPERNICUS_SEARCH_URL = os.environ.get('COPERNICUS_SEARCH_URL', 'https://scihub.copernicus.eu/dhus/search')
+SEARCH_PLATFORM = os.environ.get('SEARCH_PLATFORM', 'Sentinel-2')
+SEARCH_PRODUCT_TYPES = [product_type.strip()
+                        for product_type in os.environ.get('SEARCH_PRODUCT_TYPES', 'S2MSI2A').split(',')
+                        if product_type.strip()]
+# Поля, центры которых попадают в одну ячейку сетки (градусов), ищутся одним запросом
+SEARCH_CELL_DEGREES = float(os.environ.get('SEARCH_CELL_DEGREES', 1.0))
+# Параллельных запросов к серверу поиска
+SEARCH_THREADS = int(os.environ.get('SEARCH_THREADS', 4))
+
+# Расчёт индексов (очередь processing)
+PROCESSING_DIR = os.environ.get('PROCESSING_DIR', os.path.join(DATA_DIR, 'processing'))
+PROCESSING_INDICES = [index.strip()
+                      for index in os.environ.get('PROCESSING_INDICES', 'ndvi,gndvi,lai,fapar').split(',')
+                      if index.strip()]
+PROCESSING_RESOLUTION = os.environ.get('PROCESSING_RESOLUTION', '10m')
+# Размер стороны тайла, пикс. (кратен 256)
+PROCESSING_TILE_SIZE = int(os.environ.get('PROCESSING_TILE_SIZE', 1024))
+# Сколько задач расчёта индексов воркер выполняет одновременно (его --concurrency)
+PROCESSING_CONCURRENCY = max(1, int(os.environ.get('PROCESSING_CONCURRENCY', 2)))
+# Потоков на одну задачу (0 - ядра делятся поровну между одновременными задачами воркера)
+PROCESSING_THREADS = int(os.environ.get('PROCESSING_THREADS', 0)) or \
+    max(1, (os.cpu_count() or 1) // PROCESSING_CONCURRENCY)
+# Загружать numpy/rasterio в главном процессе воркера до fork (для воркеров очереди processing)
+PROCESSING_PRELOAD = os.environ.get('PROCESSING_PRELOAD', 'false').lower() in ('1', 'true', 'yes')
+
+# Резка индексов по полям (очередь cutter)
+CUTTER_DIR = os.environ.get('CUTTER_DIR', os.path.join(DATA_DIR, 'cutter'))
+CUTTER_THREADS = int(os.environ.get('CUTTER_THREADS', 4))
+# Кэш растеризованных масок полей и его максимальный размер, байт
+MASK_CACHE_DIR = os.environ.get('MASK_CACHE_DIR', os.path.join(DATA_DIR, 'masks'))
+MASK_CACHE_SIZE = int(os.environ.get('MASK_CACHE_SIZE', 1024 * 1024 * 1024))
+
+# Цепочка скачивание -> индексы -> резка -> публикация (false - ставится только скачивание)
+PIPELINE = os.environ.get('PIPELINE', 'true').lower() in ('1', 'true', 'yes')
+# Хост с общим локальным каталогом данных: у контейнеров одной машины должен совпадать
+HOST_ID = os.environ.get('HOST_ID') or socket.gethostname()
+# Разбирать ли очередь своего хоста host.<HOST_ID> (воркеры, которые выполняют задачи цепочки после скачивания)
+HOST_AFFINITY = os.environ.get('HOST_AFFINITY', 'false').lower() in ('1', 'true', 'yes')
+HOST_HEARTBEAT_TTL = int(os.environ.get('HOST_HEARTBEAT_TTL', 30))
+# Удалять локальные файлы датасета, когда все задачи цепочки завершились (по умолчанию - если архив есть на S3)
+PIPELINE_CLEANUP = os.environ.get('PIPELINE_CLEANUP', 'true' if S3_BUCKET else 'false').lower() in ('1', 'true', 'yes')
+PIPELINE_REFS_TTL = timedelta(seconds=int(os.environ.get('PIPELINE_REFS_TTL', 7 * 24 * 3600)))
+# Сколько задача ждёт, пока архив датасета с S3 забирает другая задача того же хоста, с
+S3_FETCH_WAIT = int(os.environ.get('S3_FETCH_WAIT', 600))
+
+# Публикация нарезки (очередь publisher): на S3 под PUBLISH_S3_PREFIX и слоями в GeoServer, если он задан
+PUBLISH_S3_PREFIX = os.environ.get('PUBLISH_S3_PREFIX', 'CUT')
+GEOSERVER_URL = os.environ.get('GEOSERVER_URL')
+GEOSERVER_USER = os.environ.get('GEOSERVER_USER', 'admin')
+GEOSERVER_PASSWORD = os.environ.get('GEOSERVER_PASSWORD')
+GEOSERVER_WORKSPACE = os.environ.get('GEOSERVER_WORKSPACE', 'sentinel')
+
+# Порт, на котором главный процесс воркера отдаёт метрики prometheus (0 - не отдавать)
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 9100))
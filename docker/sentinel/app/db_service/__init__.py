@@ -1,9 +1,24 @@
-from typing import Union, List, Optional
+import logging
+import uuid
+from typing import Union, List, Optional, Callable, Any, Sequence, Mapping, Iterable, Iterator
 
+import psycopg2.errors
 import psycopg2.extensions
 import psycopg2.extras
 from psycopg2 import sql
 
+from .bulk import RowsReader, counted, table_identifier, conflict_clause
+
+from .prepared import PreparedStatementCache
+from .query_cache import QueryCache, read_tables, write_tables
+from tools.metrics import observe_db_query
+
+logger = logging.getLogger(__name__)
+
+QueryParams = Optional[Union[Sequence, Mapping]]
+
+COPY_BUFFER_SIZE = 1024 * 1024
+
 
 class DBConnection:
     """
@@ -15,18 +30,49 @@ class DBConnection:
                  user: str,
                  password: str,
                  host: str,
-                 port: int):
+                 port: int,
+                 max_retry_count: int = 2,
+                 prepared_cache_size: int = 0,
+                 query_cache: Optional[QueryCache] = None):
+        """
+        :param max_retry_count: сколько раз повторять запрос после переподключения к БД
+        :param prepared_cache_size: размер кэша серверных prepared statements для запросов с параметрами
+                                    (0 - кэш выключен)
+        :param query_cache: кэш результатов читающих запросов (None - кэш выключен),
+                            может быть общим для нескольких подключений
+        """
         self.__dbname = dbname
         self.__user = user
         self.__password = password
         self.__host = host
         self.__port = port
+        self.__max_retry_count = max_retry_count
         self.__cursor: Optional[psycopg2.extensions.cursor] = None
+        self.__dict_responses = False
         self.__is_transaction_opened = False
+        self.__transaction_statements = 0
+        self.__prepared = PreparedStatementCache(prepared_cache_size) if prepared_cache_size > 0 else None
+        self.__query_cache = query_cache
+        self.__transaction_tables = set()
         self.__connect()
 
     def __del__(self):
-        self.__connection.close()
+        self.close()
+
+    def close(self):
+        """
+        Функция закрывает подключение к БД.
+        """
+        connection = getattr(self, '_DBConnection__connection', None)
+        if connection is not None and not connection.closed:
+            connection.close()
+
+    @property
+    def closed(self) -> bool:
+        """
+        Флаг закрытого подключения к БД.
+        """
+        return self.__connection.closed != 0
 
     def __connect(self):
         """
@@ -52,31 +98,45 @@ class DBConnection:
         return self.__connection.cursor(cursor_factory=(psycopg2.extras.RealDictCursor
                                                         if dict_responses else None))
 
-    def __check_cursor(self, dict_responses: bool = False):
+    def __reconnect(self):
+        """
+        Функция переподключения к БД.
+        Если транзакция была открыта, курсор пересоздаётся на новом подключении.
         """
-        Функция проверки подключения к БД.
-        При презагрузке БД бэк не знает об этом, а при попытке обращения к БД, запрос падает с ошибкой.
-        Чтобы избежать падения запроса на бэк, класс 1 раз пытается переподключиться к БД, и снова выполняет тестовый
-        запрос. Если этот запрос не прошёл - значит БД упала и запрос к бэку упадёт с 500 ошибкой.
+        self.close()
+        self.__connect()
+        if self.__prepared is not None:
+            self.__prepared.clear()
+        if self.__is_transaction_opened:
+            self.__cursor = self.__get_cursor(dict_responses=self.__dict_responses)
 
-        :param dict_responses: флаг настройки курсора (True - функции fetch_* будут возвращать словарь,
-                                                       False - функции fetch_* будут возвращать кортеж)
+    def __with_retry(self, action: Callable[[], Any], replayable: bool = True) -> Any:
         """
+        Функция выполняет запрос без предварительной проверки подключения.
+        При презагрузке БД бэк не знает об этом, и запрос падает с OperationalError/InterfaceError. В этом случае
+        класс переподключается к БД и повторяет запрос (не более max_retry_count раз), но только если это безопасно:
+        вне транзакции или первым запросом транзакции, когда на старом подключении ещё ничего не было сделано.
+        Ошибки, которые вернул сам сервер (с SQLSTATE: таймаут запроса, deadlock, конфликт сериализации и т.п.),
+        при живом подключении пробрасываются сразу - переподключение и повтор их не лечат.
 
-        def ping_db():
-            """
-            Тестовый запрос к БД.
-            """
-            self.__cursor.execute('SELECT 1')
-            self.rollback_transaction()
+        :param action: функция, выполняющая запрос
+        :param replayable: можно ли повторить запрос после переподключения
 
-        try:
-            ping_db()
-        except Exception as e:
-            print(e)
-            self.__connect()
-            self.__cursor = self.__get_cursor(dict_responses=dict_responses)
-            ping_db()
+        :return: результат action
+        """
+        attempt = 0
+        while True:
+            try:
+                return action()
+            except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                if not replayable or attempt >= self.__max_retry_count or not self.__is_connection_lost(e):
+                    raise
+                attempt += 1
+                logger.warning(f'Подключение к БД потеряно, переподключаемся (попытка {attempt}): {e}')
+                self.__reconnect()
+
+    def __is_connection_lost(self, error: psycopg2.Error) -> bool:
+        return isinstance(error, psycopg2.InterfaceError) or self.__connection.closed != 0 or error.pgcode is None
 
     def __check_transaction_opened(self):
         """
@@ -93,21 +153,30 @@ class DBConnection:
         :param dict_responses: флаг настройки курсора (True - функции fetch_* будут возвращать словарь,
                                                        False - функции fetch_* будут возвращать кортеж)
         """
-        self.__cursor = self.__get_cursor(dict_responses=dict_responses)
-        self.__check_cursor(dict_responses=dict_responses)
+        self.__dict_responses = dict_responses
+        self.__cursor = self.__with_retry(lambda: self.__get_cursor(dict_responses=dict_responses))
         self.__is_transaction_opened = True
+        self.__transaction_statements = 0
+        self.__transaction_tables.clear()
 
     def commit_transaction(self):
         """
         Функция делает коммит транзакции, но не закрывает её.
         """
         self.__connection.commit()
+        self.__transaction_statements = 0
+        if self.__query_cache is not None and self.__transaction_tables:
+            # Данные стали видны другим подключениям - сбрасываем то, что могли закэшировать до коммита
+            self.__query_cache.invalidate(self.__transaction_tables)
+        self.__transaction_tables.clear()
 
     def rollback_transaction(self):
         """
         Функция откатывает транзакцию.
         """
         self.__connection.rollback()
+        self.__transaction_statements = 0
+        self.__transaction_tables.clear()
 
     def close_transaction(self):
         """
@@ -122,7 +191,8 @@ class DBConnection:
 
     def execute(self,
                 query: Union[str, List[str]],
-                in_transaction: bool = False):
+                in_transaction: bool = False,
+                params: QueryParams = None):
         """
         Функция выполняет запрос, который не требует возврата (INSERT, UPDATE, DELETE).
         Функция так же обрабатывает группу запросов. В этом случае, все запросы либо выполнятся одной транзакцией, если
@@ -132,20 +202,25 @@ class DBConnection:
         :param in_transaction: флаг выполнения запроса
                                (True - в транзакции (функция упадёт, если транзакция не открыта),
                                 False - не в транзакции)
+        :param params: параметры запроса (%s или %(name)s в тексте запроса), для группы запросов не поддерживаются
         """
         if in_transaction:
-            self.__execute_in_transaction(query)
+            self.__in_transaction(lambda: self.__execute_in_transaction(query, params))
+            if self.__query_cache is not None:
+                tables = write_tables(self.__query_text(query))
+                self.__transaction_tables.update(tables)
+                self.__query_cache.invalidate(tables)
         else:
-            try:
-                self.__execute(query)
-            except psycopg2.InterfaceError:
-                self.__connect()
-                self.__execute(query)
+            self.__with_retry(lambda: self.__execute(query, params))
+            if self.__query_cache is not None:
+                self.__query_cache.invalidate(write_tables(self.__query_text(query)))
 
     def fetch_one(self,
                   query: str,
                   as_dict: bool = False,
-                  in_transaction: bool = False) -> Union[psycopg2.extras.RealDictRow, tuple]:
+                  in_transaction: bool = False,
+                  params: QueryParams = None,
+                  cached: bool = False) -> Union[psycopg2.extras.RealDictRow, tuple]:
         """
         Функция выполняет запрос и возвращает первое полученное в ответе от БД значение.
         Формат возврата зависит от настроек курсора, если in_transaction == True, иначе зависит от аргумента as_dict.
@@ -156,22 +231,26 @@ class DBConnection:
         :param in_transaction: флаг выполнения запроса
                                (True - в транзакции (функция упадёт, если транзакция не открыта),
                                 False - не в транзакции)
+        :param params: параметры запроса (%s или %(name)s в тексте запроса)
+        :param cached: можно ли взять результат из кэша результатов (если он включён). Сброс кэша при записи
+                       работает только внутри процесса - только для справочных данных, которые не меняются
+                       другими процессами, или там, где устаревание на DB_CACHE_TTL допустимо
 
         :return: первое полученное из БД значение
         """
         if in_transaction:
-            return self.__fetch_one_in_transaction(query)
+            return self.__in_transaction(lambda: self.__fetch_one_in_transaction(query, params))
         else:
-            try:
-                return self.__fetch_one_no_transaction(query, as_dict)
-            except psycopg2.InterfaceError:
-                self.__connect()
-                return self.__fetch_one_no_transaction(query, as_dict)
+            return self.__cached('one', query, as_dict, params, cached,
+                                 lambda: self.__with_retry(lambda: self.__fetch_one_no_transaction(query, as_dict,
+                                                                                                   params)))
 
     def fetch_all(self,
                   query: str,
                   as_dict: bool = False,
-                  in_transaction: bool = False) -> List[Union[psycopg2.extras.RealDictRow, tuple]]:
+                  in_transaction: bool = False,
+                  params: QueryParams = None,
+                  cached: bool = False) -> List[Union[psycopg2.extras.RealDictRow, tuple]]:
         """
         Функция выполняет запрос и возвращает все полученные из БД значения.
         Формат возврата зависит от настроек курсора, если in_transaction == True, иначе зависит от аргумента as_dict.
@@ -182,33 +261,337 @@ class DBConnection:
         :param in_transaction: флаг выполнения запроса
                                (True - в транзакции (функция упадёт, если транзакция не открыта),
                                 False - не в транзакции)
+        :param params: параметры запроса (%s или %(name)s в тексте запроса)
+        :param cached: можно ли взять результат из кэша результатов (см. fetch_one)
 
         :return: все полученные из БД значения
         """
         if in_transaction:
-            return self.__fetch_all_in_transaction(query)
+            return self.__in_transaction(lambda: self.__fetch_all_in_transaction(query, params))
         else:
+            return self.__cached('all', query, as_dict, params, cached,
+                                 lambda: self.__with_retry(lambda: self.__fetch_all_no_transaction(query, as_dict,
+                                                                                                   params)))
+
+    def fetch_iter(self,
+                   query: Union[str, sql.Composed],
+                   params: QueryParams = None,
+                   batch_size: int = 1000,
+                   as_dict: bool = False,
+                   batches: bool = False,
+                   in_transaction: bool = False) -> Iterator[Union[psycopg2.extras.RealDictRow, tuple, list]]:
+        """
+        Генератор, который выполняет запрос через именованный (серверный) курсор и отдаёт строки по мере получения:
+        в памяти одновременно находится не больше batch_size строк.
+        Курсор закрывается, даже если генератор не дочитали до конца (break, исключение, close()).
+        Вне транзакции курсор живёт в собственной транзакции, которая откатывается по окончании чтения.
+
+        :param query: SQL запрос к БД
+        :param params: параметры запроса
+        :param batch_size: количество строк, получаемых с сервера за один раз
+        :param as_dict: флаг формата возврата (True - вернётся словарь
+                                               False - вернётся кортеж)
+        :param batches: флаг выдачи (True - списки по batch_size строк, False - по одной строке)
+        :param in_transaction: флаг выполнения запроса
+                               (True - в транзакции (функция упадёт, если транзакция не открыта),
+                                False - не в транзакции)
+
+        :return: строки (или списки строк) из БД
+        """
+        name = f'dbc_iter_{uuid.uuid4().hex}'
+        if in_transaction:
+            self.__check_transaction_opened()
+            as_dict = self.__dict_responses
+
+        def open_cursor() -> psycopg2.extensions.cursor:
+            cursor = self.__connection.cursor(name=name,
+                                              cursor_factory=(psycopg2.extras.RealDictCursor if as_dict else None))
+            cursor.itersize = batch_size
             try:
-                return self.__fetch_all_no_transaction(query, as_dict)
-            except psycopg2.InterfaceError:
-                self.__connect()
-                return self.__fetch_all_no_transaction(query, as_dict)
+                with observe_db_query(self.__query_text(query)):
+                    cursor.execute(query if isinstance(query, sql.Composed) else sql.SQL(query), params)
+            except Exception:
+                if in_transaction:
+                    self.rollback_transaction()
+                else:
+                    self.__connection.rollback()
+                raise
+            return cursor
+
+        if in_transaction:
+            cursor = self.__in_transaction(open_cursor)
+        else:
+            cursor = self.__with_retry(open_cursor)
+        try:
+            if batches:
+                while True:
+                    rows = cursor.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    yield rows
+            else:
+                yield from cursor
+        finally:
+            if not cursor.closed and not self.__connection.closed:
+                cursor.close()
+            if not in_transaction and not self.__connection.closed:
+                self.__connection.rollback()
+
+    # Bulk =============================================================================================================
+
+    def bulk_insert(self,
+                    table: str,
+                    columns: Sequence[str],
+                    rows: Iterable[Sequence],
+                    page_size: int = 1000,
+                    use_copy: bool = False,
+                    in_transaction: bool = False) -> int:
+        """
+        Функция вставляет в таблицу пачку строк.
+        По умолчанию строки отправляются через execute_values страницами по page_size строк, при use_copy == True -
+        через COPY FROM STDIN потоком (для очень больших пачек). Строки читаются из итератора лениво.
+
+        :param table: таблица (можно со схемой: schema.table)
+        :param columns: колонки
+        :param rows: строки (значения в порядке columns)
+        :param page_size: количество строк в одном INSERT (для execute_values)
+        :param use_copy: флаг использования COPY
+        :param in_transaction: флаг выполнения запроса
+                               (True - в транзакции (функция упадёт, если транзакция не открыта),
+                                False - не в транзакции)
+
+        :return: количество отправленных строк
+        """
+        return self.__bulk(table, columns, rows, None, page_size, use_copy, in_transaction)
+
+    def bulk_upsert(self,
+                    table: str,
+                    columns: Sequence[str],
+                    rows: Iterable[Sequence],
+                    conflict_columns: Sequence[str],
+                    update_columns: Optional[Sequence[str]] = None,
+                    page_size: int = 1000,
+                    use_copy: bool = False,
+                    in_transaction: bool = False) -> int:
+        """
+        Функция вставляет в таблицу пачку строк с ON CONFLICT, так что повторная регистрация тех же строк безопасна.
+        При use_copy == True строки сначала заливаются через COPY во временную таблицу, а потом переносятся
+        одним INSERT ... SELECT ... ON CONFLICT.
+
+        :param table: таблица (можно со схемой: schema.table)
+        :param columns: колонки
+        :param rows: строки (значения в порядке columns)
+        :param conflict_columns: колонки уникального ключа
+        :param update_columns: колонки, которые обновляются при конфликте
+                               (None - все колонки кроме ключа, пустой список - DO NOTHING)
+        :param page_size: количество строк в одном INSERT (для execute_values)
+        :param use_copy: флаг использования COPY
+        :param in_transaction: флаг выполнения запроса
+                               (True - в транзакции (функция упадёт, если транзакция не открыта),
+                                False - не в транзакции)
 
-    def __execute(self, query: Union[str, List[str]]):
+        :return: количество отправленных строк
+        """
+        if update_columns is None:
+            update_columns = [column for column in columns if column not in conflict_columns]
+        return self.__bulk(table, columns, rows, conflict_clause(conflict_columns, update_columns),
+                           page_size, use_copy, in_transaction)
+
+    def __bulk(self,
+               table: str,
+               columns: Sequence[str],
+               rows: Iterable[Sequence],
+               conflict: Optional[sql.Composed],
+               page_size: int,
+               use_copy: bool,
+               in_transaction: bool) -> int:
+        """
+        Функция выполняет bulk_insert/bulk_upsert в транзакции или без неё.
+        Повторить запрос после переподключения можно, только если строки переданы списком (генератор уже прочитан).
+        """
+        replayable = isinstance(rows, (list, tuple))
+
+        def action(cursor: psycopg2.extensions.cursor) -> int:
+            if use_copy:
+                return self.__copy_rows(cursor, table, columns, rows, conflict)
+            return self.__insert_values(cursor, table, columns, rows, conflict, page_size)
+
+        if in_transaction:
+            count = self.__in_transaction(lambda: self.__run_in_transaction(action), replayable=replayable)
+            self.__transaction_tables.add(table.split('.')[-1].lower())
+        else:
+            count = self.__with_retry(lambda: self.__run_no_transaction(action), replayable=replayable)
+        if self.__query_cache is not None:
+            self.__query_cache.invalidate({table.split('.')[-1].lower()})
+        return count
+
+    @staticmethod
+    def __insert_values(cursor: psycopg2.extensions.cursor,
+                        table: str,
+                        columns: Sequence[str],
+                        rows: Iterable[Sequence],
+                        conflict: Optional[sql.Composed],
+                        page_size: int) -> int:
+        """
+        Функция вставляет строки через execute_values (один INSERT на page_size строк).
+        """
+        query = sql.SQL('INSERT INTO {} ({}) VALUES %s').format(table_identifier(table),
+                                                                sql.SQL(', ').join(map(sql.Identifier, columns)))
+        if conflict is not None:
+            query = sql.SQL('{} {}').format(query, conflict)
+        counter = [0]
+        psycopg2.extras.execute_values(cursor, query, counted(rows, counter), page_size=page_size)
+        return counter[0]
+
+    @staticmethod
+    def __copy_rows(cursor: psycopg2.extensions.cursor,
+                    table: str,
+                    columns: Sequence[str],
+                    rows: Iterable[Sequence],
+                    conflict: Optional[sql.Composed]) -> int:
+        """
+        Функция заливает строки через COPY FROM STDIN. Для ON CONFLICT строки идут через временную таблицу.
+        """
+        reader = RowsReader(rows)
+        column_list = sql.SQL(', ').join(map(sql.Identifier, columns))
+        if conflict is None:
+            cursor.copy_expert(sql.SQL('COPY {} ({}) FROM STDIN').format(table_identifier(table), column_list),
+                               reader, size=COPY_BUFFER_SIZE)
+            return reader.count
+        tmp_table = sql.Identifier(f'bulk_{table.split(".")[-1]}')
+        cursor.execute(sql.SQL('CREATE TEMP TABLE {} (LIKE {} INCLUDING DEFAULTS) ON COMMIT DROP').format(
+            tmp_table, table_identifier(table)))
+        cursor.copy_expert(sql.SQL('COPY {} ({}) FROM STDIN').format(tmp_table, column_list),
+                           reader, size=COPY_BUFFER_SIZE)
+        cursor.execute(sql.SQL('INSERT INTO {} ({}) SELECT {} FROM {} {}').format(
+            table_identifier(table), column_list, column_list, tmp_table, conflict))
+        cursor.execute(sql.SQL('DROP TABLE {}').format(tmp_table))
+        return reader.count
+
+    def __run_no_transaction(self, action: Callable[[psycopg2.extensions.cursor], Any]) -> Any:
+        """
+        Функция выполняет action на новом курсоре одной транзакцией.
+        """
+        with self.__connection.cursor() as cursor:
+            try:
+                result = action(cursor)
+            except Exception:
+                self.__connection.rollback()
+                raise
+            self.__connection.commit()
+            return result
+
+    def __run_in_transaction(self, action: Callable[[psycopg2.extensions.cursor], Any]) -> Any:
+        """
+        Функция выполняет action на курсоре открытой транзакции, не закрывая её.
+        """
+        self.__check_transaction_opened()
+        try:
+            return action(self.__cursor)
+        except Exception:
+            self.rollback_transaction()
+            raise
+
+    # ==================================================================================================================
+
+    def __cached(self, kind: str, query: str, as_dict: bool, params: QueryParams, cached: bool,
+                 action: Callable[[], Any]) -> Any:
+        """
+        Функция выполняет читающий запрос через кэш результатов, если он включён и вызывающий разрешил кэширование.
+        Кэшируются только строковые SELECT запросы вне транзакции.
+
+        :param kind: тип запроса (one - fetch_one, all - fetch_all)
+        :param query: SQL запрос к БД
+        :param as_dict: формат возврата
+        :param params: параметры запроса
+        :param cached: разрешено ли брать результат из кэша
+        :param action: функция, выполняющая запрос
+
+        :return: результат запроса
+        """
+        if not cached or self.__query_cache is None or not isinstance(query, str):
+            return action()
+        tables = read_tables(query)
+        key = QueryCache.make_key(query, params, as_dict, kind) if tables is not None else None
+        if key is None:
+            return action()
+        found, result = self.__query_cache.get(key)
+        if not found:
+            result = action()
+            self.__query_cache.put(key, tables, result)
+        return list(result) if isinstance(result, list) else result
+
+    def __query_text(self, query: Union[str, sql.Composed, List[str]]) -> str:
+        """
+        Функция возвращает текст запроса (или группы запросов).
+        """
+        if isinstance(query, sql.Composed):
+            return query.as_string(self.__connection)
+        if isinstance(query, list):
+            return '; '.join(self.__query_text(q) for q in query)
+        return query
+
+    def __in_transaction(self, action: Callable[[], Any], replayable: bool = True) -> Any:
+        """
+        Функция выполняет запрос в открытой транзакции.
+        Повтор после переподключения возможен только для первого запроса транзакции.
+
+        :param action: функция, выполняющая запрос
+        :param replayable: можно ли в принципе повторить запрос (например, данные из генератора повторить нельзя)
+
+        :return: результат action
+        """
+        self.__check_transaction_opened()
+        result = self.__with_retry(action, replayable=replayable and self.__transaction_statements == 0)
+        self.__transaction_statements += 1
+        return result
+
+    def __cursor_execute(self, cursor: psycopg2.extensions.cursor, query: Union[str, sql.Composed],
+                         params: QueryParams = None):
+        """
+        Функция выполняет одиночный запрос через переданный курсор.
+        Строковые запросы с параметрами выполняются через кэш prepared statements, если он включён.
+
+        :param cursor: курсор psycopg2
+        :param query: SQL запрос к БД
+        :param params: параметры запроса
+        """
+        with observe_db_query(self.__query_text(query)):
+            if isinstance(query, sql.Composed):
+                cursor.execute(query, params)
+            elif self.__prepared is not None and params is not None:
+                try:
+                    self.__prepared.execute(cursor, query, params)
+                except psycopg2.errors.InvalidSqlStatementName:
+                    # statement пропал с сервера (например, после DISCARD ALL) -
+                    # подготовим его заново при следующем вызове
+                    self.__prepared.discard(query)
+                    raise
+            else:
+                cursor.execute(sql.SQL(query), params)
+
+    @property
+    def prepared_cache_stats(self) -> Optional[dict]:
+        """
+        Статистика кэша prepared statements: {size, hits, misses} или None, если кэш выключен.
+        """
+        return self.__prepared.stats if self.__prepared is not None else None
+
+    def __execute(self, query: Union[str, List[str]], params: QueryParams = None):
         """
         Функция выполняет запрос, который не требует возврата (INSERT, UPDATE, DELETE).
         Функция так же обрабатывает группу запросов. Если запросов несколько, они объединяются одну в транзакцию,
         выполняются и транзауия закрывается.
 
         :param query: запрос или группа SQL запросов к БД
+        :param params: параметры запроса
         """
+        if isinstance(query, list) and params is not None:
+            raise TypeError('Params are not supported for query list')
         with self.__connection.cursor() as cursor:
             try:
-                if isinstance(query, str):
-                    sql_query = sql.SQL(query)
-                    cursor.execute(sql_query)
-                elif isinstance(query, sql.Composed):
-                    cursor.execute(query)
+                if isinstance(query, (str, sql.Composed)):
+                    self.__cursor_execute(cursor, query, params)
                 elif isinstance(query, list):
                     prepared_queries = []
                     for q in query:
@@ -216,8 +599,9 @@ class DBConnection:
                             prepared_queries.append(q.as_string(self.__connection))
                         else:
                             prepared_queries.append(q)
-                    sql_query = sql.SQL(f"BEGIN; {'; '.join(prepared_queries)}; COMMIT;")
-                    cursor.execute(sql_query)
+                    sql_query = f"BEGIN; {'; '.join(prepared_queries)}; COMMIT;"
+                    with observe_db_query(sql_query):
+                        cursor.execute(sql.SQL(sql_query))
                 else:
                     raise TypeError
             except Exception:
@@ -226,21 +610,22 @@ class DBConnection:
 
             self.__connection.commit()
 
-    def __fetch_one(self, query: str, cursor: psycopg2.extensions.cursor) -> Union[psycopg2.extras.RealDictRow, tuple]:
+    def __fetch_one(self,
+                    query: str,
+                    cursor: psycopg2.extensions.cursor,
+                    params: QueryParams = None) -> Union[psycopg2.extras.RealDictRow, tuple]:
         """
         Функция выполняет запрос и возвращает первое полученное в ответе от БД значение.
         Функция не знает о транзакциях и выполняет запрос через переданный в неё курсор.
 
         :param query: SQL запрос к БД
         :param cursor: курсор psycopg2
+        :param params: параметры запроса
 
         :return: первое полученное из БД значение
         """
         try:
-            if isinstance(query, sql.Composed):
-                cursor.execute(query)
-            else:
-                cursor.execute(sql.SQL(query))
+            self.__cursor_execute(cursor, query, params)
         except Exception:
             self.__connection.rollback()
             raise
@@ -248,7 +633,8 @@ class DBConnection:
 
     def __fetch_one_no_transaction(self,
                                    query: str,
-                                   as_dict: bool = False) -> Union[psycopg2.extras.RealDictRow, tuple]:
+                                   as_dict: bool = False,
+                                   params: QueryParams = None) -> Union[psycopg2.extras.RealDictRow, tuple]:
         """
         Функция выполняет запрос и возвращает первое полученное в ответе от БД значение.
         Функция открывает транзакцию (создаёт курсор), выполняет запрос и закрывает транзакцию (закрывает курсор).
@@ -256,29 +642,29 @@ class DBConnection:
         :param query: SQL запрос к БД
         :param as_dict: флаг формата возврата (True - вернётся словарь
                                                False - вернётся кортеж)
+        :param params: параметры запроса
 
         :return: первое полученное из БД значение
         """
         with self.__connection.cursor(cursor_factory=(psycopg2.extras.RealDictCursor if as_dict else None)) as cursor:
-            return self.__fetch_one(query, cursor)
+            return self.__fetch_one(query, cursor, params)
 
     def __fetch_all(self,
                     query: str,
-                    cursor: psycopg2.extensions.cursor) -> List[Union[psycopg2.extras.RealDictRow, tuple]]:
+                    cursor: psycopg2.extensions.cursor,
+                    params: QueryParams = None) -> List[Union[psycopg2.extras.RealDictRow, tuple]]:
         """
         Функция выполняет запрос и возвращает все полученные из БД значения.
         Функция не знает о транзакциях и выполняет запрос через переданный в неё курсор.
 
         :param query: SQL запрос к БД
         :param cursor: курсор psycopg2
+        :param params: параметры запроса
 
         :return: все полученные из БД значения
         """
         try:
-            if isinstance(query, sql.Composed):
-                cursor.execute(query)
-            else:
-                cursor.execute(sql.SQL(query))
+            self.__cursor_execute(cursor, query, params)
         except Exception:
             self.__connection.rollback()
             raise
@@ -286,7 +672,8 @@ class DBConnection:
 
     def __fetch_all_no_transaction(self,
                                    query: str,
-                                   as_dict: bool = False) -> List[Union[psycopg2.extras.RealDictRow, tuple]]:
+                                   as_dict: bool = False,
+                                   params: QueryParams = None) -> List[Union[psycopg2.extras.RealDictRow, tuple]]:
         """
         Функция выполняет запрос и возвращает все полученные из БД значения.
         Функция открывает транзакцию (создаёт курсор), выполняет запрос и закрывает транзакцию (закрывает курсор).
@@ -294,28 +681,29 @@ class DBConnection:
         :param query: SQL запрос к БД
         :param as_dict: флаг формата возврата (True - вернётся словарь
                                                False - вернётся кортеж)
+        :param params: параметры запроса
 
         :return: все полученные из БД значения
         """
         with self.__connection.cursor(cursor_factory=(psycopg2.extras.RealDictCursor if as_dict else None)) as cursor:
-            return self.__fetch_all(query, cursor)
+            return self.__fetch_all(query, cursor, params)
 
-    def __execute_in_transaction(self, query: Union[str, List[str]]):
+    def __execute_in_transaction(self, query: Union[str, List[str]], params: QueryParams = None):
         """
         Функция выполняет запрос, который не требует возврата (INSERT, UPDATE, DELETE).
         Функция так же обрабатывает группу запросов. Если запросов несколько, они объединяются в группу запросов,
         выполняются, но транзакция не закрывается. Если транзакция не была открыта заранее, функция упадёт.
 
         :param query: запрос или группа SQL запросов к БД
+        :param params: параметры запроса
         """
         self.__check_transaction_opened()
+        if isinstance(query, list) and params is not None:
+            raise TypeError('Params are not supported for query list')
 
         try:
-            if isinstance(query, str):
-                sql_query = sql.SQL(query)
-                self.__cursor.execute(sql_query)
-            elif isinstance(query, sql.Composed):
-                self.__cursor.execute(query)
+            if isinstance(query, (str, sql.Composed)):
+                self.__cursor_execute(self.__cursor, query, params)
             elif isinstance(query, list):
                 if len(query) > 0:
                     prepared_queries = []
@@ -333,26 +721,33 @@ class DBConnection:
             self.rollback_transaction()
             raise
 
-    def __fetch_one_in_transaction(self, query: str) -> Union[psycopg2.extras.RealDictRow, tuple]:
+    def __fetch_one_in_transaction(self, query: str,
+                                   params: QueryParams = None) -> Union[psycopg2.extras.RealDictRow, tuple]:
         """
         Функция выполняет запрос и возвращает первое полученное в ответе от БД значение.
         Функция выполняется в транзакции, но не закрывает её. Если транзакция не была открыта заранее, функция упадёт.
 
         :param query: SQL запрос к БД
+        :param params: параметры запроса
 
         :return: первое полученное из БД значение
         """
         self.__check_transaction_opened()
-        return self.__fetch_one(query, self.__cursor)
+        return self.__fetch_one(query, self.__cursor, params)
 
-    def __fetch_all_in_transaction(self, query: str) -> List[Union[psycopg2.extras.RealDictRow, tuple]]:
+    def __fetch_all_in_transaction(self, query: str,
+                                   params: QueryParams = None) -> List[Union[psycopg2.extras.RealDictRow, tuple]]:
         """
         Функция выполняет запрос и возвращает все полученные из БД значения.
         Функция выполняется в транзакции, но не закрывает её. Если транзакция не была открыта заранее, функция упадёт.
 
         :param query: SQL запрос к БД
+        :param params: параметры запроса
 
         :return: все полученные из БД значения
         """
         self.__check_transaction_opened()
-        return self.__fetch_all(query, self.__cursor)
+        return self.__fetch_all(query, self.__cursor, params)
+
+
+from .pool import DBConnectionPool
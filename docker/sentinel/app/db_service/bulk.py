@@ -0,0 +1,84 @@
+import datetime
+import io
+from typing import Iterable, Iterator, Sequence, Any
+
+from psycopg2 import sql
+
+_COPY_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+
+def copy_value(value: Any) -> str:
+    """
+    Функция переводит значение в текстовый формат COPY.
+    """
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    return str(value).translate(_COPY_ESCAPES)
+
+
+class RowsReader(io.RawIOBase):
+    """
+    Файлоподобный объект для COPY FROM STDIN, который лениво кодирует строки из итератора.
+    В памяти держится только текущий буфер, а не вся пачка.
+    """
+
+    def __init__(self, rows: Iterable[Sequence]):
+        super().__init__()
+        self.__rows = iter(rows)
+        self.__buffer = b''
+        self.count = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def __fill(self, size: int):
+        lines = []
+        length = len(self.__buffer)
+        for row in self.__rows:
+            line = ('\t'.join(copy_value(value) for value in row) + '\n').encode()
+            lines.append(line)
+            length += len(line)
+            self.count += 1
+            if length >= size:
+                break
+        self.__buffer += b''.join(lines)
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            size = 1 << 62
+        if len(self.__buffer) < size:
+            self.__fill(size)
+        data, self.__buffer = self.__buffer[:size], self.__buffer[size:]
+        return data
+
+
+def counted(rows: Iterable[Sequence], counter: list) -> Iterator[Sequence]:
+    """
+    Функция считает строки, проходящие через итератор (counter[0]).
+    """
+    for row in rows:
+        counter[0] += 1
+        yield row
+
+
+def table_identifier(table: str) -> sql.Identifier:
+    """
+    Функция собирает идентификатор таблицы с учётом схемы (schema.table).
+    """
+    return sql.Identifier(*table.split('.'))
+
+
+def conflict_clause(conflict_columns: Sequence[str], update_columns: Sequence[str]) -> sql.Composed:
+    """
+    Функция собирает ON CONFLICT (...) DO UPDATE SET col = EXCLUDED.col, ... (или DO NOTHING).
+    """
+    target = sql.SQL(', ').join(map(sql.Identifier, conflict_columns))
+    if not update_columns:
+        return sql.SQL('ON CONFLICT ({}) DO NOTHING').format(target)
+    updates = sql.SQL(', ').join(sql.SQL('{0} = EXCLUDED.{0}').format(sql.Identifier(column))
+                                 for column in update_columns)
+    return sql.SQL('ON CONFLICT ({}) DO UPDATE SET {}').format(target, updates)
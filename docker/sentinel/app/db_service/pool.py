@@ -0,0 +1,323 @@
+import collections
+import threading
+import time
+from contextlib import contextmanager
+from datetime import timedelta
+from typing import Union, List, Iterator, Optional, Sequence, Iterable
+
+import psycopg2
+import psycopg2.extras
+
+from . import DBConnection, QueryParams
+from .query_cache import QueryCache
+
+
+class DBConnectionPool:
+    """
+    Пул подключений к БД с тем же интерфейсом, что и у DBConnection.
+    Запросы вне транзакции берут подключение из пула на время одного запроса, транзакция держит подключение
+    за текущим потоком от open_transaction до close_transaction.
+    """
+
+    def __init__(self,
+                 dbname: str,
+                 user: str,
+                 password: str,
+                 host: str,
+                 port: int,
+                 min_size: int = 1,
+                 max_size: int = 10,
+                 idle_timeout: timedelta = timedelta(minutes=5),
+                 health_check_interval: timedelta = timedelta(seconds=30),
+                 checkout_timeout: float = 30.0,
+                 max_retry_count: int = 2,
+                 prepared_cache_size: int = 0,
+                 query_cache_size: int = 0,
+                 query_cache_ttl: timedelta = timedelta(seconds=60)):
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError('Invalid pool size')
+        self.__dbname = dbname
+        self.__user = user
+        self.__password = password
+        self.__host = host
+        self.__port = port
+        self.__min_size = min_size
+        self.__max_size = max_size
+        self.__idle_timeout = idle_timeout.total_seconds()
+        self.__health_check_interval = health_check_interval.total_seconds()
+        self.__checkout_timeout = checkout_timeout
+        self.__max_retry_count = max_retry_count
+        self.__prepared_cache_size = prepared_cache_size
+        # Кэш результатов общий для всех подключений пула
+        self.__query_cache = QueryCache(query_cache_size, query_cache_ttl) if query_cache_size > 0 else None
+        # Свободные подключения: (подключение, время возврата в пул), справа - самые "тёплые"
+        self.__idle = collections.deque()
+        self.__size = 0
+        self.__condition = threading.Condition()
+        self.__local = threading.local()
+        for _ in range(min_size):
+            self.__idle.append((self.__new_connection(), time.monotonic()))
+            self.__size += 1
+
+    def __new_connection(self) -> DBConnection:
+        return DBConnection(dbname=self.__dbname,
+                            user=self.__user,
+                            password=self.__password,
+                            host=self.__host,
+                            port=self.__port,
+                            max_retry_count=self.__max_retry_count,
+                            prepared_cache_size=self.__prepared_cache_size,
+                            query_cache=self.__query_cache)
+
+    # Pool =============================================================================================================
+
+    def __close_expired(self):
+        """
+        Функция закрывает подключения, которые простаивают дольше idle_timeout (сверх min_size).
+        Вызывается под self.__condition.
+        """
+        now = time.monotonic()
+        while self.__idle and self.__size > self.__min_size and now - self.__idle[0][1] > self.__idle_timeout:
+            connection, _ = self.__idle.popleft()
+            connection.close()
+            self.__size -= 1
+
+    @staticmethod
+    def __is_healthy(connection: DBConnection) -> bool:
+        """
+        Функция проверки подключения, которое долго лежало в пуле.
+        """
+        if connection.closed:
+            return False
+        try:
+            connection.fetch_one('SELECT 1')
+        except psycopg2.Error:
+            return False
+        return True
+
+    def __acquire(self) -> DBConnection:
+        """
+        Функция берёт подключение из пула. Если свободных нет и пул не заполнен - создаёт новое,
+        иначе ждёт освобождения подключения не дольше checkout_timeout.
+        """
+        deadline = time.monotonic() + self.__checkout_timeout
+        with self.__condition:
+            while True:
+                self.__close_expired()
+                if self.__idle:
+                    connection, released_at = self.__idle.pop()
+                    break
+                if self.__size < self.__max_size:
+                    self.__size += 1
+                    connection, released_at = None, None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self.__condition.wait(remaining):
+                    raise TimeoutError('No free DB connections in pool')
+
+        try:
+            if connection is None:
+                connection = self.__new_connection()
+            elif time.monotonic() - released_at > self.__health_check_interval and \
+                    not self.__is_healthy(connection):
+                connection.close()
+                connection = self.__new_connection()
+        except Exception:
+            with self.__condition:
+                self.__size -= 1
+                self.__condition.notify()
+            raise
+        return connection
+
+    def __release(self, connection: DBConnection):
+        """
+        Функция возвращает подключение в пул. Закрытые подключения выбрасываются.
+        """
+        with self.__condition:
+            if connection.closed:
+                self.__size -= 1
+            else:
+                self.__idle.append((connection, time.monotonic()))
+            self.__condition.notify()
+
+    @contextmanager
+    def connection(self) -> Iterator[DBConnection]:
+        """
+        Контекстный менеджер, выдающий подключение из пула на время блока with.
+        """
+        connection = self.__acquire()
+        try:
+            yield connection
+        finally:
+            self.__release(connection)
+
+    def close(self):
+        """
+        Функция закрывает все свободные подключения пула.
+        """
+        with self.__condition:
+            while self.__idle:
+                connection, _ = self.__idle.pop()
+                connection.close()
+                self.__size -= 1
+
+    @property
+    def query_cache_stats(self) -> Optional[dict]:
+        """
+        Статистика кэша результатов: {size, hits, misses} или None, если кэш выключен.
+        """
+        return self.__query_cache.stats if self.__query_cache is not None else None
+
+    @property
+    def size(self) -> int:
+        """
+        Текущее количество подключений пула (свободных и занятых).
+        """
+        return self.__size
+
+    # Transactions =====================================================================================================
+
+    def __transaction_connection(self) -> DBConnection:
+        connection = getattr(self.__local, 'connection', None)
+        if connection is None:
+            raise Exception('Transaction not opened')
+        return connection
+
+    def open_transaction(self, dict_responses: bool = False):
+        """
+        Функция, открывающая транзакцию. Подключение закрепляется за текущим потоком до close_transaction.
+
+        :param dict_responses: флаг настройки курсора (True - функции fetch_* будут возвращать словарь,
+                                                       False - функции fetch_* будут возвращать кортеж)
+        """
+        if getattr(self.__local, 'connection', None) is not None:
+            raise Exception('Transaction already opened')
+        connection = self.__acquire()
+        try:
+            connection.open_transaction(dict_responses=dict_responses)
+        except Exception:
+            self.__release(connection)
+            raise
+        self.__local.connection = connection
+
+    def commit_transaction(self):
+        """
+        Функция делает коммит транзакции, но не закрывает её.
+        """
+        self.__transaction_connection().commit_transaction()
+
+    def rollback_transaction(self):
+        """
+        Функция откатывает транзакцию.
+        """
+        self.__transaction_connection().rollback_transaction()
+
+    def close_transaction(self):
+        """
+        Функция делает коммит транзакции, закрывает её и возвращает подключение в пул.
+        """
+        connection = self.__transaction_connection()
+        try:
+            connection.close_transaction()
+        finally:
+            self.__local.connection = None
+            self.__release(connection)
+
+    # ==================================================================================================================
+
+    def execute(self,
+                query: Union[str, List[str]],
+                in_transaction: bool = False,
+                params: QueryParams = None):
+        """
+        Функция выполняет запрос, который не требует возврата (INSERT, UPDATE, DELETE).
+        Параметры - см. DBConnection.execute.
+        """
+        if in_transaction:
+            return self.__transaction_connection().execute(query, in_transaction=True, params=params)
+        with self.connection() as connection:
+            return connection.execute(query, params=params)
+
+    def fetch_one(self,
+                  query: str,
+                  as_dict: bool = False,
+                  in_transaction: bool = False,
+                  params: QueryParams = None,
+                  cached: bool = False) -> Union[psycopg2.extras.RealDictRow, tuple]:
+        """
+        Функция выполняет запрос и возвращает первое полученное в ответе от БД значение.
+        Параметры - см. DBConnection.fetch_one.
+        """
+        if in_transaction:
+            return self.__transaction_connection().fetch_one(query, in_transaction=True, params=params)
+        with self.connection() as connection:
+            return connection.fetch_one(query, as_dict, params=params, cached=cached)
+
+    def fetch_all(self,
+                  query: str,
+                  as_dict: bool = False,
+                  in_transaction: bool = False,
+                  params: QueryParams = None,
+                  cached: bool = False) -> List[Union[psycopg2.extras.RealDictRow, tuple]]:
+        """
+        Функция выполняет запрос и возвращает все полученные из БД значения.
+        Параметры - см. DBConnection.fetch_all.
+        """
+        if in_transaction:
+            return self.__transaction_connection().fetch_all(query, in_transaction=True, params=params)
+        with self.connection() as connection:
+            return connection.fetch_all(query, as_dict, params=params, cached=cached)
+
+    def fetch_iter(self,
+                   query: str,
+                   params: QueryParams = None,
+                   batch_size: int = 1000,
+                   as_dict: bool = False,
+                   batches: bool = False,
+                   in_transaction: bool = False) -> Iterator[Union[psycopg2.extras.RealDictRow, tuple, list]]:
+        """
+        Генератор строк через серверный курсор. Подключение держится до окончания (или закрытия) генератора.
+        Параметры - см. DBConnection.fetch_iter.
+        """
+        if in_transaction:
+            yield from self.__transaction_connection().fetch_iter(query, params, batch_size, batches=batches,
+                                                                  in_transaction=True)
+            return
+        with self.connection() as connection:
+            yield from connection.fetch_iter(query, params, batch_size, as_dict, batches)
+
+    def bulk_insert(self,
+                    table: str,
+                    columns: Sequence[str],
+                    rows: Iterable[Sequence],
+                    page_size: int = 1000,
+                    use_copy: bool = False,
+                    in_transaction: bool = False) -> int:
+        """
+        Функция вставляет в таблицу пачку строк.
+        Параметры - см. DBConnection.bulk_insert.
+        """
+        if in_transaction:
+            return self.__transaction_connection().bulk_insert(table, columns, rows, page_size, use_copy,
+                                                               in_transaction=True)
+        with self.connection() as connection:
+            return connection.bulk_insert(table, columns, rows, page_size, use_copy)
+
+    def bulk_upsert(self,
+                    table: str,
+                    columns: Sequence[str],
+                    rows: Iterable[Sequence],
+                    conflict_columns: Sequence[str],
+                    update_columns: Optional[Sequence[str]] = None,
+                    page_size: int = 1000,
+                    use_copy: bool = False,
+                    in_transaction: bool = False) -> int:
+        """
+        Функция вставляет в таблицу пачку строк с ON CONFLICT.
+        Параметры - см. DBConnection.bulk_upsert.
+        """
+        if in_transaction:
+            return self.__transaction_connection().bulk_upsert(table, columns, rows, conflict_columns, update_columns,
+                                                               page_size, use_copy, in_transaction=True)
+        with self.connection() as connection:
+            return connection.bulk_upsert(table, columns, rows, conflict_columns, update_columns, page_size, use_copy)
@@ -0,0 +1,126 @@
+import collections
+import re
+from typing import Tuple
+
+import psycopg2.extensions
+
+# Строковые литералы и комментарии разбираются целиком, чтобы не трогать %s внутри них
+_TOKEN_RE = re.compile(r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|--[^\n]*|/\*.*?\*/|%%|%\((\w+)\)s|%s", re.DOTALL)
+_PLACEHOLDER_RE = re.compile(r'%\(\w+\)s|%s')
+
+
+def is_preparable(params) -> bool:
+    """
+    Функция проверяет, можно ли передать параметры в EXECUTE.
+    Кортеж psycopg2 разворачивает в список значений для IN (...), а после PREPARE на его месте один параметр $n -
+    такие запросы (и списки, для единообразия) выполняются без PREPARE.
+
+    :param params: параметры запроса (последовательность или словарь)
+    """
+    values = params.values() if isinstance(params, dict) else params
+    return not any(isinstance(value, (tuple, list)) for value in values)
+
+
+def to_prepared(query: str) -> Tuple[str, str]:
+    """
+    Функция переводит запрос с плейсхолдерами psycopg2 (%s или %(name)s) в запрос для PREPARE ($1, $2, ...).
+
+    :param query: SQL запрос с плейсхолдерами psycopg2
+
+    :return: (запрос для PREPARE, список аргументов для EXECUTE с плейсхолдерами psycopg2)
+    :raises ValueError: запрос нельзя подготовить (смешаны %s и %(name)s или плейсхолдер внутри литерала/комментария)
+    """
+    names = []
+    positional = 0
+
+    def replace(match) -> str:
+        nonlocal positional
+        token = match.group(0)
+        if token == '%%':
+            return '%'
+        if token[0] in '\'"-/':
+            if _PLACEHOLDER_RE.search(token):
+                raise ValueError('Placeholder inside a string literal or comment')
+            return token.replace('%%', '%')
+        if match.group(1) is None:
+            if names:
+                raise ValueError('Mixed %s and %(name)s placeholders')
+            positional += 1
+            return f'${positional}'
+        if positional:
+            raise ValueError('Mixed %s and %(name)s placeholders')
+        if match.group(1) not in names:
+            names.append(match.group(1))
+        return f'${names.index(match.group(1)) + 1}'
+
+    prepared_query = _TOKEN_RE.sub(replace, query)
+    if names:
+        arguments = ', '.join(f'%({name})s' for name in names)
+    else:
+        arguments = ', '.join(['%s'] * positional)
+    return prepared_query, arguments
+
+
+class PreparedStatementCache:
+    """
+    LRU кэш серверных prepared statements одного подключения.
+    Ключ - текст запроса, значение - имя statement и шаблон аргументов EXECUTE.
+    """
+
+    def __init__(self, size: int):
+        self.__size = size
+        self.__statements = collections.OrderedDict()
+        self.__counter = 0
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        """
+        Функция забывает все statements (после переподключения они уже не существуют на сервере).
+        """
+        self.__statements.clear()
+
+    def discard(self, query: str):
+        """
+        Функция удаляет statement из кэша, не трогая сервер.
+        """
+        self.__statements.pop(query, None)
+
+    def execute(self, cursor: psycopg2.extensions.cursor, query: str, params):
+        """
+        Функция выполняет запрос через EXECUTE, при необходимости предварительно подготовив его через PREPARE.
+        При переполнении кэша самый давно не используемый statement освобождается через DEALLOCATE.
+        Запросы, которые нельзя подготовить (см. is_preparable и to_prepared), выполняются обычным execute.
+
+        :param cursor: курсор psycopg2
+        :param query: SQL запрос с плейсхолдерами psycopg2
+        :param params: параметры запроса
+        """
+        if not is_preparable(params):
+            cursor.execute(query, params)
+            return
+        statement = self.__statements.get(query)
+        if statement is None:
+            try:
+                prepared_query, arguments = to_prepared(query)
+            except ValueError:
+                cursor.execute(query, params)
+                return
+            self.misses += 1
+            self.__counter += 1
+            name = f'dbc_ps_{self.__counter}'
+            while len(self.__statements) >= self.__size:
+                _, (evicted, _) = self.__statements.popitem(last=False)
+                cursor.execute(f'DEALLOCATE {evicted}')
+            cursor.execute(f'PREPARE {name} AS {prepared_query}')
+            statement = (name, arguments)
+            self.__statements[query] = statement
+        else:
+            self.hits += 1
+            self.__statements.move_to_end(query)
+        name, arguments = statement
+        cursor.execute(f'EXECUTE {name} ({arguments})' if arguments else f'EXECUTE {name}', params)
+
+    @property
+    def stats(self) -> dict:
+        return {'size': len(self.__statements), 'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,128 @@
+import collections
+import re
+import threading
+import time
+from datetime import timedelta
+from typing import Any, Hashable, Iterable, Optional, Set, Tuple
+
+_IDENT = r'((?:"[^"]+"|\w+)(?:\.(?:"[^"]+"|\w+))?)'
+_READ_TABLES_RE = re.compile(r'\b(?:FROM|JOIN)\s+' + _IDENT, re.IGNORECASE)
+_WRITE_TABLES_RE = re.compile(r'\b(?:INSERT\s+INTO|UPDATE|DELETE\s+FROM|TRUNCATE(?:\s+TABLE)?|COPY)\s+(?:ONLY\s+)?'
+                              + _IDENT, re.IGNORECASE)
+_READ_ONLY_RE = re.compile(r'^\s*(?:SELECT|WITH)\b', re.IGNORECASE)
+_MODIFYING_RE = re.compile(r'\b(?:INSERT|UPDATE|DELETE|FOR\s+UPDATE|FOR\s+SHARE|nextval)\b', re.IGNORECASE)
+
+
+def _normalize_table(name: str) -> str:
+    """
+    Функция приводит имя таблицы к виду без схемы и кавычек (schema."Table" -> table).
+    """
+    return name.split('.')[-1].strip('"').lower()
+
+
+def read_tables(query: str) -> Optional[Set[str]]:
+    """
+    Функция возвращает таблицы, которые читает запрос, или None, если запрос нельзя кэшировать
+    (не SELECT, изменяет данные или блокирует строки).
+    """
+    if not _READ_ONLY_RE.match(query) or _MODIFYING_RE.search(query):
+        return None
+    return {_normalize_table(name) for name in _READ_TABLES_RE.findall(query)}
+
+
+def write_tables(query: str) -> Set[str]:
+    """
+    Функция возвращает таблицы, которые изменяет запрос.
+    """
+    return {_normalize_table(name) for name in _WRITE_TABLES_RE.findall(query)}
+
+
+class QueryCache:
+    """
+    TTL кэш результатов читающих запросов с ограничением размера (LRU).
+    Ключ - текст запроса, параметры и формат ответа. Запись в таблицу через DBConnection.execute
+    сбрасывает все закэшированные запросы, читающие эту таблицу.
+    Кэш потокобезопасен и может быть общим для нескольких подключений.
+    """
+
+    def __init__(self, size: int, ttl: timedelta):
+        self.__size = size
+        self.__ttl = ttl.total_seconds()
+        # ключ -> (время протухания, таблицы, результат)
+        self.__entries = collections.OrderedDict()
+        # таблица -> ключи запросов, которые её читают
+        self.__by_table = collections.defaultdict(set)
+        self.__lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(query: str, params: Any, as_dict: bool, kind: str) -> Optional[Hashable]:
+        """
+        Функция собирает ключ кэша. Если параметры нехэшируемые - запрос не кэшируется (None).
+        """
+        if isinstance(params, dict):
+            params = tuple(sorted(params.items()))
+        elif isinstance(params, list):
+            params = tuple(params)
+        key = (kind, query, params, as_dict)
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def get(self, key: Hashable) -> Tuple[bool, Any]:
+        """
+        Функция возвращает (найден ли результат, результат).
+        """
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    self.__remove(key)
+                self.misses += 1
+                return False, None
+            self.__entries.move_to_end(key)
+            self.hits += 1
+            return True, entry[2]
+
+    def put(self, key: Hashable, tables: Set[str], value: Any):
+        """
+        Функция кладёт результат в кэш, вытесняя самые давно не использованные записи.
+        """
+        with self.__lock:
+            if key in self.__entries:
+                self.__remove(key)
+            while len(self.__entries) >= self.__size:
+                self.__remove(next(iter(self.__entries)))
+            self.__entries[key] = (time.monotonic() + self.__ttl, tables, value)
+            for table in tables:
+                self.__by_table[table].add(key)
+
+    def invalidate(self, tables: Iterable[str]):
+        """
+        Функция сбрасывает все записи, читающие указанные таблицы.
+        """
+        with self.__lock:
+            for table in tables:
+                for key in list(self.__by_table.get(table, ())):
+                    self.__remove(key)
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+            self.__by_table.clear()
+
+    def __remove(self, key: Hashable):
+        _, tables, _ = self.__entries.pop(key)
+        for table in tables:
+            keys = self.__by_table.get(table)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.__by_table[table]
+
+    @property
+    def stats(self) -> dict:
+        return {'size': len(self.__entries), 'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,185 @@
+"""
+Резка растров тайла по контурам полей.
+
+Маски полей берутся из MaskCache: контуры читаются из БД и растеризуются только для полей, у которых маски
+на этой сетке ещё нет или контур изменился (для проверки из БД читается только хэш геометрии). Сама резка -
+чтение окна поля из растра и наложение маски, без работы с геометрией. Поля режутся в пуле потоков,
+у каждого потока свои открытые растры.
+"""
+import json
+import math
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Sequence
+
+import numpy as np
+import rasterio
+from rasterio import features, windows
+from rasterio.windows import Window
+
+from db_service import DBConnection
+from processing.masks import FieldMask, MaskCache, grid_signature
+
+FIELD_HASHES_QUERY = """
+    SELECT uuid::text AS uuid, md5(ST_AsEWKB(geometry)) AS geometry_hash FROM fields
+    WHERE uuid = ANY(%(uuids)s::uuid[])
+"""
+FIELD_GEOMETRIES_QUERY = """
+    SELECT uuid::text AS uuid, ST_AsGeoJSON(ST_Transform(geometry, %(srid)s::int)) AS geometry
+    FROM fields
+    WHERE uuid = ANY(%(uuids)s::uuid[])
+"""
+DATASET_FIELDS_QUERY = """
+    SELECT field_uuid::text AS field_uuid FROM field_datasets WHERE dataset_guid = %(guid)s
+"""
+
+_TILE_RE = re.compile(r'_T(\d{2}[A-Z]{3})_')
+
+
+def tile_id(title: str) -> str:
+    """ Функция возвращает тайл датасета sentinel-2 по названию (S2A_MSIL2A_..._T37UCS_... -> T37UCS)
+    """
+    match = _TILE_RE.search(title)
+    if match is None:
+        raise ValueError(f'{title}: не удалось определить тайл')
+    return 'T' + match.group(1)
+
+
+def dataset_fields(db: DBConnection, guid: str) -> List[str]:
+    """ Функция возвращает поля, для которых найден датасет
+    """
+    return [row['field_uuid'] for row in db.fetch_all(DATASET_FIELDS_QUERY, as_dict=True, params={'guid': guid})]
+
+
+def field_hashes(db: DBConnection, uuids: Sequence[str]) -> Dict[str, str]:
+    """ Функция возвращает хэши текущих контуров полей
+
+    :param db: подключение к БД
+    :param uuids: идентификаторы полей
+    :return: поле -> хэш геометрии (неизвестные поля пропускаются)
+    """
+    rows = db.fetch_all(FIELD_HASHES_QUERY, as_dict=True, params={'uuids': list(uuids)})
+    return {row['uuid']: row['geometry_hash'] for row in rows}
+
+
+def field_geometries(db: DBConnection, uuids: Sequence[str], srid: int) -> Dict[str, dict]:
+    """ Функция возвращает контуры полей в системе координат растра
+
+    :param db: подключение к БД
+    :param uuids: идентификаторы полей
+    :param srid: EPSG растра
+    :return: поле -> GeoJSON геометрия
+    """
+    rows = db.fetch_all(FIELD_GEOMETRIES_QUERY, as_dict=True, params={'uuids': list(uuids), 'srid': srid})
+    return {row['uuid']: json.loads(row['geometry']) for row in rows}
+
+
+def rasterize_field(geometry: dict, transform, shape) -> FieldMask:
+    """ Функция растеризует контур поля в пределах его окна на сетке растра
+
+    :param geometry: GeoJSON геометрия в системе координат растра
+    :param transform: трансформация растра
+    :param shape: размер растра (строки, столбцы)
+    :return: FieldMask (пустая, если поле не попадает на растр)
+    """
+    xmin, ymin, xmax, ymax = features.bounds(geometry)
+    inverse = ~transform
+    corners = [inverse * (x, y) for x in (xmin, xmax) for y in (ymin, ymax)]
+    cols = [c for c, _ in corners]
+    rows = [r for _, r in corners]
+    col_off = max(0, math.floor(min(cols)))
+    row_off = max(0, math.floor(min(rows)))
+    col_end = min(shape[1], math.ceil(max(cols)))
+    row_end = min(shape[0], math.ceil(max(rows)))
+    if col_end <= col_off or row_end <= row_off:
+        return FieldMask(0, 0, 0, 0, np.zeros((0, 0), dtype=bool))
+    window = Window(col_off, row_off, col_end - col_off, row_end - row_off)
+    mask = features.rasterize([(geometry, 1)], out_shape=(row_end - row_off, col_end - col_off),
+                              transform=windows.transform(window, transform), fill=0, dtype='uint8')
+    if not mask.any():
+        return FieldMask(0, 0, 0, 0, np.zeros((0, 0), dtype=bool))
+    return FieldMask(row_off, col_off, row_end - row_off, col_end - col_off, mask.view(bool))
+
+
+def cut_fields(rasters: Dict[str, str],
+               geometry_hashes: Dict[str, str],
+               load_geometries: Callable[[List[str], int], Dict[str, dict]],
+               cache: MaskCache,
+               tile: str,
+               output_dir: str,
+               threads: int = 1,
+               logger=None) -> Dict[str, Dict[str, str]]:
+    """ Функция вырезает поля из растров одного тайла
+
+    :param rasters: название слоя (NDVI, ...) -> путь к GeoTIFF, все на одной сетке
+    :param geometry_hashes: поле -> хэш текущего контура
+    :param load_geometries: функция (поля, EPSG) -> {поле: GeoJSON}, вызывается только для полей без маски
+    :param cache: кэш масок
+    :param tile: тайл (T37UCS)
+    :param output_dir: каталог результатов (<output_dir>/<поле>/<имя растра>)
+    :param threads: количество потоков
+    :param logger: логгер
+    :return: поле -> {слой: путь}, только поля, попавшие на тайл
+    """
+    with rasterio.open(next(iter(rasters.values()))) as reference:
+        profile = reference.profile
+        transform = reference.transform
+        shape = (reference.height, reference.width)
+        crs = reference.crs
+    grid = grid_signature(crs.to_string(), tuple(transform)[:6], shape)
+    resolution = int(round(abs(transform.a)))
+
+    masks = cache.get_many(tile, resolution, grid, geometry_hashes)
+    missing = sorted(set(geometry_hashes) - set(masks))
+    if missing:
+        geometries = load_geometries(missing, crs.to_epsg())
+        computed = {field: (geometry_hashes[field], rasterize_field(geometry, transform, shape))
+                    for field, geometry in geometries.items()}
+        cache.put_many(tile, resolution, grid, computed)
+        masks.update({field: field_mask for field, (_, field_mask) in computed.items()})
+    if logger is not None:
+        logger.info(f'{tile}: {len(geometry_hashes)} полей, масок из кэша {len(geometry_hashes) - len(missing)}, '
+                    f'посчитано {len(missing)}')
+
+    fields = [(field, field_mask) for field, field_mask in sorted(masks.items()) if not field_mask.empty]
+    profile.update(driver='GTiff', count=1, tiled=False, compress='deflate', BIGTIFF='IF_SAFER')
+    profile.pop('blockxsize', None)
+    profile.pop('blockysize', None)
+    local = threading.local()
+    opened = []
+    opened_lock = threading.Lock()
+
+    def cut(item) -> Dict[str, str]:
+        field, field_mask = item
+        datasets = getattr(local, 'datasets', None)
+        if datasets is None:
+            datasets = local.datasets = {name: rasterio.open(path) for name, path in rasters.items()}
+            with opened_lock:
+                opened.append(datasets)
+        window = Window(field_mask.col_off, field_mask.row_off, field_mask.width, field_mask.height)
+        field_dir = os.path.join(output_dir, field)
+        os.makedirs(field_dir, exist_ok=True)
+        result = {}
+        for name, ds in datasets.items():
+            data = ds.read(1, window=window)
+            nodata = ds.nodata if ds.nodata is not None else (np.nan if data.dtype.kind == 'f' else 0)
+            np.copyto(data, np.array(nodata, dtype=data.dtype), where=~field_mask.mask)
+            target = os.path.join(field_dir, os.path.basename(rasters[name]))
+            with rasterio.open(target + '.tmp', 'w', **dict(profile, dtype=data.dtype, nodata=nodata,
+                                                            height=field_mask.height, width=field_mask.width,
+                                                            transform=windows.transform(window, transform))) as out:
+                out.write(data, 1)
+            os.replace(target + '.tmp', target)
+            result[name] = target
+        return result
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+            results = list(executor.map(cut, fields))
+    finally:
+        for datasets in opened:
+            for ds in datasets.values():
+                ds.close()
+    return {field: result for (field, _), result in zip(fields, results)}
@@ -0,0 +1,142 @@
+"""
+Расчёт вегетационных индексов по каналам sentinel-2 на NumPy.
+
+Все индексы считаются за один проход по тайлу: каналы один раз переводятся в отражение (float32), общие
+промежуточные величины (например, NDVI для FAPAR) считаются один раз. Все массивы тайла выделяются заранее
+и переиспользуются, операции пишут результат через out=, так что на тайл не создаётся временных массивов.
+
+LAI и FAPAR - эмпирические приближения:
+    LAI = 3.618 * EVI - 0.118 (Boegh et al., 2002)
+    FAPAR = 1.24 * NDVI - 0.168 (Myneni, Williams, 1994), ограничено [0, 1]
+"""
+from typing import Dict, Iterable, Optional, Sequence, Tuple
+
+import numpy as np
+
+# Каналы, нужные для каждого индекса
+INDEX_BANDS = {
+    'ndvi': ('B04', 'B08'),
+    'gndvi': ('B03', 'B08'),
+    'lai': ('B02', 'B04', 'B08'),
+    'fapar': ('B04', 'B08'),
+}
+# Классы SCL, которые маскируются: нет данных, битые пиксели, тени облаков, облака, перистые облака
+SCL_MASK_CLASSES = (0, 1, 3, 8, 9, 10)
+# DN -> отражение: (DN + BOA_ADD_OFFSET) / 10000
+REFLECTANCE_SCALE = 1e-4
+NODATA_DN = 0
+
+
+def required_bands(indices: Iterable[str]) -> Tuple[str, ...]:
+    """ Функция возвращает каналы, нужные для расчёта индексов
+
+    :param indices: индексы (ndvi, gndvi, lai, fapar)
+    :return: отсортированные названия каналов
+    """
+    bands = set()
+    for index in indices:
+        if index not in INDEX_BANDS:
+            raise ValueError(f'Неизвестный индекс {index}')
+        bands.update(INDEX_BANDS[index])
+    return tuple(sorted(bands))
+
+
+class IndexEngine:
+    """
+    Расчёт индексов для тайлов одного размера. Экземпляр не потокобезопасен: у каждого потока свой.
+    """
+
+    def __init__(self,
+                 indices: Sequence[str],
+                 tile_shape: Tuple[int, int] = (1024, 1024),
+                 offset: float = 0.0,
+                 mask_classes: Sequence[int] = SCL_MASK_CLASSES):
+        """
+        :param indices: индексы (ndvi, gndvi, lai, fapar)
+        :param tile_shape: максимальный размер тайла (строки, столбцы)
+        :param offset: BOA_ADD_OFFSET продукта (-1000 для baseline 04.00 и новее)
+        :param mask_classes: маскируемые классы SCL
+        """
+        self.indices = tuple(indices)
+        self.bands = required_bands(self.indices)
+        self.tile_shape = tile_shape
+        self.offset = np.float32(offset)
+        self.scale = np.float32(REFLECTANCE_SCALE)
+        # Таблица "класс SCL -> маскировать": маска по SCL - одна операция индексирования
+        self.__scl_table = np.zeros(256, dtype=bool)
+        self.__scl_table[list(mask_classes)] = True
+
+        shape = tile_shape
+        self.__reflectance = {band: np.empty(shape, dtype=np.float32) for band in self.bands}
+        self.__invalid = np.empty(shape, dtype=bool)
+        self.__band_invalid = np.empty(shape, dtype=bool)
+        self.__numerator = np.empty(shape, dtype=np.float32)
+        self.__denominator = np.empty(shape, dtype=np.float32)
+        self.__ndvi = np.empty(shape, dtype=np.float32)
+        self.__outputs = {index: np.empty(shape, dtype=np.float32) for index in self.indices}
+
+    def compute(self, bands: Dict[str, np.ndarray], scl: Optional[np.ndarray] = None) -> Dict[str, np.ndarray]:
+        """ Функция считает индексы для тайла
+
+        :param bands: DN каналов (uint16), все одного размера не больше tile_shape
+        :param scl: классы SCL того же размера (None - маска только по nodata)
+        :return: индекс -> float32, NaN в замаскированных пикселях. Массивы переиспользуются следующим вызовом
+        """
+        h, w = bands[self.bands[0]].shape
+        if h > self.tile_shape[0] or w > self.tile_shape[1]:
+            raise ValueError(f'Тайл {h}x{w} больше {self.tile_shape}')
+        invalid = self.__invalid[:h, :w]
+        band_invalid = self.__band_invalid[:h, :w]
+        numerator = self.__numerator[:h, :w]
+        denominator = self.__denominator[:h, :w]
+
+        if scl is not None:
+            np.take(self.__scl_table, scl, out=invalid)
+        else:
+            invalid.fill(False)
+        refl = {}
+        for band in self.bands:
+            dn = bands[band]
+            np.equal(dn, NODATA_DN, out=band_invalid)
+            np.logical_or(invalid, band_invalid, out=invalid)
+            r = self.__reflectance[band][:h, :w]
+            np.add(dn, self.offset, out=r, dtype=np.float32)
+            np.multiply(r, self.scale, out=r)
+            refl[band] = r
+
+        outputs = {index: self.__outputs[index][:h, :w] for index in self.indices}
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if 'ndvi' in outputs or 'fapar' in outputs:
+                ndvi = outputs.get('ndvi', self.__ndvi[:h, :w])
+                self.__normalized_difference(refl['B08'], refl['B04'], ndvi, numerator, denominator)
+            if 'gndvi' in outputs:
+                self.__normalized_difference(refl['B08'], refl['B03'], outputs['gndvi'], numerator, denominator)
+            if 'fapar' in outputs:
+                fapar = outputs['fapar']
+                np.multiply(ndvi, np.float32(1.24), out=fapar)
+                np.subtract(fapar, np.float32(0.168), out=fapar)
+                np.clip(fapar, 0.0, 1.0, out=fapar)
+            if 'lai' in outputs:
+                lai = outputs['lai']
+                # EVI = 2.5 * (NIR - RED) / (NIR + 6 * RED - 7.5 * BLUE + 1)
+                np.subtract(refl['B08'], refl['B04'], out=numerator)
+                np.multiply(refl['B04'], np.float32(6.0), out=denominator)
+                np.add(denominator, refl['B08'], out=denominator)
+                np.multiply(refl['B02'], np.float32(7.5), out=lai)
+                np.subtract(denominator, lai, out=denominator)
+                np.add(denominator, np.float32(1.0), out=denominator)
+                np.divide(numerator, denominator, out=lai)
+                np.multiply(lai, np.float32(2.5 * 3.618), out=lai)
+                np.subtract(lai, np.float32(0.118), out=lai)
+
+        for output in outputs.values():
+            np.copyto(output, np.float32(np.nan), where=invalid)
+        return outputs
+
+    @staticmethod
+    def __normalized_difference(a: np.ndarray, b: np.ndarray, out: np.ndarray,
+                                numerator: np.ndarray, denominator: np.ndarray):
+        # (a - b) / (a + b)
+        np.subtract(a, b, out=numerator)
+        np.add(a, b, out=denominator)
+        np.divide(numerator, denominator, out=out)
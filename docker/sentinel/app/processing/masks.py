@@ -0,0 +1,212 @@
+"""
+Кэш масок полей на сетке тайла: растеризация контура поля делается один раз для (поле, тайл, разрешение),
+дальше резка поля - чтение окна и наложение готовой маски.
+
+Маска хранится только в пределах окна поля, по биту на пиксель (np.packbits по строкам), и читается через
+np.memmap. Индекс масок - sqlite в каталоге кэша, общий для всех процессов. Запись становится недействительной,
+если изменился контур поля (хэш геометрии) или сетка тайла (CRS, трансформация, размер). Общий размер файлов
+ограничен: при переполнении удаляются давно не использованные маски.
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Dict, Iterable, List, NamedTuple, Tuple
+
+import numpy as np
+
+INDEX_FILENAME = '.masks.sqlite'
+MASK_SUFFIX = '.bits'
+
+
+class FieldMask(NamedTuple):
+    # Окно поля в пикселях тайла: смещение строки и столбца, высота и ширина (0 - поле не попадает на тайл)
+    row_off: int
+    col_off: int
+    height: int
+    width: int
+    # bool (height, width)
+    mask: np.ndarray
+
+    @property
+    def empty(self) -> bool:
+        return self.height == 0 or self.width == 0
+
+
+def grid_signature(crs: str, transform: Iterable[float], shape: Tuple[int, int]) -> str:
+    """ Функция возвращает подпись сетки растра: маски с одной подписью накладываются пиксель в пиксель
+
+    :param crs: CRS растра (WKT или EPSG:...)
+    :param transform: аффинная трансформация (a, b, c, d, e, f)
+    :param shape: размер растра (строки, столбцы)
+    :return: хэш сетки
+    """
+    text = '|'.join([str(crs)] + [repr(round(float(v), 6)) for v in transform] + [str(n) for n in shape])
+    return hashlib.md5(text.encode()).hexdigest()
+
+
+def pack_mask(mask: np.ndarray) -> bytes:
+    return np.packbits(mask, axis=1).tobytes()
+
+
+def unpack_mask(data: np.ndarray, height: int, width: int) -> np.ndarray:
+    return np.unpackbits(data.reshape(height, -1), axis=1, count=width).view(bool)
+
+
+class MaskCache:
+    """
+    Кэш масок полей с ограничением общего размера (LRU).
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int = 1024 ** 3):
+        """
+        :param cache_dir: каталог кэша
+        :param max_bytes: максимальный общий размер файлов масок
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.__filename = os.path.join(cache_dir, INDEX_FILENAME)
+        self.__local = threading.local()
+
+    def __connection(self) -> sqlite3.Connection:
+        connection = getattr(self.__local, 'connection', None)
+        if connection is None or getattr(self.__local, 'pid', None) != os.getpid():
+            os.makedirs(self.cache_dir, exist_ok=True)
+            connection = sqlite3.connect(self.__filename, timeout=30, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS masks ('
+                               'field TEXT NOT NULL, tile TEXT NOT NULL, resolution INTEGER NOT NULL, '
+                               'geometry_hash TEXT NOT NULL, grid TEXT NOT NULL, '
+                               'row_off INTEGER NOT NULL, col_off INTEGER NOT NULL, '
+                               'height INTEGER NOT NULL, width INTEGER NOT NULL, '
+                               'filename TEXT, size INTEGER NOT NULL, last_used REAL NOT NULL, '
+                               'PRIMARY KEY (field, tile, resolution))')
+            connection.execute('CREATE INDEX IF NOT EXISTS masks_last_used ON masks (last_used)')
+            self.__local.connection = connection
+            self.__local.pid = os.getpid()
+        return connection
+
+    def get_many(self, tile: str, resolution: int, grid: str,
+                 geometry_hashes: Dict[str, str]) -> Dict[str, FieldMask]:
+        """ Функция возвращает действительные маски полей и отмечает их использование
+
+        :param tile: тайл (T37UCS)
+        :param resolution: разрешение, м
+        :param grid: подпись сетки (grid_signature)
+        :param geometry_hashes: поле -> хэш текущего контура
+        :return: поле -> маска, для полей, у которых маска есть и не устарела
+        """
+        connection = self.__connection()
+        result = {}
+        used = []
+        fields = list(geometry_hashes)
+        # sqlite ограничивает количество параметров запроса
+        for start in range(0, len(fields), 500):
+            chunk = fields[start:start + 500]
+            rows = connection.execute(
+                'SELECT field, geometry_hash, grid, row_off, col_off, height, width, filename FROM masks '
+                f'WHERE tile = ? AND resolution = ? AND field IN ({",".join("?" * len(chunk))})',
+                [tile, resolution] + chunk).fetchall()
+            for field, geometry_hash, row_grid, row_off, col_off, height, width, filename in rows:
+                if geometry_hash != geometry_hashes[field] or row_grid != grid:
+                    continue
+                if filename is None:
+                    mask = np.zeros((0, 0), dtype=bool)
+                else:
+                    try:
+                        data = np.memmap(os.path.join(self.cache_dir, filename), dtype=np.uint8, mode='r')
+                    except (OSError, ValueError):
+                        # Файл удалили при вытеснении в другом процессе - маска будет посчитана заново
+                        continue
+                    mask = unpack_mask(data, height, width)
+                result[field] = FieldMask(row_off, col_off, height, width, mask)
+                used.append(field)
+        if used:
+            now = time.time()
+            connection.execute('BEGIN')
+            connection.executemany('UPDATE masks SET last_used = ? WHERE field = ? AND tile = ? AND resolution = ?',
+                                   [(now, field, tile, resolution) for field in used])
+            connection.execute('COMMIT')
+        return result
+
+    def put_many(self, tile: str, resolution: int, grid: str, masks: Dict[str, Tuple[str, FieldMask]]):
+        """ Функция сохраняет маски полей и вытесняет старые, если кэш переполнен
+
+        :param tile: тайл (T37UCS)
+        :param resolution: разрешение, м
+        :param grid: подпись сетки (grid_signature)
+        :param masks: поле -> (хэш контура, маска)
+        """
+        rows = []
+        now = time.time()
+        for field, (geometry_hash, field_mask) in masks.items():
+            filename = None
+            size = 0
+            if not field_mask.empty:
+                data = pack_mask(field_mask.mask)
+                # Уникальное имя: старый файл мог быть открыт читателем в другом процессе
+                filename = f'{tile}/{resolution}/{field}.{uuid.uuid4().hex[:8]}{MASK_SUFFIX}'
+                path = os.path.join(self.cache_dir, filename)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path + '.tmp', 'wb') as f:
+                    f.write(data)
+                os.replace(path + '.tmp', path)
+                size = len(data)
+            rows.append((field, tile, resolution, geometry_hash, grid, field_mask.row_off, field_mask.col_off,
+                         field_mask.height, field_mask.width, filename, size, now))
+        connection = self.__connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            replaced = self.__filenames(connection, tile, resolution, list(masks))
+            connection.executemany('INSERT OR REPLACE INTO masks (field, tile, resolution, geometry_hash, grid, '
+                                   'row_off, col_off, height, width, filename, size, last_used) '
+                                   'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            evicted = self.__evict(connection)
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        for filename in replaced + evicted:
+            self.__remove_file(filename)
+
+    def size(self) -> int:
+        """ Функция возвращает общий размер файлов масок, байт
+        """
+        return self.__connection().execute('SELECT COALESCE(SUM(size), 0) FROM masks').fetchone()[0]
+
+    @staticmethod
+    def __filenames(connection: sqlite3.Connection, tile: str, resolution: int, fields: List[str]) -> List[str]:
+        filenames = []
+        for start in range(0, len(fields), 500):
+            chunk = fields[start:start + 500]
+            filenames += [row[0] for row in connection.execute(
+                'SELECT filename FROM masks WHERE filename IS NOT NULL AND tile = ? AND resolution = ? '
+                f'AND field IN ({",".join("?" * len(chunk))})', [tile, resolution] + chunk)]
+        return filenames
+
+    def __evict(self, connection: sqlite3.Connection) -> List[str]:
+        total = connection.execute('SELECT COALESCE(SUM(size), 0) FROM masks').fetchone()[0]
+        if total <= self.max_bytes:
+            return []
+        evicted = []
+        keys = []
+        # Освобождаем с запасом, чтобы не вытеснять на каждой записи
+        target = self.max_bytes * 0.9
+        for field, tile, resolution, filename, size in connection.execute(
+                'SELECT field, tile, resolution, filename, size FROM masks ORDER BY last_used').fetchall():
+            if total <= target:
+                break
+            keys.append((field, tile, resolution))
+            if filename is not None:
+                evicted.append(filename)
+            total -= size
+        connection.executemany('DELETE FROM masks WHERE field = ? AND tile = ? AND resolution = ?', keys)
+        return evicted
+
+    def __remove_file(self, filename: str):
+        try:
+            os.remove(os.path.join(self.cache_dir, filename))
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,286 @@
+"""
+Чтение каналов продукта sentinel-2 окнами и запись индексов в GeoTIFF.
+
+Продукт обрабатывается тайлами (окнами) в пуле потоков: чтение JPEG2000/GeoTIFF в GDAL и операции NumPy
+отпускают GIL, так что одна задача занимает несколько ядер. У каждого потока свои открытые датасеты и свой
+IndexEngine с буферами. Каждый выходной файл пишется под своей блокировкой, так что сжатие разных индексов
+идёт параллельно.
+Несжатые GeoTIFF не читаются через GDAL, а отображаются в память (np.memmap) - окно тогда просто срез.
+"""
+import fnmatch
+import glob
+import os
+import re
+import sys
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+from xml.etree import ElementTree
+
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.windows import Window
+
+from processing.indices import IndexEngine, required_bands
+from sentinel.remote_zip import band_patterns
+
+# Классы сцены есть только в L2A и только в 20m/60m - читаются с пересчётом на сетку каналов
+SCL_BAND = 'SCL'
+# Размер блока выходного GeoTIFF, размер тайла обработки должен быть ему кратен
+OUTPUT_BLOCK_SIZE = 256
+# Сжатие выходных GeoTIFF - самая дорогая часть обработки; это промежуточные файлы для резчика,
+# поэтому быстрый уровень deflate важнее размера
+OUTPUT_ZLEVEL = 1
+_RESOLUTION_RE = re.compile(r'_(\d+)m\.jp2$')
+
+
+def find_bands(product_path: str, bands: Sequence[str], resolution: Optional[str] = None) -> Dict[str, str]:
+    """ Функция находит файлы каналов в продукте
+
+    :param product_path: каталог продукта (<название>.SAFE или каталог, в котором он лежит) или zip-архив
+    :param bands: каналы (B04, B08, SCL, ...)
+    :param resolution: разрешение для L2A (10m, 20m, 60m), None - самое подробное из имеющихся
+    :return: канал -> путь, который можно открыть rasterio (файлы внутри архива - через /vsizip/)
+    """
+    names, prefix = _list_product(product_path)
+    paths = {}
+    for band in bands:
+        matches = [name for name in names
+                   if any(fnmatch.fnmatchcase(name, p) for p in band_patterns([band], resolution, metadata=False))]
+        if not matches:
+            raise FileNotFoundError(f'{product_path}: не найден канал {band}'
+                                    f'{f" с разрешением {resolution}" if resolution else ""}')
+        # L1C - один файл на канал, L2A - по файлу на разрешение
+        matches.sort(key=_resolution)
+        paths[band] = prefix + matches[0]
+    return paths
+
+
+def read_offset(product_path: str) -> float:
+    """ Функция читает смещение DN из метаданных продукта (BOA_ADD_OFFSET для L2A, RADIO_ADD_OFFSET для L1C)
+
+    :param product_path: каталог продукта или zip-архив
+    :return: смещение (0 для продуктов до baseline 04.00)
+    """
+    names, _ = _list_product(product_path)
+    metadata = [name for name in names if fnmatch.fnmatchcase(name, '*MTD_MSIL*.xml')]
+    if not metadata:
+        return 0.0
+    if zipfile.is_zipfile(product_path):
+        with zipfile.ZipFile(product_path) as zf:
+            content = zf.read(metadata[0])
+    else:
+        with open(os.path.join(product_path, metadata[0]), 'rb') as f:
+            content = f.read()
+    for element in ElementTree.fromstring(content).iter():
+        # Смещение задаётся для каждого канала, но у всех каналов продукта оно одно
+        if element.tag.endswith('BOA_ADD_OFFSET') or element.tag.endswith('RADIO_ADD_OFFSET'):
+            return float(element.text)
+    return 0.0
+
+
+def _list_product(product_path: str) -> Tuple[List[str], str]:
+    if os.path.isdir(product_path):
+        names = [os.path.relpath(path, product_path)
+                 for path in glob.iglob(os.path.join(product_path, '**', '*'), recursive=True)]
+        return names, product_path.rstrip('/') + '/'
+    with zipfile.ZipFile(product_path) as zf:
+        return zf.namelist(), f'/vsizip/{product_path}/'
+
+
+def _resolution(name: str) -> int:
+    match = _RESOLUTION_RE.search(name)
+    return int(match.group(1)) if match else 0
+
+
+def iter_windows(height: int, width: int, tile: int) -> Iterator[Window]:
+    """ Функция разбивает растр на окна
+
+    :param height: высота растра
+    :param width: ширина растра
+    :param tile: размер стороны окна
+    :return: окна по строкам
+    """
+    for row in range(0, height, tile):
+        for col in range(0, width, tile):
+            yield Window(col, row, min(tile, width - col), min(tile, height - row))
+
+
+def memmap_raster(dataset) -> Optional[np.ndarray]:
+    """ Функция отображает в память первый канал несжатого GeoTIFF
+
+    :param dataset: открытый датасет rasterio
+    :return: массив (строки, столбцы) поверх файла или None, если файл так прочитать нельзя
+        (сжатие, тайлы, несколько каналов, чужой порядок байт, файл внутри архива)
+    """
+    if dataset.driver != 'GTiff' or dataset.count != 1 or dataset.compression is not None or \
+            dataset.name.startswith('/vsi'):
+        return None
+    block_height, block_width = dataset.block_shapes[0]
+    if block_width != dataset.width:
+        return None
+    dtype = np.dtype(dataset.dtypes[0])
+    with open(dataset.name, 'rb') as f:
+        if f.read(2) != (b'II' if sys.byteorder == 'little' else b'MM'):
+            return None
+    last_strip = (dataset.height - 1) // block_height
+    # Смещения полос GDAL отдаёт только поштучно
+    first = dataset.get_tag_item('BLOCK_OFFSET_0_0', 'TIFF', bidx=1)
+    last = dataset.get_tag_item(f'BLOCK_OFFSET_0_{last_strip}', 'TIFF', bidx=1)
+    if not first or not last:
+        return None
+    first, last = int(first), int(last)
+    # Полосы должны идти в файле подряд
+    if last - first != last_strip * block_height * dataset.width * dtype.itemsize:
+        return None
+    return np.memmap(dataset.name, dtype=dtype, mode='r', offset=first, shape=(dataset.height, dataset.width))
+
+
+class BandReader:
+    """
+    Чтение окон каналов продукта в буферы потока. Экземпляр не потокобезопасен: у каждого потока свой.
+    """
+
+    def __init__(self, paths: Dict[str, str], shape: Tuple[int, int], scl_path: Optional[str] = None):
+        """
+        :param paths: канал -> путь (все каналы одного разрешения)
+        :param shape: размер растра каналов (строки, столбцы)
+        :param scl_path: путь к SCL (может быть другого разрешения)
+        """
+        self.shape = shape
+        self.__datasets = {band: rasterio.open(path) for band, path in paths.items()}
+        self.__memmaps = {band: memmap_raster(ds) for band, ds in self.__datasets.items()}
+        self.__scl = rasterio.open(scl_path) if scl_path else None
+        self.__buffers = {}
+
+    def read(self, window: Window) -> Tuple[Dict[str, np.ndarray], Optional[np.ndarray]]:
+        """ Функция читает окно всех каналов и SCL
+
+        :param window: окно в пикселях каналов
+        :return: канал -> DN, SCL (None, если нет)
+        """
+        shape = (int(window.height), int(window.width))
+        rows, cols = window.toslices()
+        bands = {}
+        for band, ds in self.__datasets.items():
+            memmap = self.__memmaps[band]
+            if memmap is not None:
+                bands[band] = memmap[rows, cols]
+            else:
+                bands[band] = ds.read(1, window=window, out=self.__buffer(band, shape, ds.dtypes[0]))
+        scl = None
+        if self.__scl is not None:
+            # Окно в пикселях SCL, чтение с пересчётом ближайшим соседом на сетку каналов
+            y_ratio = self.__scl.height / self.shape[0]
+            x_ratio = self.__scl.width / self.shape[1]
+            scl_window = Window(window.col_off * x_ratio, window.row_off * y_ratio,
+                                window.width * x_ratio, window.height * y_ratio)
+            scl = self.__scl.read(1, window=scl_window, out=self.__buffer(SCL_BAND, shape, self.__scl.dtypes[0]),
+                                  resampling=Resampling.nearest)
+        return bands, scl
+
+    def close(self):
+        for ds in self.__datasets.values():
+            ds.close()
+        if self.__scl is not None:
+            self.__scl.close()
+
+    def __buffer(self, band: str, shape: Tuple[int, int], dtype: str) -> np.ndarray:
+        # Крайние окна меньше остальных - буфер на каждый размер, их не больше четырёх
+        key = (band, shape)
+        buffer = self.__buffers.get(key)
+        if buffer is None:
+            buffer = self.__buffers[key] = np.empty(shape, dtype=dtype)
+        return buffer
+
+
+def compute_indices(product_path: str, indices: Sequence[str], output_dir: str, name: str,
+                    resolution: Optional[str] = '10m', tile: int = 1024, threads: int = 1,
+                    use_scl: bool = True) -> Dict[str, str]:
+    """ Функция считает индексы по продукту и сохраняет каждый в GeoTIFF
+
+    :param product_path: каталог продукта или zip-архив
+    :param indices: индексы (ndvi, gndvi, lai, fapar)
+    :param output_dir: каталог для результатов
+    :param name: префикс имён файлов (обычно название продукта)
+    :param resolution: разрешение каналов L2A
+    :param tile: размер стороны окна обработки, кратный OUTPUT_BLOCK_SIZE
+    :param threads: количество потоков
+    :param use_scl: маскировать облака и тени по SCL (если SCL в продукте есть)
+    :return: индекс -> путь к GeoTIFF
+    """
+    if tile % OUTPUT_BLOCK_SIZE:
+        raise ValueError(f'Размер тайла {tile} должен быть кратен {OUTPUT_BLOCK_SIZE}')
+    paths = find_bands(product_path, required_bands(indices), resolution)
+    scl_path = None
+    if use_scl:
+        try:
+            scl_path = find_bands(product_path, [SCL_BAND])[SCL_BAND]
+        except FileNotFoundError:
+            # L1C - маска только по nodata
+            pass
+    offset = read_offset(product_path)
+
+    with rasterio.open(next(iter(paths.values()))) as reference:
+        profile = reference.profile
+        shape = (reference.height, reference.width)
+    for band, path in paths.items():
+        with rasterio.open(path) as ds:
+            if (ds.height, ds.width) != shape:
+                raise ValueError(f'{path}: размер канала {band} {ds.height}x{ds.width} отличается от {shape}')
+
+    profile.update(driver='GTiff', dtype='float32', count=1, nodata=float('nan'), tiled=True,
+                   blockxsize=OUTPUT_BLOCK_SIZE, blockysize=OUTPUT_BLOCK_SIZE, compress='deflate', predictor=3,
+                   zlevel=OUTPUT_ZLEVEL, num_threads=max(1, threads), BIGTIFF='IF_SAFER')
+    os.makedirs(output_dir, exist_ok=True)
+    targets = {index: os.path.join(output_dir, f'{name}_{index.upper()}.tif') for index in indices}
+    outputs = {index: rasterio.open(target + '.tmp', 'w', **profile) for index, target in targets.items()}
+    write_locks = {index: threading.Lock() for index in indices}
+    workers_lock = threading.Lock()
+    local = threading.local()
+    workers = []
+
+    def process(window: Window):
+        worker = getattr(local, 'worker', None)
+        if worker is None:
+            worker = local.worker = (BandReader(paths, shape, scl_path),
+                                     IndexEngine(indices, (tile, tile), offset))
+            with workers_lock:
+                workers.append(worker)
+        reader, engine = worker
+        bands, scl = reader.read(window)
+        result = engine.compute(bands, scl)
+        # Буферы engine переиспользуются следующим окном этого же потока - пишем сразу.
+        # Сначала в свободные файлы, ждём только когда свободных не осталось
+        pending = list(result)
+        while pending:
+            for index in pending:
+                if write_locks[index].acquire(blocking=False):
+                    break
+            else:
+                index = pending[0]
+                write_locks[index].acquire()
+            try:
+                outputs[index].write(result[index], 1, window=window)
+            finally:
+                write_locks[index].release()
+            pending.remove(index)
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+            # list - чтобы ошибка любого окна всплыла здесь
+            list(executor.map(process, iter_windows(shape[0], shape[1], tile)))
+    except BaseException:
+        for index, output in outputs.items():
+            output.close()
+            os.remove(targets[index] + '.tmp')
+        raise
+    finally:
+        for reader, _ in workers:
+            reader.close()
+    for index, output in outputs.items():
+        output.close()
+        os.replace(targets[index] + '.tmp', targets[index])
+    return targets
@@ -1,31 +1,40 @@
+import argparse
+import logging
+
 import config
 
 
 try:
-    from tasks.worker import downloader
     from tasks.celery_app import app
     from db_service import DBConnection
+    from sentinel.enqueuer import enqueue_pending
+    from tools.redis_pool import get_redis
 except:
-    from .tasks.worker import downloader
     from .tasks.celery_app import app
     from .db_service import DBConnection
+    from .sentinel.enqueuer import enqueue_pending
+    from .tools.redis_pool import get_redis
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--page-size', type=int, default=config.ENQUEUE_PAGE_SIZE)
+    parser.add_argument('--limit', type=int, default=None)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
 
     db_connection = DBConnection(dbname=config.DB_NAME,
                                  user=config.DB_USER,
                                  password=config.DB_PASSWORD,
                                  host=config.DB_IP,
-                                 port=config.DB_PORT)
-
-    # Вытаскиваем данные из БД по нескаченным датасетам
-    query = "SELECT guid, title FROM datasets;"
-    res = db_connection.fetch_all(query, True)
-    print(f'Got {len(res)} datasets to')
-    for i in range(0, 2):
-        app.send_task(name='downloader:sentinel',
-                      args=[res[i]['guid'], res[i]['title']])
+                                 port=config.DB_PORT,
+                                 max_retry_count=config.MAX_QUERY_RETRY_COUNT,
+                                 prepared_cache_size=config.DB_PREPARED_CACHE_SIZE)
+
+    # Вытаскиваем данные из БД по нескаченным датасетам и ставим их в очередь пачками
+    enqueue_pending(db_connection, app, get_redis(config.REDIS_URL), logging.getLogger(__name__),
+                    page_size=args.page_size, ttl=int(config.ENQUEUE_TTL.total_seconds()), limit=args.limit,
+                    follow_up=config.PIPELINE)
 
     # app.send_task(name='downloader:sentinel',
     #               args=[res['guid'], res['title']])
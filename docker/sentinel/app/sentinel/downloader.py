@@ -1,92 +1,138 @@
 import datetime
+import fnmatch
 import os
+import shutil
 import time
+import zipfile
+from typing import List, Optional, Tuple
+
 import requests
 
-from tools.web import get_filename_from_content_disposition
+import config
+from sentinel.file_sink import ChecksumMismatchError, FileSink
+from sentinel.partial import load_part_state, save_part_state, remove_part
+from sentinel.product_cache import ProductIndex
+from sentinel.progress import DownloadProgress
+from sentinel.remote_zip import band_patterns, extract_members, member_path, read_central_directory, \
+    select_members
+from sentinel.s3_upload import MultipartUpload, object_matches
+from sentinel.segmented import probe_ranges, download_segmented, replay_part
+from sentinel.session import get_session
+from sentinel.status import STATUS_DOWNLOADED, STATUS_ERROR, StatusWriter
+from tools.metrics import DOWNLOADS, DOWNLOAD_SPEED, ONLINE_CHECK_SECONDS, WORKER
+from tools.web import get_filename_from_content_disposition, parse_content_range
+
+
+PRODUCT_URL = config.COPERNICUS_URL + "/Products('{}')"
+STREAM_CHUNK_SIZE = config.DOWNLOAD_CHUNK_SIZE
+
+
+class ProductOfflineError(Exception):
+    """
+    Датасет лежит в долгосрочном архиве (LTA), скачать его сейчас нельзя.
+    """
+
+    def __init__(self, product_guid: str, restore_triggered: bool):
+        super().__init__(f'датасет {product_guid} не в онлайне')
+        self.product_guid = product_guid
+        self.restore_triggered = restore_triggered
 
 
-def download_dataset(worker, product_guid: str, product_title: str, cred: str, tmp_dir: str, logger):
-    _PRODUCT_URL = "https://scihub.copernicus.eu/dhus/odata/v1/Products('{}')"
-    """ Функция выкачивает и сохраняет датасет на S3
+def download_dataset(worker, product_guid: str, product_title: str, cred: str, tmp_dir: str, logger,
+                     segments: int = 1, index: Optional[ProductIndex] = None,
+                     sink: Optional[MultipartUpload] = None, keep_local: bool = True,
+                     status: Optional[StatusWriter] = None) -> str:
+    """ Функция выкачивает и сохраняет датасет на S3.
+    Если датасет не в онлайне, функция запрашивает его восстановление из архива и падает с ProductOfflineError.
 
     :param product: - датасет
     :param cred:  - авторизационные данные для работы с сервисом scihub.copernucus.eu
     :param tmp_dir: - временный каталог для сохранения и обработки файлов
-    :return:
+    :param segments: - количество параллельных соединений на один файл (1 - качаем одним потоком)
+    :param index: - индекс уже скачанных датасетов (None - не проверять и не регистрировать)
+    :param sink: - multipart upload на S3, в который скачанные куски уходят по ходу загрузки (None - только диск).
+                   Upload завершается здесь же, прервать его при ошибке - забота вызывающего
+    :param keep_local: - сохранять ли датасет на локальную ФС. Без неё датасет идёт с сервера сразу на S3
+                         одним потоком и после обрыва качается заново
+    :param status: - буфер состояния датасетов: размер, прогресс, путь и статус загрузки (None - в БД не пишем)
+    :return: путь к файлу датасета (адрес объекта на S3, если keep_local=False)
     """
     logger.info(f'Processing {product_title}')
     start = int(round(time.time()))
+    if not keep_local and sink is None:
+        raise ValueError('Без локальной копии датасет некуда сохранять')
+    if index is not None:
+        # Датасет уже лежит на диске - даже не открываем соединение
+        cached = index.get(product_guid)
+        if cached is not None:
+            logger.info(f'[{product_guid}] Датасет уже скачан: {cached["path"]}')
+            if sink is None:
+                _set_downloaded(status, product_guid, cached['path'])
+                return cached['path']
+            if object_matches(sink.client, sink.bucket, sink.key, cached['path'], cached['size'], sink.part_size,
+                              cached['checksum']):
+                # Датасет уже загружен на S3 прошлым запуском - многогигабайтный архив повторно не отправляем
+                sink.abort()
+                logger.info(f'[{product_guid}] Датасет уже есть на {sink.uri}')
+                _set_downloaded(status, product_guid, cached['path'] if keep_local else sink.uri)
+                return cached['path'] if keep_local else sink.uri
+            with open(cached['path'], 'rb') as f:
+                replay_part(f.fileno(), 0, cached['size'], sink)
+            upload = sink.complete()
+            logger.info(f'[{product_guid}] Датасет загружен на {upload["uri"]}')
+            _set_downloaded(status, product_guid, cached['path'] if keep_local else upload['uri'])
+            return cached['path'] if keep_local else upload['uri']
     # Собираем название файла на локальной ФС
 
-    download_url = '/'.join([_PRODUCT_URL, '$value'])
-    session = requests.Session()
-    creds = cred.split(':')
-    session.auth = (creds[0], creds[1])
+    download_url = '/'.join([PRODUCT_URL, '$value'])
+    # Сессия живёт всё время жизни процесса, соединения с сервером переиспользуются между задачами
+    session = get_session(cred)
     # Проверяем, можно ли скачать датасет
-    resp = session.get("https://ya.ru")
-    resp.close()
-    if not _is_online(session, product_guid, _PRODUCT_URL, logger):
+    if not is_online(session, product_guid, logger):
         logger.info(f'[{product_guid}] File is not online yet')
-        with session.get(download_url.format(product_guid)) as resp:
-            if resp.status_code == 202:
-                # Если датасет не в онлайне, то триггерим задачу на скачку
-                logger.info(
-                    f'[{datetime.datetime.now().time()}] Триггернули задачу {product_guid} на скачивание файла ')
-            elif resp.status_code == 200:
-                logger.info(
-                    f'[{datetime.datetime.now().time()}] Ждали 202, а получили 200. Нипанятна.')
-            else:
-                logger.info(
-                    f'[{datetime.datetime.now().time()}] Получили {resp.status_code}, {resp.text}')
-            raise Exception(f'ошибка получения данных по файлу {product_guid}')
+        raise ProductOfflineError(product_guid, trigger_restore(session, product_guid, logger))
     # lp.print(f'Пытаемся выкачать с сайта, вроде должен быть онлайн')
     # logger.error('exception raised, it would be retry after 5 seconds')
     # raise worker.retry(exc='Error!!!!!!!!', countdown=10)
-    dataset_filename = None
-    # Качаем датасет
-    with session.get(download_url.format(product_guid), allow_redirects=True, stream=True) as resp:
-        size = 0
-        if resp.status_code != 200:
-            # lp.print(f'Ошибка: {resp.text} ({resp.status_code})')
-            raise Exception(f'ошибка получения файла {product_guid}')
-        if "Content-Disposition" in resp.headers.keys():
-            # Вытаскиваем название файла
-            dataset_filename = get_filename_from_content_disposition(
-                resp.headers.get('content-disposition'))
-            # Processing dataset title for directories S2A_MSIL2A_20210913T083601_N0301_R064_T37UCS_20210913T113119
-            dir_path = ''
-            title_parts = product_title.split('_')
-            if title_parts[1] == 'MSIL2A':
-                dir_path += 'L2/'
-                dir_path += os.path.join(title_parts[2][0:4],
-                                         title_parts[2][4:6], title_parts[2][6:8])
-            dataset_path = os.path.join(tmp_dir, dir_path)
-            os.makedirs(dataset_path, exist_ok=True)
-            dataset_filename = '/'.join([dataset_path, dataset_filename])
-            # lp.print(f'Нашли название файла в хедерах: {dataset_filename}')
-        if "content-range" in resp.headers.keys():
-            # Вытаскиваем размер файла
-            size = float(resp.headers.get('content-range').split('/')[1])
-            logger.info(
-                f'[{datetime.datetime.now().time()}][{datetime.datetime.now().time()}] Нашли размер файла: {int(size)}')
-            # set_dataset_size(product.guid, int(size))
+    # MD5 из метаданных сверяется с тем, что посчитано по ходу загрузки (None - сервер его не отдаёт)
+    checksum = product_checksum(session, product_guid, logger) if config.DOWNLOAD_VERIFY_CHECKSUM else None
+    if not keep_local:
+        uri = _download_to_sink(worker, session, download_url.format(product_guid), product_guid, sink, logger,
+                                start, status, checksum)
+        _set_downloaded(status, product_guid, uri)
+        return uri
+    # Собираем каталог датасета по его названию, например
+    # S2A_MSIL2A_20210913T083601_N0301_R064_T37UCS_20210913T113119 -> L2/2021/09/13
+    dataset_path = os.path.join(tmp_dir, _get_dataset_dir(product_title))
+    os.makedirs(dataset_path, exist_ok=True)
+    # Качаем во временный .part файл, рядом с ним храним состояние загрузки, чтобы после падения воркера
+    # (или обрыва соединения) продолжить с того же места, а не с нуля
+    part_filename = os.path.join(dataset_path, f'{product_guid}.part')
+    state_filename = part_filename + '.json'
+    state = load_part_state(part_filename, state_filename)
+    progress = DownloadProgress(worker, product_guid, status=status)
+    try:
+        dataset_filename, md5 = _download(session, download_url.format(product_guid), part_filename, state_filename,
+                                          state, segments, logger, progress, sink, checksum)
+        # Части загружались на S3 вместе со скачиванием - осталось отправить последнюю и собрать объект
+        upload = sink.complete() if sink is not None else None
+    except Exception:
+        DOWNLOADS.labels(WORKER, 'error').inc()
+        if status is not None:
+            status.update(product_guid, status=STATUS_ERROR)
+        raise
+    if not dataset_filename:
+        dataset_filename = f'{product_title}.zip'
+    dataset_filename = '/'.join([dataset_path, dataset_filename])
 
-        with open(dataset_filename, 'wb') as f:
-            current_size = 0.0
-
-            for chunk in resp.iter_content(chunk_size=8192):
-                f.write(chunk)
-                chunk_size = len(chunk)
-                if int((current_size + chunk_size) / (10 * 1024 * 1024)) > int(
-                        current_size / (10 * 1024 * 1024)):
-                    if size == 0:
-                        logger.info(
-                            f'[{dataset_filename}] Size: {current_size}')
-                    else:
-                        logger.info(
-                            f'[{dataset_filename}] {current_size / size * 100.0:.2f} %')
-                current_size += chunk_size
+    os.replace(part_filename, dataset_filename)
+    os.remove(state_filename)
+    if index is not None:
+        index.put(product_guid, dataset_filename, checksum=md5, title=product_title)
+    if upload is not None:
+        logger.info(f'[{product_guid}] Датасет загружен на {upload["uri"]}')
+    DOWNLOADS.labels(WORKER, 'ok').inc()
+    DOWNLOAD_SPEED.observe(progress.transferred / max(time.monotonic() - progress.started, 1e-3))
 
     dl_end_ = int(round(time.time()))
     logger.info(
@@ -102,33 +148,416 @@ def download_dataset(worker, product_guid: str, product_title: str, cred: str, t
     #     product = product._replace(producttype='S2MSI2A')
     #     print(2)
 
-    # print('Upload to S3')
-    # Загружаем файл на S3
-    # dataset_path = upload_file_to_s3(file_name=dataset_filename, bucket=config.S3_GEOSERVER_BUCKET,
-    #                                  upload_folder='ZIP')
-    # Регистрируем датасет в БД
-    # logger.info('Регистрируем датасет в БД')
-    # set_dataset_uploaded(product.guid, dataset_path)
-    logger.info('Закрываем сессию')
-    session.close()
+    # Регистрируем датасет в БД (пишется пачкой вместе с другими загрузками)
+    _set_downloaded(status, product_guid, dataset_filename)
 
     # return dataset_path
-    return
+    return dataset_filename
+
+
+def _set_downloaded(status: Optional[StatusWriter], product_guid: str, path: str):
+    if status is not None:
+        status.update(product_guid, path=path, progress=100.0, status=STATUS_DOWNLOADED)
+
+
+def download_bands(worker, product_guid: str, product_title: str, cred: str, tmp_dir: str, logger,
+                   bands: List[str], resolution: Optional[str] = None, segments: int = 1,
+                   index: Optional[ProductIndex] = None, status: Optional[StatusWriter] = None) -> str:
+    """ Функция выкачивает из SAFE-архива на сервере только нужные каналы.
+    Через Range читается оглавление архива, затем скачиваются и распаковываются только подходящие файлы.
+    Результат - "разреженный" каталог <название>.SAFE, в котором лежат только эти файлы (и метаданные продукта).
+    Файлы, которые уже лежат в каталоге, повторно не качаются.
+
+    :param bands: - каналы (B04, B08, ...)
+    :param resolution: - разрешение для L2A (10m, 20m, 60m), None - любое
+    :param segments: - количество файлов, которые качаются одновременно
+    :param index: - индекс уже скачанных датасетов: если архив целиком уже на диске, каналы берутся из него
+    :param status: - буфер состояния датасетов, пишется, только если архив пришлось качать целиком
+                     (по отдельным каналам датасет не считается скачанным)
+    :return: путь к каталогу <название>.SAFE
+    """
+    logger.info(f'Processing {product_title}, bands: {", ".join(bands)}')
+    start = int(round(time.time()))
+    patterns = band_patterns(bands, resolution)
+    dataset_path = os.path.join(tmp_dir, _get_dataset_dir(product_title))
+    safe_dir = os.path.join(dataset_path, f'{product_title}.SAFE')
+
+    cached = index.get(product_guid) if index is not None else None
+    if cached is not None:
+        logger.info(f'[{product_guid}] Архив уже скачан, распаковываем каналы из {cached["path"]}')
+        _extract_local(cached['path'], patterns, dataset_path)
+        return safe_dir
+
+    download_url = '/'.join([PRODUCT_URL, '$value']).format(product_guid)
+    session = get_session(cred)
+    if not is_online(session, product_guid, logger):
+        logger.info(f'[{product_guid}] File is not online yet')
+        raise ProductOfflineError(product_guid, trigger_restore(session, product_guid, logger))
+    probe = probe_ranges(session, download_url)
+    if probe is None:
+        # Сервер не умеет отдавать куски - качаем архив целиком и распаковываем каналы из него
+        logger.info(f'[{product_guid}] Сервер не поддерживает Range, качаем архив целиком')
+        dataset_filename = download_dataset(worker, product_guid, product_title, cred, tmp_dir, logger,
+                                            index=index, status=status)
+        _extract_local(dataset_filename, patterns, dataset_path)
+        return safe_dir
+
+    members = select_members(read_central_directory(session, download_url, probe[1]), patterns)
+    if not members:
+        raise ValueError(f'[{product_guid}] В архиве нет файлов для каналов {", ".join(bands)}')
+    members = [member for member in members if not _is_extracted(dataset_path, member.name, member.size)]
+    logger.info(f'[{product_guid}] Качаем {len(members)} файлов, '
+                f'{sum(member.compressed_size for member in members)} из {probe[1]} байт архива')
+
+    # Распаковываем во временный каталог и переносим файлы на место, только когда все скачаны
+    part_dir = os.path.join(dataset_path, f'.{product_guid}.bands')
+    progress = DownloadProgress(worker, product_guid)
+    progress.start(0, sum(member.compressed_size for member in members))
+    try:
+        extract_members(session, download_url, members, part_dir, progress, threads=segments)
+    except Exception:
+        DOWNLOADS.labels(WORKER, 'error').inc()
+        raise
+    finally:
+        progress.finish()
+    for member in members:
+        target = member_path(dataset_path, member.name)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(member_path(part_dir, member.name), target)
+    shutil.rmtree(part_dir, ignore_errors=True)
+    DOWNLOADS.labels(WORKER, 'ok').inc()
+    DOWNLOAD_SPEED.observe(progress.transferred / max(time.monotonic() - progress.started, 1e-3))
 
+    logger.info(f'[{safe_dir}] Загрузка каналов завершена за: {int(round(time.time())) - start} s')
+    return safe_dir
 
-def _is_online(session: requests.Session, id: str, product_url: str, logger) -> bool:
+
+def _is_extracted(target_dir: str, name: str, size: int) -> bool:
+    try:
+        return os.path.getsize(member_path(target_dir, name)) == size
+    except OSError:
+        return False
+
+
+def _extract_local(zip_filename: str, patterns: List[str], target_dir: str):
+    """ Функция распаковывает из скачанного архива файлы, подходящие под шаблоны
+
+    :param zip_filename: путь к архиву
+    :param patterns: шаблоны путей внутри архива
+    :param target_dir: каталог распаковки
+    """
+    with zipfile.ZipFile(zip_filename) as archive:
+        for info in archive.infolist():
+            if info.is_dir() or not any(fnmatch.fnmatchcase(info.filename, p) for p in patterns):
+                continue
+            if _is_extracted(target_dir, info.filename, info.file_size):
+                continue
+            target = member_path(target_dir, info.filename)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with archive.open(info) as src, open(target + '.tmp', 'wb') as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+            os.replace(target + '.tmp', target)
+
+
+def is_online(session: requests.Session, id: str, logger) -> bool:
     """ Функция запрашивает состояние датасета на сервере copernicus.eu
 
+    :param session: сессия requests
     :param id: идентификатор датасета
-    :param cred: авторизационные данные для работы с сервером copernicus.eu
     :return:
     """
     logger.info(f'ID: {id}')
 
-    check_url = '/'.join([product_url, 'Online/$value'])
+    check_url = '/'.join([PRODUCT_URL, 'Online/$value'])
     logger.info(f'Проверка файла {check_url.format(id)} на онлайн')
 
-    with session.get(check_url.format(id),
-                     allow_redirects=True,
-                     stream=True) as resp:
+    with ONLINE_CHECK_SECONDS.time(), session.get(check_url.format(id),
+                                                  allow_redirects=True,
+                                                  stream=True) as resp:
         return resp.text == 'true'
+
+
+def product_checksum(session: requests.Session, id: str, logger) -> Optional[str]:
+    """ Функция запрашивает MD5 датасета из его метаданных на сервере copernicus.eu
+
+    :param session: сессия requests
+    :param id: идентификатор датасета
+    :return: MD5 в нижнем регистре или None, если сервер его не отдаёт
+    """
+    try:
+        with session.get(PRODUCT_URL.format(id), params={'$format': 'json'}, allow_redirects=True) as resp:
+            if resp.status_code != 200:
+                logger.warning(f'[{id}] Метаданные датасета недоступны ({resp.status_code}), MD5 не проверяем')
+                return None
+            meta = resp.json()
+    except (requests.RequestException, ValueError) as e:
+        logger.warning(f'[{id}] Не удалось получить метаданные датасета, MD5 не проверяем: {e}')
+        return None
+    # DHuS: {"d": {"Checksum": {"Algorithm": "MD5", "Value": ...}}}, новый OData: {"Checksum": [{...}, ...]}
+    checksums = meta.get('d', meta).get('Checksum') or []
+    if isinstance(checksums, dict):
+        checksums = [checksums]
+    for checksum in checksums:
+        if str(checksum.get('Algorithm', '')).upper() == 'MD5' and checksum.get('Value'):
+            return checksum['Value'].lower()
+    logger.warning(f'[{id}] В метаданных датасета нет MD5, проверять не с чем')
+    return None
+
+
+def trigger_restore(session: requests.Session, id: str, logger) -> bool:
+    """ Функция запрашивает восстановление датасета из долгосрочного архива
+
+    :param session: сессия requests
+    :param id: идентификатор датасета
+    :return: True, если сервер принял запрос (или датасет уже в онлайне)
+    """
+    download_url = '/'.join([PRODUCT_URL, '$value'])
+    with session.get(download_url.format(id), stream=True) as resp:
+        if resp.status_code == 202:
+            # Если датасет не в онлайне, то триггерим задачу на скачку
+            logger.info(
+                f'[{datetime.datetime.now().time()}] Триггернули задачу {id} на скачивание файла ')
+        elif resp.status_code == 200:
+            logger.info(
+                f'[{datetime.datetime.now().time()}] Ждали 202, а получили 200. Нипанятна.')
+        else:
+            logger.info(
+                f'[{datetime.datetime.now().time()}] Получили {resp.status_code}, {resp.text}')
+        return resp.status_code in (200, 202)
+
+
+def _get_dataset_dir(product_title: str) -> str:
+    """ Функция возвращает относительный каталог датасета на локальной ФС
+
+    :param product_title: название датасета (S2A_MSIL2A_20210913T083601_N0301_R064_T37UCS_20210913T113119)
+    :return: относительный путь (L2/2021/09/13)
+    """
+    dir_path = ''
+    title_parts = product_title.split('_')
+    if len(title_parts) > 2 and title_parts[1] == 'MSIL2A':
+        dir_path += 'L2/'
+        dir_path += os.path.join(title_parts[2][0:4],
+                                 title_parts[2][4:6], title_parts[2][6:8])
+    return dir_path
+
+
+def _download(session: requests.Session,
+              url: str,
+              part_filename: str,
+              state_filename: str,
+              state: dict,
+              segments: int,
+              logger,
+              progress: DownloadProgress,
+              sink: Optional[MultipartUpload] = None,
+              checksum: Optional[str] = None) -> Tuple[Optional[str], Optional[str]]:
+    """ Функция выкачивает файл в .part: в несколько соединений, если сервер это умеет, иначе одним потоком
+
+    :param checksum: MD5 файла из метаданных (None - не проверять)
+    :return: (название файла из Content-Disposition, проверенный MD5 файла или None)
+    """
+    if segments > 1:
+        # Если сервер умеет отдавать файл кусками - качаем в несколько соединений
+        probe = probe_ranges(session, url)
+        if probe is not None:
+            dataset_filename, size, etag = probe
+            if state['size'] != size or (state['etag'] and etag and state['etag'] != etag):
+                remove_part(part_filename, state_filename)
+                state = {'offset': 0, 'size': size, 'etag': etag}
+            logger.info(f'[{part_filename}] Качаем {size} байт в {segments} потоков')
+            hasher = FileSink(None, 0, size, STREAM_CHUNK_SIZE) if checksum is not None else None
+            download_segmented(session, url, part_filename, state_filename, state, segments, logger, progress,
+                               sink, hasher)
+            if hasher is None:
+                return dataset_filename, None
+            _verify(hasher, part_filename, state_filename, checksum)
+            return dataset_filename, hasher.hexdigest()
+        logger.info(f'[{part_filename}] Сервер не поддерживает Range, качаем одним потоком')
+    return _download_stream(session, url, part_filename, state_filename, state, logger, progress, sink, checksum)
+
+
+def _download_to_sink(worker, session: requests.Session, url: str, product_guid: str, sink: MultipartUpload,
+                      logger, start: int, status: Optional[StatusWriter] = None,
+                      checksum: Optional[str] = None) -> str:
+    """ Функция выкачивает датасет одним потоком сразу на S3, минуя локальную ФС
+
+    :param checksum: MD5 файла из метаданных (None - не проверять)
+    :return: адрес объекта на S3
+    """
+    progress = DownloadProgress(worker, product_guid, status=status)
+    try:
+        progress.request_started()
+        with session.get(url, allow_redirects=True, stream=True) as resp:
+            if resp.status_code != 200:
+                raise RuntimeError(f'ошибка получения файла {url}: {resp.status_code}')
+            size = int(resp.headers.get('Content-Length') or 0)
+            progress.start(0, size)
+            writer = FileSink(None, 0, size, STREAM_CHUNK_SIZE, verify=checksum is not None)
+            chunk = writer.read(resp.raw)
+            while chunk:
+                writer.write(chunk)
+                sink.write(chunk)
+                progress.advance(len(chunk))
+                chunk = writer.read(resp.raw)
+        progress.finish()
+        if size and sink.size != size:
+            raise RuntimeError(f'[{product_guid}] Загрузка прервана на {sink.size} из {size} байт')
+        # Объект на S3 ещё не собран - при несовпадении вызывающий прерывает upload
+        writer.verify(product_guid, checksum)
+        upload = sink.complete()
+    except Exception:
+        DOWNLOADS.labels(WORKER, 'error').inc()
+        if status is not None:
+            status.update(product_guid, status=STATUS_ERROR)
+        raise
+    DOWNLOADS.labels(WORKER, 'ok').inc()
+    DOWNLOAD_SPEED.observe(progress.transferred / max(time.monotonic() - progress.started, 1e-3))
+    logger.info(f'[{upload["uri"]}] Загрузка завершена за: {int(round(time.time())) - start} s')
+    return upload['uri']
+
+
+def _download_stream(session: requests.Session,
+                     url: str,
+                     part_filename: str,
+                     state_filename: str,
+                     state: dict,
+                     logger,
+                     progress: Optional[DownloadProgress] = None,
+                     sink: Optional[MultipartUpload] = None,
+                     checksum: Optional[str] = None) -> Tuple[Optional[str], Optional[str]]:
+    """ Функция выкачивает файл одним потоком, продолжая загрузку с места обрыва, если это возможно
+
+    :param session: сессия requests
+    :param url: адрес файла
+    :param part_filename: путь к .part файлу
+    :param state_filename: путь к файлу состояния
+    :param state: состояние загрузки {offset, size, etag}
+    :param logger: логгер
+    :param progress: прогресс загрузки
+    :param sink: multipart upload на S3, в который параллельно уходят скачанные куски
+    :param checksum: MD5 файла из метаданных (None - не проверять)
+    :return: (название файла из Content-Disposition, проверенный MD5 файла или None)
+    """
+    if state['size'] and state['offset'] >= state['size']:
+        # Упали между последним сохранением состояния и переименованием .part - файл уже скачан целиком,
+        # а запрос с Range за концом файла сервер отклонит с 416
+        logger.info(f'[{part_filename}] Файл уже скачан целиком, {state["size"]} байт')
+        return _complete_part(part_filename, state_filename, state, progress, sink, checksum)
+    headers = {}
+    if state['offset'] > 0:
+        headers['Range'] = f"bytes={state['offset']}-"
+        if state['etag']:
+            headers['If-Range'] = state['etag']
+        logger.info(f'[{part_filename}] Продолжаем загрузку с {state["offset"]} байт')
+    dataset_filename = None
+    if progress is not None:
+        progress.request_started()
+    with session.get(url, allow_redirects=True, stream=True, headers=headers) as resp:
+        size = 0
+        if resp.status_code == 416:
+            # Сохранённое смещение за концом файла на сервере (файл поменялся) - начинаем сначала
+            remove_part(part_filename, state_filename)
+            raise RuntimeError(f'[{part_filename}] Сервер отклонил диапазон с {state["offset"]} байт: '
+                               f'{resp.headers.get("content-range")}')
+        if resp.status_code not in (200, 206):
+            # lp.print(f'Ошибка: {resp.text} ({resp.status_code})')
+            raise Exception(f'ошибка получения файла {url}')
+        if "Content-Disposition" in resp.headers.keys():
+            # Вытаскиваем название файла
+            dataset_filename = get_filename_from_content_disposition(
+                resp.headers.get('content-disposition'))
+        content_range = parse_content_range(resp.headers.get('content-range'))
+        if content_range is not None and content_range[2] is not None:
+            # Вытаскиваем размер файла
+            size = float(content_range[2])
+            logger.info(
+                f'[{datetime.datetime.now().time()}][{datetime.datetime.now().time()}] Нашли размер файла: {int(size)}')
+        elif resp.status_code == 200 and resp.headers.get('Content-Length'):
+            size = float(resp.headers.get('Content-Length'))
+
+        etag = resp.headers.get('ETag')
+        offset = state['offset']
+        if resp.status_code == 206:
+            # Сервер вернул кусок - проверяем, что это продолжение именно нашего файла
+            if content_range is None or content_range[0] != offset or \
+                    (state['size'] and size and int(size) != state['size']):
+                remove_part(part_filename, state_filename)
+                raise RuntimeError(f'[{part_filename}] Сервер вернул неожиданный диапазон: '
+                                   f'{resp.headers.get("content-range")}')
+        elif offset > 0:
+            # Сервер не поддерживает Range (или файл поменялся) - начинаем сначала
+            logger.info(f'[{part_filename}] Сервер вернул файл целиком, начинаем загрузку заново')
+            offset = 0
+        state = {'offset': offset, 'size': int(size), 'etag': etag or state['etag'], 'filename': dataset_filename}
+        save_part_state(state_filename, state)
+        if progress is not None:
+            progress.start(offset, int(size))
+
+        with open(part_filename, 'r+b' if offset > 0 else 'wb') as f:
+            writer = FileSink(f, offset, int(size), STREAM_CHUNK_SIZE, verify=checksum is not None)
+            # Уже скачанное до обрыва лежит только на диске - досчитываем по нему MD5 и отправляем его на S3 заново
+            writer.resume(sink)
+            f.seek(offset)
+            f.truncate()
+            writer.preallocate()
+            current_size = float(offset)
+
+            chunk = writer.read(resp.raw)
+            while chunk:
+                writer.write(chunk)
+                if sink is not None:
+                    sink.write(chunk)
+                chunk_size = len(chunk)
+                if progress is not None:
+                    progress.advance(chunk_size)
+                if int((current_size + chunk_size) / (10 * 1024 * 1024)) > int(
+                        current_size / (10 * 1024 * 1024)):
+                    if size == 0:
+                        logger.info(
+                            f'[{part_filename}] Size: {current_size}')
+                    else:
+                        logger.info(
+                            f'[{part_filename}] {current_size / size * 100.0:.2f} %')
+                    # Сохраняем только то, что уже гарантированно лежит на диске
+                    f.flush()
+                    os.fsync(f.fileno())
+                    state['offset'] = int(current_size + chunk_size)
+                    save_part_state(state_filename, state)
+                current_size += chunk_size
+                chunk = writer.read(resp.raw)
+
+        if progress is not None:
+            progress.finish()
+        if size and int(current_size) != int(size):
+            # Соединение оборвалось - сохраняем состояние и даём задаче перезапуститься
+            state['offset'] = int(current_size)
+            save_part_state(state_filename, state)
+            raise RuntimeError(f'[{part_filename}] Загрузка прервана на {int(current_size)} из {int(size)} байт')
+        _verify(writer, part_filename, state_filename, checksum)
+
+    return dataset_filename, writer.hexdigest()
+
+
+def _complete_part(part_filename: str, state_filename: str, state: dict, progress: Optional[DownloadProgress],
+                   sink: Optional[MultipartUpload], checksum: Optional[str]) -> Tuple[Optional[str], Optional[str]]:
+    """ Функция завершает загрузку, .part файл которой уже скачан целиком: MD5 и отправка на S3 - по диску
+
+    :return: (название файла из сохранённого состояния, проверенный MD5 файла или None)
+    """
+    with open(part_filename, 'r+b') as f:
+        writer = FileSink(f, state['size'], state['size'], STREAM_CHUNK_SIZE, verify=checksum is not None)
+        writer.resume(sink)
+    if progress is not None:
+        progress.start(state['size'], state['size'])
+        progress.finish()
+    _verify(writer, part_filename, state_filename, checksum)
+    return state.get('filename'), writer.hexdigest()
+
+
+def _verify(writer: FileSink, part_filename: str, state_filename: str, checksum: Optional[str]):
+    try:
+        writer.verify(part_filename, checksum)
+    except ChecksumMismatchError:
+        # Докачивать испорченный файл бессмысленно - повтор задачи качает его с нуля
+        remove_part(part_filename, state_filename)
+        raise
@@ -0,0 +1,107 @@
+from typing import Iterator, List, Optional, Tuple
+
+import redis
+
+from db_service import DBConnection
+from sentinel.pipeline import build_chain
+
+ENQUEUED_KEY = 'sentinel:enqueued:{}'
+
+# Датасет считается нескачанным, пока для него не записан путь к файлу
+PENDING_FIRST_PAGE_QUERY = """
+    SELECT guid, title, size
+    FROM datasets
+    WHERE path IS NULL
+    ORDER BY guid
+    LIMIT %(limit)s
+"""
+PENDING_NEXT_PAGE_QUERY = """
+    SELECT guid, title, size
+    FROM datasets
+    WHERE path IS NULL AND guid > %(after)s
+    ORDER BY guid
+    LIMIT %(limit)s
+"""
+
+
+def iter_pending_pages(db: DBConnection, page_size: int) -> Iterator[List[dict]]:
+    """ Функция постранично отдаёт нескачанные датасеты.
+    Используется keyset-пагинация по guid: каждая страница - короткий индексный запрос, без OFFSET.
+
+    :param db: подключение к БД
+    :param page_size: размер страницы
+    :return: страницы [{guid, title, size}, ...]
+    """
+    page = db.fetch_all(PENDING_FIRST_PAGE_QUERY, as_dict=True, params={'limit': page_size})
+    while page:
+        yield page
+        if len(page) < page_size:
+            return
+        page = db.fetch_all(PENDING_NEXT_PAGE_QUERY, as_dict=True,
+                            params={'after': page[-1]['guid'], 'limit': page_size})
+
+
+def enqueue_datasets(app, r: redis.Redis, datasets: List[dict], ttl: int, producer=None,
+                     follow_up: bool = False) -> Tuple[int, int]:
+    """ Функция ставит датасеты в очередь downloader, пропуская те, что уже поставлены (метка в redis с TTL)
+
+    :param app: приложение celery
+    :param r: клиент redis
+    :param datasets: [{guid, title, size}, ...]
+    :param ttl: время жизни метки "задача уже в очереди", с
+    :param producer: producer celery, через который публиковать задачи (None - свой из пула)
+    :param follow_up: ставить цепочку скачивание -> индексы -> резка -> публикация, а не только скачивание
+    :return: (поставлено, пропущено)
+    """
+    with r.pipeline(transaction=False) as pipe:
+        for dataset in datasets:
+            pipe.set(ENQUEUED_KEY.format(dataset['guid']), 1, nx=True, ex=ttl)
+        marks = pipe.execute()
+    fresh = [dataset for dataset, marked in zip(datasets, marks) if marked]
+    with app.producer_or_acquire(producer) as producer:
+        for i, dataset in enumerate(fresh):
+            try:
+                if follow_up:
+                    build_chain(app, str(dataset['guid']), dataset['title'],
+                                {'size': dataset['size']}).apply_async(producer=producer)
+                else:
+                    app.send_task(name='downloader:sentinel',
+                                  args=[str(dataset['guid']), dataset['title']],
+                                  kwargs={'size': dataset['size']},
+                                  producer=producer)
+            except Exception:
+                # Снимаем метки с неопубликованных датасетов, чтобы следующий запуск их подхватил
+                r.delete(*[ENQUEUED_KEY.format(d['guid']) for d in fresh[i:]])
+                raise
+    return len(fresh), len(datasets) - len(fresh)
+
+
+def enqueue_pending(db: DBConnection, app, r: redis.Redis, logger, page_size: int = 1000, ttl: int = 24 * 3600,
+                    limit: Optional[int] = None, follow_up: bool = False) -> int:
+    """ Функция ставит в очередь downloader все нескачанные датасеты.
+    Для каждого датасета в redis ставится метка с TTL (SET NX), так что повторный запуск не создаёт дублей задач,
+    пока метка жива. Задачи публикуются пачками через одно подключение к брокеру.
+
+    :param db: подключение к БД
+    :param app: приложение celery
+    :param r: клиент redis
+    :param logger: логгер
+    :param page_size: количество датасетов в одной пачке
+    :param ttl: время жизни метки "задача уже в очереди", с
+    :param limit: максимальное количество поставленных задач (None - без ограничения)
+    :param follow_up: ставить цепочку по датасету, а не только скачивание
+    :return: количество поставленных задач
+    """
+    enqueued = 0
+    skipped = 0
+    with app.producer_or_acquire() as producer:
+        for page in iter_pending_pages(db, page_size):
+            if limit is not None:
+                page = page[:limit - enqueued]
+            page_enqueued, page_skipped = enqueue_datasets(app, r, page, ttl, producer, follow_up)
+            enqueued += page_enqueued
+            skipped += page_skipped
+            logger.info(f'Поставлено в очередь {enqueued} датасетов, пропущено уже поставленных {skipped}')
+            if limit is not None and enqueued >= limit:
+                break
+    return enqueued
@@ -0,0 +1,140 @@
+"""
+Запись скачиваемого датасета в файл с проверкой контрольной суммы.
+
+MD5 считается по ходу записи из того же буфера, который уходит на диск, поэтому для проверки многогигабайтный файл
+второй раз не читается. Ответ сервера читается большими кусками в один переиспользуемый буфер (readinto), место под
+файл резервируется заранее (posix_fallocate): меньше вызовов Python на гигабайт и нет фрагментации файла на диске.
+"""
+import errno
+import hashlib
+import os
+from typing import Optional
+
+import requests
+from urllib3.exceptions import DecodeError, ProtocolError, ReadTimeoutError
+
+from sentinel.s3_upload import MultipartUpload
+
+
+class ChecksumMismatchError(RuntimeError):
+    """
+    MD5 скачанного файла не совпал с контрольной суммой из метаданных датасета.
+    Файл испорчен по дороге - задача скачивания повторяется (RuntimeError) и качает его заново.
+    """
+
+    def __init__(self, name: str, expected: str, actual: str):
+        super().__init__(f'[{name}] MD5 скачанного файла {actual} не совпадает с {expected} из метаданных датасета')
+        self.expected = expected
+        self.actual = actual
+
+
+class FileSink:
+    """
+    Приёмник потока ответа: файл на диске (или только подсчёт MD5, если файла нет) и переиспользуемый буфер чтения.
+    """
+
+    def __init__(self, f, offset: int, size: int, buffer_size: int, verify: bool = True):
+        """
+        :param f: файл, открытый на запись (None - только считать MD5, данные идут на S3)
+        :param offset: с какого смещения пишется файл (при докачке - сколько уже скачано)
+        :param size: полный размер файла (0 - неизвестен)
+        :param buffer_size: размер буфера чтения, байт
+        :param verify: считать ли MD5
+        """
+        self.f = f
+        self.pos = offset
+        self.size = size
+        self.buffer = bytearray(buffer_size)
+        self.__view = memoryview(self.buffer)
+        self.__md5 = hashlib.md5() if verify else None
+
+    def resume(self, upload: Optional[MultipartUpload] = None):
+        """ Функция учитывает уже скачанное до обрыва начало файла: досчитывает по нему MD5 и отправляет его на S3.
+        Читается только уже лежащий на диске кусок, и только если он кому-то нужен
+
+        :param upload: multipart upload, в который уходит файл (None - только MD5)
+        """
+        if self.pos == 0 or (self.__md5 is None and upload is None):
+            return
+        fd = self.f.fileno()
+        pos = 0
+        while pos < self.pos:
+            chunk = self.__read_at(fd, pos, self.pos)
+            if self.__md5 is not None:
+                self.__md5.update(chunk)
+            if upload is not None:
+                upload.write_at(pos, chunk)
+            pos += len(chunk)
+
+    def update_from(self, fd: int, end: int):
+        """ Функция досчитывает MD5 по уже записанному в файл куску [pos, end) - при загрузке в несколько
+        соединений MD5 идёт вслед за непрерывным началом файла, куски только что записаны и читаются из page cache
+
+        :param fd: дескриптор файла
+        :param end: до какого смещения файл записан без пропусков
+        """
+        while self.pos < end:
+            chunk = self.__read_at(fd, self.pos, end)
+            if self.__md5 is not None:
+                self.__md5.update(chunk)
+            self.pos += len(chunk)
+
+    def __read_at(self, fd: int, pos: int, end: int) -> memoryview:
+        n = os.preadv(fd, [self.__view[:min(len(self.buffer), end - pos)]], pos)
+        if not n:
+            raise RuntimeError(f'.part файл короче {end} байт')
+        return self.__view[:n]
+
+    def preallocate(self):
+        """ Функция резервирует на диске место под оставшуюся часть файла
+        """
+        if self.f is None or self.size <= self.pos or not hasattr(os, 'posix_fallocate'):
+            return
+        try:
+            os.posix_fallocate(self.f.fileno(), self.pos, self.size - self.pos)
+        except OSError as e:
+            # Места нет - нет смысла начинать загрузку; если ФС не умеет резервировать, пишем как есть
+            if e.errno == errno.ENOSPC:
+                raise
+
+    def read(self, raw) -> memoryview:
+        """ Функция читает очередной кусок ответа в буфер
+
+        :param raw: поток ответа (requests.Response.raw)
+        :return: прочитанный кусок (пустой - ответ закончился); действителен до следующего чтения
+        """
+        # Как и iter_content: Content-Encoding снимается, ошибки urllib3 приводятся к исключениям requests
+        raw.decode_content = True
+        try:
+            n = raw.readinto(self.__view)
+        except ProtocolError as e:
+            raise requests.exceptions.ChunkedEncodingError(e)
+        except DecodeError as e:
+            raise requests.exceptions.ContentDecodingError(e)
+        except ReadTimeoutError as e:
+            raise requests.exceptions.ConnectionError(e)
+        return self.__view[:n]
+
+    def write(self, chunk: memoryview):
+        """ Функция дописывает кусок в файл и в MD5
+        """
+        if self.f is not None:
+            self.f.write(chunk)
+        if self.__md5 is not None:
+            self.__md5.update(chunk)
+        self.pos += len(chunk)
+
+    def hexdigest(self) -> Optional[str]:
+        return self.__md5.hexdigest() if self.__md5 is not None else None
+
+    def verify(self, name: str, expected: Optional[str]):
+        """ Функция сверяет MD5 записанного с контрольной суммой из метаданных
+
+        :param name: что качали (для сообщения об ошибке)
+        :param expected: MD5 из метаданных (None - проверять не с чем)
+        """
+        if expected is None or self.__md5 is None:
+            return
+        actual = self.hexdigest()
+        if actual != expected.lower():
+            raise ChecksumMismatchError(name, expected.lower(), actual)
@@ -0,0 +1,33 @@
+"""
+Регистрация слоёв в GeoServer через REST API.
+"""
+import requests
+
+# Ошибки, после которых есть смысл повторить задачу: GeoServer перегружен или перезапускается
+RETRYABLE_STATUSES = (429, 502, 503, 504)
+
+
+def publish_geotiff(session: requests.Session, url: str, workspace: str, store: str, path: str, logger) -> bool:
+    """ Функция загружает GeoTIFF в GeoServer: создаётся хранилище и слой с именем store
+
+    :param session: сессия requests (с авторизацией GeoServer)
+    :param url: адрес GeoServer (http://geoserver:8080/geoserver)
+    :param workspace: рабочее пространство
+    :param store: имя хранилища и слоя
+    :param path: путь к GeoTIFF
+    :param logger: логгер
+    :return: True - слой опубликован, False - GeoServer отказал, повторять бесполезно
+    """
+    with open(path, 'rb') as f:
+        try:
+            resp = session.put(f'{url.rstrip("/")}/rest/workspaces/{workspace}/coveragestores/{store}/file.geotiff',
+                               params={'coverageName': store}, data=f, headers={'Content-Type': 'image/tiff'},
+                               timeout=300)
+        except requests.RequestException as e:
+            raise RuntimeError(f'{store}: GeoServer недоступен: {e}') from e
+    if resp.status_code in RETRYABLE_STATUSES or resp.status_code >= 500:
+        raise RuntimeError(f'{store}: GeoServer ответил {resp.status_code}: {resp.text[:200]}')
+    if resp.status_code not in (200, 201):
+        logger.warning(f'{store}: GeoServer отказал в публикации ({resp.status_code}): {resp.text[:200]}')
+        return False
+    return True
@@ -0,0 +1,138 @@
+import threading
+import time
+import uuid
+from typing import List, Optional, Tuple
+
+import redis
+
+SEMAPHORE_KEY = 'sentinel:limiter:connections:{}'
+BUCKET_KEY = 'sentinel:limiter:bucket:{}'
+
+# Семафор: ZSET держателей (member - lease:i, score - время протухания)
+# KEYS[1] - семафор, ARGV: now, expire_at, limit, permits, lease_id
+_ACQUIRE_SCRIPT = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+local used = redis.call('ZCARD', KEYS[1])
+local permits = tonumber(ARGV[4])
+if used + permits > tonumber(ARGV[3]) then
+    return 0
+end
+for i = 1, permits do
+    redis.call('ZADD', KEYS[1], ARGV[2], ARGV[5] .. ':' .. i)
+end
+return 1
+"""
+
+# Token bucket: HASH {tokens, ts}
+# KEYS[1] - bucket, ARGV: now, rate (токенов в секунду), burst
+# Возвращает 0, если токен взят, иначе сколько секунд ждать следующего токена (строкой)
+_TAKE_TOKEN_SCRIPT = """
+local now = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local burst = tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or burst
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 60)
+return tostring(wait)
+"""
+
+
+class AccountLease:
+    """
+    Захваченные соединения учётной записи copernicus.
+    Пока lease жив, фоновый поток продлевает его в redis, так что долгие загрузки не теряют разрешение,
+    а упавший воркер отпустит его сам через ttl.
+    """
+
+    def __init__(self, r: redis.Redis, cred: str, lease_id: str, permits: int, ttl: int):
+        self.r = r
+        self.cred = cred
+        self.account = cred.split(':')[0]
+        self.lease_id = lease_id
+        self.permits = permits
+        self.ttl = ttl
+        self.__stop = threading.Event()
+        self.__heartbeat = threading.Thread(target=self.__refresh, daemon=True)
+        self.__heartbeat.start()
+
+    @property
+    def members(self) -> List[str]:
+        return [f'{self.lease_id}:{i}' for i in range(1, self.permits + 1)]
+
+    def __refresh(self):
+        while not self.__stop.wait(self.ttl / 3):
+            try:
+                self.r.zadd(SEMAPHORE_KEY.format(self.account),
+                            {member: time.time() + self.ttl for member in self.members}, xx=True)
+            except redis.RedisError:
+                pass
+
+    def release(self):
+        self.__stop.set()
+        self.r.zrem(SEMAPHORE_KEY.format(self.account), *self.members)
+
+    def __enter__(self) -> 'AccountLease':
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+def account_load(r: redis.Redis, account: str) -> int:
+    """ Функция возвращает количество занятых соединений учётной записи
+    """
+    key = SEMAPHORE_KEY.format(account)
+    with r.pipeline() as pipe:
+        pipe.zremrangebyscore(key, '-inf', time.time())
+        pipe.zcard(key)
+        return pipe.execute()[1]
+
+
+def acquire_account(r: redis.Redis,
+                    creds: List[str],
+                    max_connections: int,
+                    segments: dict,
+                    default_segments: int,
+                    rate: float,
+                    burst: int,
+                    ttl: int = 600) -> Tuple[Optional[AccountLease], float]:
+    """ Функция выбирает наименее загруженную учётную запись и захватывает для неё соединения.
+    Лимит соединений общий для всех воркеров (семафор в redis), частота запуска загрузок ограничена token bucket.
+
+    :param r: клиент redis
+    :param creds: учётные записи вида user:password
+    :param max_connections: максимальное количество одновременных соединений на учётную запись
+    :param segments: сколько соединений нужно одной загрузке для каждой учётной записи {user: N}
+    :param default_segments: сколько соединений нужно одной загрузке для остальных учётных записей
+    :param rate: сколько загрузок в секунду можно начинать на одной учётной записи (0 - без ограничения)
+    :param burst: размер token bucket
+    :param ttl: время жизни захвата без продления, с
+    :return: (lease или None, через сколько секунд стоит попробовать снова)
+    """
+    accounts = sorted(creds, key=lambda cred: account_load(r, cred.split(':')[0]))
+    acquire = r.register_script(_ACQUIRE_SCRIPT)
+    take_token = r.register_script(_TAKE_TOKEN_SCRIPT)
+    retry_after = None
+    for cred in accounts:
+        account = cred.split(':')[0]
+        need = min(max(1, segments.get(account, default_segments)), max_connections)
+        lease_id = uuid.uuid4().hex
+        now = time.time()
+        if not acquire(keys=[SEMAPHORE_KEY.format(account)], args=[now, now + ttl, max_connections, need, lease_id]):
+            continue
+        wait = float(take_token(keys=[BUCKET_KEY.format(account)], args=[now, rate, burst])) if rate > 0 else 0
+        if wait > 0:
+            r.zrem(SEMAPHORE_KEY.format(account), *[f'{lease_id}:{i}' for i in range(1, need + 1)])
+            retry_after = wait if retry_after is None else min(retry_after, wait)
+            continue
+        return AccountLease(r, cred, lease_id, need, ttl), 0
+    return None, retry_after or 0
@@ -0,0 +1,64 @@
+import json
+import os
+
+
+def load_part_state(part_filename: str, state_filename: str) -> dict:
+    """ Функция читает состояние недокачанного файла
+
+    :param part_filename: путь к .part файлу
+    :param state_filename: путь к файлу состояния
+    :return: словарь {offset, size, etag[, segments]}
+    """
+    state = {'offset': 0, 'size': 0, 'etag': None}
+    if not os.path.exists(part_filename) or not os.path.exists(state_filename):
+        return state
+    try:
+        with open(state_filename) as f:
+            state.update(json.load(f))
+    except (OSError, ValueError):
+        return {'offset': 0, 'size': 0, 'etag': None}
+    if state.get('segments'):
+        # После многопоточной загрузки продолжить одним потоком можно только с конца непрерывного куска
+        state['offset'] = contiguous_offset(state['segments'])
+    # Доверяем только тем байтам, которые реально есть на диске
+    state['offset'] = min(int(state['offset']), os.path.getsize(part_filename))
+    return state
+
+
+def save_part_state(state_filename: str, state: dict):
+    """ Функция атомарно сохраняет состояние недокачанного файла
+
+    :param state_filename: путь к файлу состояния
+    :param state: словарь {offset, size, etag[, segments]}
+    """
+    tmp_filename = state_filename + '.tmp'
+    with open(tmp_filename, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp_filename, state_filename)
+
+
+def remove_part(part_filename: str, state_filename: str):
+    """ Функция удаляет недокачанный файл и его состояние
+
+    :param part_filename: путь к .part файлу
+    :param state_filename: путь к файлу состояния
+    """
+    for filename in (part_filename, state_filename):
+        if os.path.exists(filename):
+            os.remove(filename)
+
+
+def contiguous_offset(segments: list) -> int:
+    """ Функция возвращает размер скачанного без пропусков начала файла
+
+    :param segments: список сегментов [начало, конец (включительно), текущая позиция]
+    :return: смещение первого нескачанного байта
+    """
+    offset = 0
+    for start, end, pos in sorted(segments):
+        if start > offset:
+            break
+        offset = max(offset, pos)
+        if pos <= end:
+            break
+    return offset
@@ -0,0 +1,229 @@
+"""
+Цепочка скачивание -> индексы -> резка -> публикация.
+
+Задачи цепочки после скачивания идут в очередь хоста (host.<HOST_ID>), на котором уже лежат файлы датасета,
+если на этом хосте жив хотя бы один воркер, разбирающий эту очередь (пульс в redis). Иначе - в общую очередь, и воркер
+на другом хосте один раз забирает архив с S3 (остальные задачи этого хоста ждут его на блокировке).
+
+Локальные файлы датасета (архив, индексы, нарезка) удаляются, когда завершились все задачи цепочки:
+скачивание заводит счётчик ссылок по числу оставшихся задач, каждая задача по завершении снимает свою ссылку,
+а упавшая - ещё и ссылки задач, до которых цепочка уже не дойдёт.
+"""
+import os
+import shutil
+import threading
+import time
+from typing import List, Optional, Tuple
+
+import redis
+from celery import chain
+
+from tools.metrics import S3_FETCHES
+
+HOST_KEY = 'sentinel:host:{}'
+HOST_QUEUE_PREFIX = 'host.'
+REFS_KEY = 'sentinel:refs:{}'
+REFS_HOSTS_KEY = 'sentinel:refs:{}:hosts'
+FETCH_LOCK_KEY = 'sentinel:fetch:{}:{}'
+
+# Задачи после скачивания, в порядке цепочки. Все получают результат предыдущей задачи первым аргументом
+FOLLOW_UP_TASKS = ('processing:indices', 'cutter:fields', 'publisher:geoserver')
+
+# Снять ссылки и, если их не осталось, вернуть хосты с локальными файлами датасета (nil - ссылки ещё есть)
+_RELEASE_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return nil
+end
+if redis.call('DECRBY', KEYS[1], ARGV[1]) > 0 then
+    return nil
+end
+local hosts = redis.call('SMEMBERS', KEYS[2])
+redis.call('DEL', KEYS[1], KEYS[2])
+return hosts
+"""
+
+
+def build_chain(app, guid: str, title: str, download_kwargs: Optional[dict] = None):
+    """ Функция собирает цепочку задач по датасету
+
+    :param app: приложение celery
+    :param guid: идентификатор датасета
+    :param title: название датасета
+    :param download_kwargs: именованные аргументы задачи скачивания (size, bands, resolution)
+    :return: celery chain
+    """
+    follow_up = {'dataset_guid': guid, 'dataset_title': title, 'pipeline': True}
+    return chain(app.signature('downloader:sentinel', args=[guid, title], kwargs=download_kwargs or {}),
+                 *[app.signature(name, kwargs=follow_up) for name in FOLLOW_UP_TASKS])
+
+
+def host_queue(host: str) -> str:
+    return HOST_QUEUE_PREFIX + host
+
+
+class HostHeartbeat:
+    """
+    Пульс воркера хоста: пока жив хотя бы один воркер хоста, задачи цепочки направляются в очередь хоста.
+    Воркеры одного хоста - члены общего sorted set, оценка - время, до которого пульс действителен:
+    остановка одного воркера снимает только его пульс.
+    """
+
+    def __init__(self, r: redis.Redis, host: str, worker: str, ttl: int = 30):
+        """
+        :param r: клиент redis
+        :param host: идентификатор хоста
+        :param worker: имя воркера (уникально в пределах хоста)
+        :param ttl: время жизни пульса без продления, с
+        """
+        self.r = r
+        self.key = HOST_KEY.format(host)
+        self.worker = worker
+        self.ttl = ttl
+        self.__stop = threading.Event()
+        self.__thread = threading.Thread(target=self.__beat, daemon=True)
+
+    def start(self):
+        self.__touch()
+        self.__thread.start()
+
+    def __touch(self):
+        now = time.time()
+        with self.r.pipeline() as pipe:
+            pipe.zadd(self.key, {self.worker: now + self.ttl})
+            # Пульсы упавших без остановки воркеров
+            pipe.zremrangebyscore(self.key, '-inf', now)
+            pipe.expire(self.key, self.ttl)
+            pipe.execute()
+
+    def __beat(self):
+        while not self.__stop.wait(self.ttl / 3):
+            try:
+                self.__touch()
+            except redis.RedisError:
+                pass
+
+    def stop(self):
+        self.__stop.set()
+        # Снимаем пульс сразу: если воркер был последним на хосте, новые задачи не ждут в очереди остановленного хоста
+        try:
+            self.r.zrem(self.key, self.worker)
+        except redis.RedisError:
+            pass
+
+
+def is_host_alive(r: redis.Redis, host: str) -> bool:
+    return r.zcount(HOST_KEY.format(host), time.time(), '+inf') > 0
+
+
+def add_refs(r: redis.Redis, guid: str, count: int, host: Optional[str], ttl: int):
+    """ Функция добавляет ссылки на локальные файлы датасета
+
+    :param r: клиент redis
+    :param guid: идентификатор датасета
+    :param count: количество задач, которые будут пользоваться файлами
+    :param host: хост, на котором лежат файлы (None - локальных файлов нет)
+    :param ttl: время жизни счётчика, с (на случай потерянных задач)
+    """
+    with r.pipeline() as pipe:
+        pipe.incrby(REFS_KEY.format(guid), count)
+        pipe.expire(REFS_KEY.format(guid), ttl)
+        if host:
+            pipe.sadd(REFS_HOSTS_KEY.format(guid), host)
+            pipe.expire(REFS_HOSTS_KEY.format(guid), ttl)
+        pipe.execute()
+
+
+def touch_host(r: redis.Redis, guid: str, host: str, ttl: int):
+    """ Функция отмечает, что на хосте появились локальные файлы датасета
+    """
+    with r.pipeline() as pipe:
+        pipe.sadd(REFS_HOSTS_KEY.format(guid), host)
+        pipe.expire(REFS_HOSTS_KEY.format(guid), ttl)
+        pipe.execute()
+
+
+def release_refs(r: redis.Redis, guid: str, count: int = 1) -> Optional[List[str]]:
+    """ Функция снимает ссылки на локальные файлы датасета
+
+    :param r: клиент redis
+    :param guid: идентификатор датасета
+    :param count: количество снимаемых ссылок
+    :return: хосты, на которых нужно удалить файлы датасета, если ссылок не осталось, иначе None
+    """
+    hosts = r.register_script(_RELEASE_SCRIPT)(keys=[REFS_KEY.format(guid), REFS_HOSTS_KEY.format(guid)],
+                                               args=[count])
+    if hosts is None:
+        return None
+    return sorted(host.decode() if isinstance(host, bytes) else host for host in hosts)
+
+
+def parse_s3_uri(uri: str) -> Tuple[str, str]:
+    """ Функция разбирает адрес объекта s3://bucket/key -> (bucket, key)
+    """
+    bucket, _, key = uri[len('s3://'):].partition('/')
+    return bucket, key
+
+
+def fetch_product(r: redis.Redis, client, guid: str, title: str, bucket: str, key: str, target: str,
+                  index, host: str, logger, lock_ttl: int = 900, wait: int = 600) -> str:
+    """ Функция скачивает архив датасета с S3 на локальную ФС - один раз на хост: остальные задачи хоста
+    ждут на блокировке и получают уже скачанный файл из индекса
+
+    :param r: клиент redis
+    :param client: клиент boto3 S3
+    :param guid: идентификатор датасета
+    :param title: название датасета
+    :param bucket: бакет
+    :param key: ключ объекта
+    :param target: путь к файлу на локальной ФС
+    :param index: индекс скачанных датасетов (ProductIndex)
+    :param host: идентификатор хоста
+    :param logger: логгер
+    :param lock_ttl: время жизни блокировки, с
+    :param wait: сколько ждать блокировку, с
+    :return: путь к файлу
+    """
+    lock = r.lock(FETCH_LOCK_KEY.format(guid, host), timeout=lock_ttl, blocking_timeout=wait)
+    if not lock.acquire():
+        raise RuntimeError(f'[{guid}] Не дождались скачивания датасета с S3 другой задачей')
+    try:
+        cached = index.get(guid)
+        if cached is not None and os.path.exists(cached['path']):
+            return cached['path']
+        logger.info(f'[{guid}] Датасета нет на хосте {host}, забираем s3://{bucket}/{key}')
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        client.download_file(bucket, key, target + '.part')
+        os.replace(target + '.part', target)
+        S3_FETCHES.inc()
+        index.put(guid, target, title=title)
+        return target
+    finally:
+        try:
+            lock.release()
+        except redis.exceptions.LockError:
+            # Блокировка истекла - файл уже на месте, следующая задача увидит его в индексе
+            pass
+
+
+def remove_local(title: str, product_path: Optional[str], dirs: List[str]) -> List[str]:
+    """ Функция удаляет локальные файлы датасета по завершении цепочки
+
+    :param title: название датасета
+    :param product_path: архив или каталог датасета из индекса (None - датасета на хосте нет)
+    :param dirs: каталоги результатов задач (в каждом удаляется подкаталог <title>)
+    :return: удалённые пути
+    """
+    from sentinel.product_cache import META_SUFFIX
+    paths = [os.path.join(directory, title) for directory in dirs]
+    if product_path:
+        paths += [product_path, product_path + META_SUFFIX]
+    removed = []
+    for path in paths:
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        elif os.path.exists(path):
+            os.remove(path)
+        else:
+            continue
+        removed.append(path)
+    return removed
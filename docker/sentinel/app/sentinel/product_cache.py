@@ -0,0 +1,269 @@
+"""
+Индекс скачанных датасетов на локальной ФС и блокировка повторной загрузки одного датасета.
+
+Пересборка индекса по каталогу с данными (из /app): python3 -m sentinel.product_cache /data [--checksums]
+Архивы без .meta.json (скачанные до появления индекса) находятся по названию в таблице datasets.
+"""
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import uuid
+from typing import Callable, Dict, List, Optional
+
+import redis
+
+INDEX_FILENAME = '.products.sqlite'
+META_SUFFIX = '.meta.json'
+LEASE_KEY = 'sentinel:download:{}'
+ARCHIVE_SUFFIX = '.zip'
+RESOLVE_BATCH_SIZE = 1000
+
+DATASET_GUIDS_QUERY = """
+    SELECT guid::text AS guid, title FROM datasets WHERE title = ANY(%(titles)s)
+"""
+
+# Продлить lease, только если он всё ещё наш
+_REFRESH_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+# Отпустить lease, только если он всё ещё наш
+_RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class ProductIndex:
+    """
+    Индекс скачанных датасетов: GUID -> путь, размер, контрольная сумма, mtime.
+    Хранится в sqlite в корне каталога с данными, так что общий для всех процессов, работающих с этим каталогом.
+    Рядом с каждым файлом лежит .meta.json, по которым индекс можно пересобрать.
+    """
+
+    def __init__(self, data_dir: str):
+        self.data_dir = data_dir
+        self.__filename = os.path.join(data_dir, INDEX_FILENAME)
+        self.__local = threading.local()
+
+    def __connection(self) -> sqlite3.Connection:
+        connection = getattr(self.__local, 'connection', None)
+        if connection is None or getattr(self.__local, 'pid', None) != os.getpid():
+            os.makedirs(self.data_dir, exist_ok=True)
+            connection = sqlite3.connect(self.__filename, timeout=30, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS products ('
+                               'guid TEXT PRIMARY KEY, path TEXT NOT NULL, size INTEGER NOT NULL, '
+                               'checksum TEXT, mtime REAL NOT NULL)')
+            self.__local.connection = connection
+            self.__local.pid = os.getpid()
+        return connection
+
+    def get(self, guid: str) -> Optional[dict]:
+        """ Функция возвращает запись о скачанном датасете, если файл на месте и не менялся
+
+        :param guid: идентификатор датасета
+        :return: {guid, path, size, checksum, mtime} или None
+        """
+        row = self.__connection().execute('SELECT guid, path, size, checksum, mtime FROM products WHERE guid = ?',
+                                          (guid,)).fetchone()
+        if row is None:
+            return None
+        product = dict(zip(('guid', 'path', 'size', 'checksum', 'mtime'), row))
+        try:
+            stat = os.stat(product['path'])
+        except OSError:
+            stat = None
+        if stat is None or stat.st_size != product['size'] or stat.st_mtime != product['mtime']:
+            self.remove(guid)
+            return None
+        return product
+
+    def put(self, guid: str, path: str, checksum: Optional[str] = None, title: Optional[str] = None):
+        """ Функция регистрирует скачанный файл в индексе и пишет рядом с ним .meta.json
+
+        :param guid: идентификатор датасета
+        :param path: путь к файлу
+        :param checksum: контрольная сумма файла (если известна)
+        :param title: название датасета
+        """
+        stat = os.stat(path)
+        _write_meta(path, {'guid': guid, 'title': title, 'checksum': checksum})
+        self.__connection().execute('INSERT OR REPLACE INTO products (guid, path, size, checksum, mtime) '
+                                    'VALUES (?, ?, ?, ?, ?)', (guid, path, stat.st_size, checksum, stat.st_mtime))
+
+    def remove(self, guid: str):
+        self.__connection().execute('DELETE FROM products WHERE guid = ?', (guid,))
+
+    def rebuild(self, resolve: Optional[Callable[[List[str]], Dict[str, str]]] = None,
+                checksums: bool = False) -> int:
+        """ Функция пересобирает индекс по .meta.json в каталоге с данными.
+        Архивы без .meta.json регистрируются по названию датасета из имени файла, рядом с ними пишется .meta.json
+
+        :param resolve: функция, возвращающая по названиям датасетов их GUID (см. dataset_guids).
+                        Без неё находятся только архивы, названные по GUID
+        :param checksums: считать ли MD5 архивов без .meta.json (читается каждый такой архив целиком)
+        :return: количество найденных датасетов
+        """
+        rows = []
+        # название датасета -> архив без .meta.json
+        orphans = {}
+        for root, _, files in os.walk(self.data_dir):
+            names = set(files)
+            for name in files:
+                if name.endswith(ARCHIVE_SUFFIX) and name + META_SUFFIX not in names:
+                    orphans.setdefault(_archive_title(name), os.path.join(root, name))
+                if not name.endswith(META_SUFFIX):
+                    continue
+                path = os.path.join(root, name[:-len(META_SUFFIX)])
+                try:
+                    with open(os.path.join(root, name)) as f:
+                        meta = json.load(f)
+                    stat = os.stat(path)
+                except (OSError, ValueError):
+                    continue
+                rows.append((meta['guid'], path, stat.st_size, meta.get('checksum'), stat.st_mtime))
+        guids = resolve(list(orphans)) if resolve is not None and orphans else {}
+        for title, path in orphans.items():
+            guid = guids.get(title) or _as_guid(title)
+            if guid is None:
+                continue
+            try:
+                checksum = file_md5(path) if checksums else None
+                _write_meta(path, {'guid': guid, 'title': title, 'checksum': checksum})
+                stat = os.stat(path)
+            except OSError:
+                continue
+            rows.append((guid, path, stat.st_size, checksum, stat.st_mtime))
+        connection = self.__connection()
+        connection.execute('BEGIN')
+        connection.execute('DELETE FROM products')
+        connection.executemany('INSERT OR REPLACE INTO products (guid, path, size, checksum, mtime) '
+                               'VALUES (?, ?, ?, ?, ?)', rows)
+        connection.execute('COMMIT')
+        return len(rows)
+
+
+def _write_meta(path: str, meta: dict):
+    tmp_filename = path + META_SUFFIX + '.tmp'
+    with open(tmp_filename, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp_filename, path + META_SUFFIX)
+
+
+def _archive_title(name: str) -> str:
+    """ Функция возвращает название датасета по имени архива (<название>.zip или <название>.SAFE.zip)
+    """
+    title = name[:-len(ARCHIVE_SUFFIX)]
+    return title[:-len('.SAFE')] if title.endswith('.SAFE') else title
+
+
+def _as_guid(title: str) -> Optional[str]:
+    try:
+        return str(uuid.UUID(title))
+    except ValueError:
+        return None
+
+
+def file_md5(path: str, buffer_size: int = 1024 * 1024) -> str:
+    """ Функция считает MD5 файла
+    """
+    md5 = hashlib.md5()
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    with open(path, 'rb', buffering=0) as f:
+        for n in iter(lambda: f.readinto(buffer), 0):
+            md5.update(view[:n])
+    return md5.hexdigest()
+
+
+def dataset_guids(db, titles: List[str]) -> Dict[str, str]:
+    """ Функция находит GUID датасетов по названиям в таблице datasets
+
+    :param db: подключение к БД (DBConnection)
+    :param titles: названия датасетов
+    :return: название -> GUID (ненайденные названия пропускаются)
+    """
+    result = {}
+    for start in range(0, len(titles), RESOLVE_BATCH_SIZE):
+        rows = db.fetch_all(DATASET_GUIDS_QUERY, as_dict=True,
+                            params={'titles': titles[start:start + RESOLVE_BATCH_SIZE]})
+        result.update({row['title']: row['guid'] for row in rows})
+    return result
+
+
+class ProductLease:
+    """
+    Блокировка загрузки датасета в redis: пока она жива, другие задачи этот датасет не качают.
+    Фоновый поток продлевает блокировку, упавший воркер отпустит её сам через ttl.
+    """
+
+    def __init__(self, r: redis.Redis, guid: str, owner: str, ttl: int):
+        self.r = r
+        self.key = LEASE_KEY.format(guid)
+        self.owner = owner
+        self.ttl = ttl
+        self.__stop = threading.Event()
+        self.__heartbeat = threading.Thread(target=self.__refresh, daemon=True)
+        self.__heartbeat.start()
+
+    def __refresh(self):
+        refresh = self.r.register_script(_REFRESH_SCRIPT)
+        while not self.__stop.wait(self.ttl / 3):
+            try:
+                refresh(keys=[self.key], args=[self.owner, self.ttl])
+            except redis.RedisError:
+                pass
+
+    def release(self):
+        self.__stop.set()
+        self.r.register_script(_RELEASE_SCRIPT)(keys=[self.key], args=[self.owner])
+
+    def __enter__(self) -> 'ProductLease':
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+def acquire_product(r: redis.Redis, guid: str, owner: str, ttl: int = 600) -> Optional[ProductLease]:
+    """ Функция захватывает загрузку датасета.
+    Повторная доставка той же задачи (тот же owner) после падения воркера забирает блокировку себе.
+
+    :param r: клиент redis
+    :param guid: идентификатор датасета
+    :param owner: владелец блокировки (id задачи)
+    :param ttl: время жизни блокировки без продления, с
+    :return: lease или None, если датасет уже качает кто-то другой
+    """
+    key = LEASE_KEY.format(guid)
+    if not r.set(key, owner, nx=True, ex=ttl):
+        current = r.get(key)
+        if current is None or current.decode() != owner:
+            return None
+        r.expire(key, ttl)
+    return ProductLease(r, guid, owner, ttl)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('data_dir', nargs='?', default='/data')
+    parser.add_argument('--checksums', action='store_true', help='считать MD5 архивов без .meta.json')
+    parser.add_argument('--no-db', action='store_true', help='не искать архивы без .meta.json в таблице datasets')
+    args = parser.parse_args()
+    resolve = None
+    if not args.no_db:
+        import config
+        from db_service import DBConnection
+        db = DBConnection(dbname=config.DB_NAME, user=config.DB_USER, password=config.DB_PASSWORD, host=config.DB_IP,
+                          port=config.DB_PORT, max_retry_count=config.MAX_QUERY_RETRY_COUNT)
+        resolve = lambda titles: dataset_guids(db, titles)
+    count = ProductIndex(args.data_dir).rebuild(resolve, checksums=args.checksums)
+    print(f'Indexed {count} products in {args.data_dir}')
@@ -0,0 +1,80 @@
+import threading
+import time
+from typing import Optional
+
+from sentinel.status import STATUS_DOWNLOADING, StatusWriter
+from tools.metrics import DOWNLOAD_BYTES, TIME_TO_FIRST_BYTE_SECONDS, WORKER
+
+
+class DownloadProgress:
+    """
+    Прогресс загрузки датасета.
+    Считает скачанные байты (в т.ч. из нескольких потоков), пишет метрики и не чаще раза в interval секунд
+    публикует прогресс в состояние задачи (update_state), чтобы он был виден во Flower, и в буфер состояния
+    датасетов (в БД его пишет StatusWriter).
+    """
+
+    def __init__(self, worker, product_guid: str, interval: float = 2.0, status: Optional[StatusWriter] = None):
+        self.__worker = worker
+        # task.request - thread-local: в потоках многопоточной загрузки его нет, id задачи запоминаем здесь
+        self.__task_id = getattr(getattr(worker, 'request', None), 'id', None)
+        self.__status = status
+        self.__product_guid = product_guid
+        self.__interval = interval
+        self.__lock = threading.Lock()
+        self.__request_started = None
+        self.__first_byte = False
+        self.__reported_at = 0.0
+        self.__unreported_bytes = 0
+        self.started = time.monotonic()
+        self.done = 0
+        self.total = 0
+        self.transferred = 0
+
+    def start(self, done: int, total: int):
+        """ Функция задаёт уже скачанный объём (при докачке) и полный размер файла
+        """
+        with self.__lock:
+            self.done = done
+            self.total = total
+        if self.__status is not None:
+            self.__status.update(self.__product_guid, size=total, status=STATUS_DOWNLOADING)
+
+    def request_started(self):
+        with self.__lock:
+            if self.__request_started is None:
+                self.__request_started = time.monotonic()
+
+    def advance(self, size: int):
+        """ Функция учитывает очередной кусок файла
+        """
+        now = time.monotonic()
+        with self.__lock:
+            if not self.__first_byte and self.__request_started is not None:
+                self.__first_byte = True
+                TIME_TO_FIRST_BYTE_SECONDS.observe(now - self.__request_started)
+            self.done += size
+            self.transferred += size
+            self.__unreported_bytes += size
+            if now - self.__reported_at < self.__interval:
+                return
+            self.__reported_at = now
+            self.__flush()
+
+    def finish(self):
+        with self.__lock:
+            self.__flush()
+
+    def __flush(self):
+        DOWNLOAD_BYTES.labels(WORKER).inc(self.__unreported_bytes)
+        self.__unreported_bytes = 0
+        percent = round(self.done / self.total * 100.0, 2) if self.total else None
+        if self.__status is not None:
+            self.__status.update(self.__product_guid, progress=percent)
+        if self.__worker is not None and self.__task_id is not None:
+            self.__worker.update_state(task_id=self.__task_id,
+                                       state='PROGRESS',
+                                       meta={'guid': self.__product_guid,
+                                             'done': self.done,
+                                             'total': self.total,
+                                             'percent': percent})
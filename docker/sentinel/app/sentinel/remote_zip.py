@@ -0,0 +1,273 @@
+"""
+Выборочное чтение файлов из zip-архива на сервере через HTTP Range: читаем конец архива (EOCD и центральный
+каталог), находим нужные файлы и скачиваем только их байты.
+"""
+import fnmatch
+import os
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, List, NamedTuple, Optional, Tuple
+
+import requests
+
+from sentinel.progress import DownloadProgress
+from tools.web import parse_content_range
+
+EOCD_SIGNATURE = b'PK\x05\x06'
+EOCD64_LOCATOR_SIGNATURE = b'PK\x06\x07'
+EOCD64_SIGNATURE = b'PK\x06\x06'
+CENTRAL_SIGNATURE = b'PK\x01\x02'
+LOCAL_SIGNATURE = b'PK\x03\x04'
+
+_EOCD = struct.Struct('<4sHHHHIIH')
+_EOCD64_LOCATOR = struct.Struct('<4sIQI')
+_EOCD64 = struct.Struct('<4sQHHIIQQQQ')
+_CENTRAL = struct.Struct('<4sHHHHHHIIIHHHHHII')
+_LOCAL = struct.Struct('<4sHHHHHIIIHH')
+
+ZIP64_EXTRA_ID = 0x0001
+ZIP64_MARKER = 0xFFFFFFFF
+MAX_COMMENT_SIZE = 0xFFFF
+STORED = 0
+DEFLATED = 8
+CHUNK_SIZE = 1024 * 1024
+
+
+class ZipMember(NamedTuple):
+    name: str
+    method: int
+    crc: int
+    compressed_size: int
+    size: int
+    # смещение локального заголовка файла в архиве
+    offset: int
+    # конец данных файла в архиве (начало следующего файла или центрального каталога)
+    end: int
+
+
+def fetch_range(session: requests.Session, url: str, start: int, end: int) -> bytes:
+    """ Функция скачивает диапазон байт файла
+
+    :param session: сессия requests
+    :param url: адрес файла
+    :param start: начало диапазона
+    :param end: конец диапазона (включительно)
+    :return: байты диапазона
+    """
+    with session.get(url, allow_redirects=True, headers={'Range': f'bytes={start}-{end}'}) as resp:
+        content_range = parse_content_range(resp.headers.get('content-range'))
+        if resp.status_code != 206 or content_range is None or content_range[0] != start:
+            raise RuntimeError(f'Сервер вернул неожиданный ответ на диапазон {start}-{end}: '
+                               f'{resp.status_code} {resp.headers.get("content-range")}')
+        return resp.content
+
+
+def read_central_directory(session: requests.Session, url: str, size: int) -> List[ZipMember]:
+    """ Функция читает оглавление zip-архива на сервере
+
+    :param session: сессия requests
+    :param url: адрес архива
+    :param size: размер архива
+    :return: файлы архива в порядке их расположения
+    """
+    tail_size = min(size, _EOCD.size + MAX_COMMENT_SIZE + _EOCD64_LOCATOR.size)
+    tail_start = size - tail_size
+    tail = fetch_range(session, url, tail_start, size - 1)
+    pos = tail.rfind(EOCD_SIGNATURE)
+    if pos < 0:
+        raise ValueError(f'{url} не zip-архив')
+    _, _, _, _, count, cd_size, cd_offset, _ = _EOCD.unpack_from(tail, pos)
+    if count == 0xFFFF or cd_size == ZIP64_MARKER or cd_offset == ZIP64_MARKER:
+        # ZIP64: настоящие размеры лежат в EOCD64, на который указывает локатор перед EOCD
+        locator = pos - _EOCD64_LOCATOR.size
+        if locator < 0 or tail[locator:locator + 4] != EOCD64_LOCATOR_SIGNATURE:
+            raise ValueError(f'{url}: не найден локатор ZIP64')
+        _, _, eocd64_offset, _ = _EOCD64_LOCATOR.unpack_from(tail, locator)
+        if eocd64_offset >= tail_start:
+            eocd64 = tail[eocd64_offset - tail_start:eocd64_offset - tail_start + _EOCD64.size]
+        else:
+            eocd64 = fetch_range(session, url, eocd64_offset, eocd64_offset + _EOCD64.size - 1)
+        if eocd64[:4] != EOCD64_SIGNATURE:
+            raise ValueError(f'{url}: повреждён EOCD64')
+        _, _, _, _, _, _, _, count, cd_size, cd_offset = _EOCD64.unpack_from(eocd64)
+
+    if cd_offset >= tail_start:
+        central = tail[cd_offset - tail_start:cd_offset - tail_start + cd_size]
+    else:
+        central = fetch_range(session, url, cd_offset, cd_offset + cd_size - 1)
+
+    entries = []
+    pos = 0
+    for _ in range(count):
+        (signature, _, _, flags, method, _, _, crc, compressed_size, file_size, name_size, extra_size,
+         comment_size, _, _, _, offset) = _CENTRAL.unpack_from(central, pos)
+        if signature != CENTRAL_SIGNATURE:
+            raise ValueError(f'{url}: повреждён центральный каталог')
+        pos += _CENTRAL.size
+        name = central[pos:pos + name_size].decode('utf-8' if flags & 0x800 else 'cp437')
+        extra = central[pos + name_size:pos + name_size + extra_size]
+        pos += name_size + extra_size + comment_size
+        file_size, compressed_size, offset = _zip64_sizes(extra, file_size, compressed_size, offset)
+        entries.append((offset, name, method, crc, compressed_size, file_size))
+
+    entries.sort()
+    ends = [offset for offset, *_ in entries[1:]] + [cd_offset]
+    return [ZipMember(name, method, crc, compressed_size, file_size, offset, end)
+            for (offset, name, method, crc, compressed_size, file_size), end in zip(entries, ends)]
+
+
+def _zip64_sizes(extra: bytes, file_size: int, compressed_size: int, offset: int) -> Tuple[int, int, int]:
+    """
+    Размеры и смещение из extra-поля ZIP64 (в нём только те значения, что не влезли в 32 бита, в этом порядке)
+    """
+    pos = 0
+    while pos + 4 <= len(extra):
+        header_id, data_size = struct.unpack_from('<HH', extra, pos)
+        pos += 4
+        if header_id == ZIP64_EXTRA_ID:
+            values = list(struct.unpack_from(f'<{data_size // 8}Q', extra, pos))
+            if file_size == ZIP64_MARKER:
+                file_size = values.pop(0)
+            if compressed_size == ZIP64_MARKER:
+                compressed_size = values.pop(0)
+            if offset == ZIP64_MARKER:
+                offset = values.pop(0)
+            break
+        pos += data_size
+    return file_size, compressed_size, offset
+
+
+def select_members(members: Iterable[ZipMember], patterns: Iterable[str]) -> List[ZipMember]:
+    """ Функция отбирает файлы архива по шаблонам fnmatch
+
+    :param members: файлы архива
+    :param patterns: шаблоны путей внутри архива
+    :return: подходящие файлы (без каталогов)
+    """
+    patterns = list(patterns)
+    return [member for member in members
+            if not member.name.endswith('/') and any(fnmatch.fnmatchcase(member.name, p) for p in patterns)]
+
+
+def band_patterns(bands: Iterable[str], resolution: Optional[str] = None, metadata: bool = True) -> List[str]:
+    """ Функция возвращает шаблоны файлов каналов в SAFE-архиве sentinel-2
+
+    :param bands: каналы (B04, B08, SCL, ...)
+    :param resolution: разрешение для L2A (10m, 20m, 60m), None - любое
+    :param metadata: добавить метаданные продукта (MTD_*.xml)
+    :return: шаблоны для select_members
+    """
+    patterns = []
+    for band in bands:
+        # L1C: GRANULE/<tile>/IMG_DATA/T37UCS_20210913T083601_B04.jp2
+        patterns.append(f'*/IMG_DATA/*_{band}.jp2')
+        # L2A: GRANULE/<tile>/IMG_DATA/R10m/T37UCS_20210913T083601_B04_10m.jp2
+        if resolution:
+            patterns.append(f'*/IMG_DATA/R{resolution}/*_{band}_{resolution}.jp2')
+        else:
+            patterns.append(f'*/IMG_DATA/R*/*_{band}_*.jp2')
+    if metadata:
+        patterns.append('*.SAFE/MTD_*.xml')
+    return patterns
+
+
+def extract_member(session: requests.Session, url: str, member: ZipMember, target: str,
+                   progress: Optional[DownloadProgress] = None):
+    """ Функция скачивает и распаковывает один файл архива
+
+    :param session: сессия requests
+    :param url: адрес архива
+    :param member: файл архива
+    :param target: путь, куда сохранить файл
+    :param progress: прогресс загрузки
+    """
+    if member.method not in (STORED, DEFLATED):
+        raise ValueError(f'{member.name}: неподдерживаемый метод сжатия {member.method}')
+    if progress is not None:
+        progress.request_started()
+    with session.get(url, allow_redirects=True, stream=True,
+                     headers={'Range': f'bytes={member.offset}-{member.end - 1}'}) as resp:
+        content_range = parse_content_range(resp.headers.get('content-range'))
+        if resp.status_code != 206 or content_range is None or content_range[0] != member.offset:
+            raise RuntimeError(f'Сервер вернул неожиданный ответ на диапазон {member.name}: '
+                               f'{resp.status_code} {resp.headers.get("content-range")}')
+        chunks = resp.iter_content(chunk_size=CHUNK_SIZE)
+        # Локальный заголовок: длина имени и extra-поля в нём могут отличаться от центрального каталога
+        buffer = b''
+        header_size = _LOCAL.size
+        for chunk in chunks:
+            buffer += chunk
+            if len(buffer) >= _LOCAL.size:
+                signature, *_, name_size, extra_size = _LOCAL.unpack_from(buffer)
+                if signature != LOCAL_SIGNATURE:
+                    raise RuntimeError(f'{member.name}: повреждён локальный заголовок')
+                header_size = _LOCAL.size + name_size + extra_size
+                if len(buffer) >= header_size:
+                    break
+        if len(buffer) < header_size:
+            raise RuntimeError(f'{member.name}: архив оборвался на заголовке')
+
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS) if member.method == DEFLATED else None
+        crc = 0
+        remaining = member.compressed_size
+        with open(target, 'wb') as f:
+            for chunk in _with_head(buffer[header_size:], chunks):
+                chunk = chunk[:remaining]
+                remaining -= len(chunk)
+                data = decompressor.decompress(chunk) if decompressor is not None else chunk
+                crc = zlib.crc32(data, crc)
+                f.write(data)
+                if progress is not None:
+                    progress.advance(len(chunk))
+                if remaining <= 0:
+                    break
+            if decompressor is not None:
+                data = decompressor.flush()
+                crc = zlib.crc32(data, crc)
+                f.write(data)
+    if remaining > 0:
+        raise RuntimeError(f'{member.name}: загрузка прервана, не хватает {remaining} байт')
+    if crc != member.crc:
+        raise RuntimeError(f'{member.name}: не совпала контрольная сумма CRC32')
+
+
+def _with_head(head: bytes, chunks: Iterable[bytes]):
+    if head:
+        yield head
+    yield from chunks
+
+
+def member_path(target_dir: str, name: str) -> str:
+    """ Функция возвращает путь файла архива внутри каталога распаковки
+
+    :param target_dir: каталог распаковки
+    :param name: путь файла внутри архива
+    :return: путь на локальной ФС
+    """
+    root = os.path.realpath(target_dir)
+    target = os.path.realpath(os.path.join(root, name))
+    if not target.startswith(root + os.sep):
+        raise ValueError(f'{name}: путь выходит за пределы каталога')
+    return target
+
+
+def extract_members(session: requests.Session, url: str, members: List[ZipMember], target_dir: str,
+                    progress: Optional[DownloadProgress] = None, threads: int = 1):
+    """ Функция скачивает файлы архива, сохраняя их пути внутри архива
+
+    :param session: сессия requests
+    :param url: адрес архива
+    :param members: файлы архива
+    :param target_dir: каталог, куда распаковать файлы
+    :param progress: прогресс загрузки
+    :param threads: количество файлов, которые качаются одновременно
+    """
+    def extract(member: ZipMember):
+        target = member_path(target_dir, member.name)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        extract_member(session, url, member, target, progress)
+
+    with ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+        # list - чтобы ошибка любого файла всплыла здесь
+        list(executor.map(extract, members))
@@ -0,0 +1,102 @@
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from typing import Callable, Optional
+
+import redis
+import requests
+
+from sentinel.downloader import is_online, trigger_restore
+
+PENDING_KEY = 'sentinel:restore:pending'
+PRODUCTS_KEY = 'sentinel:restore:products'
+LOCK_KEY = 'sentinel:restore:lock'
+
+CHECK_THREADS = 8
+
+
+def add_pending(r: redis.Redis, product_guid: str, product_title: str, triggered: bool,
+                check_interval: timedelta, task_kwargs: Optional[dict] = None, chain: Optional[list] = None):
+    """ Функция ставит датасет в очередь ожидания восстановления из архива
+
+    :param r: клиент redis
+    :param product_guid: идентификатор датасета
+    :param product_title: название датасета
+    :param triggered: удалось ли запросить восстановление
+    :param check_interval: через сколько проверить датасет
+    :param task_kwargs: именованные аргументы задачи скачивания, с которыми её поставить после восстановления
+    :param chain: оставшиеся задачи цепочки celery (request.chain), которые пойдут после скачивания
+    """
+    now = time.time()
+    product = {'title': product_title, 'triggered_at': now if triggered else None, 'kwargs': task_kwargs or {},
+               'chain': chain or None}
+    with r.pipeline() as pipe:
+        pipe.hsetnx(PRODUCTS_KEY, product_guid, json.dumps(product))
+        pipe.zadd(PENDING_KEY, {product_guid: now + check_interval.total_seconds()}, nx=True)
+        pipe.execute()
+
+
+def poll_pending(r: redis.Redis,
+                 session: requests.Session,
+                 send_task: Callable[[str, str, dict, Optional[list]], None],
+                 logger,
+                 batch_size: int,
+                 check_interval: timedelta,
+                 retrigger_interval: timedelta) -> int:
+    """ Функция проверяет пачку ожидающих датасетов и отправляет на скачивание те, что уже в онлайне.
+    Датасеты, которые всё ещё в архиве, откладываются на check_interval, запрос на восстановление
+    повторяется раз в retrigger_interval (или сразу, если прошлый запрос не прошёл).
+
+    :param r: клиент redis
+    :param session: сессия requests
+    :param send_task: функция постановки задачи на скачивание (guid, title, kwargs, chain)
+    :param logger: логгер
+    :param batch_size: максимальное количество датасетов за один проход
+    :param check_interval: интервал между проверками одного датасета
+    :param retrigger_interval: интервал между повторными запросами на восстановление
+    :return: количество датасетов, отправленных на скачивание
+    """
+    lock = r.lock(LOCK_KEY, timeout=max(60, int(check_interval.total_seconds())))
+    if not lock.acquire(blocking=False):
+        logger.info('Проверка архивных датасетов уже выполняется')
+        return 0
+    try:
+        now = time.time()
+        guids = [guid.decode() for guid in r.zrangebyscore(PENDING_KEY, '-inf', now, start=0, num=batch_size)]
+        if not guids:
+            return 0
+        products = {guid: json.loads(product)
+                    for guid, product in zip(guids, r.hmget(PRODUCTS_KEY, guids)) if product is not None}
+
+        with ThreadPoolExecutor(max_workers=CHECK_THREADS) as executor:
+            online = dict(zip(guids, executor.map(lambda guid: is_online(session, guid, logger), guids)))
+
+        enqueued = 0
+        with r.pipeline() as pipe:
+            # Статусы уже обработанных датасетов записываются, даже если send_task упал на середине пачки -
+            # иначе отправленные датасеты остались бы в ожидании и ушли на скачивание повторно
+            try:
+                for guid in guids:
+                    product = products.get(guid)
+                    if product is None:
+                        pipe.zrem(PENDING_KEY, guid)
+                        continue
+                    if online[guid]:
+                        send_task(guid, product['title'], product.get('kwargs') or {}, product.get('chain'))
+                        pipe.zrem(PENDING_KEY, guid)
+                        pipe.hdel(PRODUCTS_KEY, guid)
+                        enqueued += 1
+                        continue
+                    triggered_at = product.get('triggered_at')
+                    if triggered_at is None or now - triggered_at > retrigger_interval.total_seconds():
+                        if trigger_restore(session, guid, logger):
+                            product['triggered_at'] = now
+                            pipe.hset(PRODUCTS_KEY, guid, json.dumps(product))
+                    pipe.zadd(PENDING_KEY, {guid: now + check_interval.total_seconds()})
+            finally:
+                pipe.execute()
+        logger.info(f'Проверено {len(guids)} архивных датасетов, отправлено на скачивание {enqueued}')
+        return enqueued
+    finally:
+        lock.release()
@@ -0,0 +1,255 @@
+"""
+Загрузка датасета на S3 по мере скачивания: куски файла собираются в части multipart upload и отправляются
+несколькими потоками, пока загрузка с сервера ещё идёт.
+"""
+import base64
+import hashlib
+import queue
+import threading
+from typing import Optional
+
+MIN_PART_SIZE = 5 * 1024 * 1024
+MAX_PARTS = 10000
+
+
+class MultipartUpload:
+    """
+    Multipart upload на S3, в который пишут загрузчики датасета.
+    Части собираются в памяти по смещению (write_at), так что писать можно и одним потоком по порядку,
+    и несколькими потоками в непересекающиеся диапазоны (лучше выровненные по part_size - тогда часть
+    не ждёт соседний поток).
+    Готовые части ставятся в ограниченную очередь (запись блокируется, если S3 не успевает) и отправляются
+    пулом потоков с Content-MD5, после завершения проверяется ETag всего объекта.
+    """
+
+    def __init__(self, client, bucket: str, key: str, part_size: int = 16 * 1024 * 1024, threads: int = 4,
+                 max_queued_parts: int = 8):
+        """
+        :param client: клиент boto3 s3
+        :param bucket: бакет
+        :param key: ключ объекта
+        :param part_size: размер части, байт (не меньше 5 МБ)
+        :param threads: количество потоков загрузки частей
+        :param max_queued_parts: сколько готовых частей может ждать отправки в памяти
+        """
+        if part_size < MIN_PART_SIZE:
+            raise ValueError(f'part_size должен быть не меньше {MIN_PART_SIZE}')
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.upload_id = client.create_multipart_upload(Bucket=bucket, Key=key)['UploadId']
+        self.size = 0
+        self.__lock = threading.Lock()
+        # номер части -> [сколько байт собрано, {смещение: кусок}]
+        self.__buffers = {}
+        # номер части -> (ETag, md5 части)
+        self.__parts = {}
+        self.__error: Optional[BaseException] = None
+        self.__closed = False
+        self.__queue = queue.Queue(maxsize=max_queued_parts)
+        self.__threads = [threading.Thread(target=self.__upload_parts, daemon=True) for _ in range(threads)]
+        for thread in self.__threads:
+            thread.start()
+
+    @property
+    def uri(self) -> str:
+        return f's3://{self.bucket}/{self.key}'
+
+    def write(self, data: bytes):
+        """ Функция дописывает кусок в конец объекта (загрузка одним потоком)
+        """
+        self.write_at(self.size, data)
+
+    def write_at(self, pos: int, data: bytes):
+        """ Функция записывает кусок объекта по смещению
+
+        :param pos: смещение куска в объекте
+        :param data: кусок
+        """
+        self.__raise_error()
+        view = memoryview(data)
+        while view:
+            number = pos // self.part_size + 1
+            if number > MAX_PARTS:
+                raise ValueError(f'{self.uri}: больше {MAX_PARTS} частей, увеличьте part_size')
+            size = min(len(view), number * self.part_size - pos)
+            with self.__lock:
+                part = self.__buffers.setdefault(number, [0, {}])
+                part[1][pos] = bytes(view[:size])
+                part[0] += size
+                self.size = max(self.size, pos + size)
+                ready = part[0] == self.part_size
+                if ready:
+                    del self.__buffers[number]
+            if ready:
+                self.__put(number, part[1])
+            view = view[size:]
+            pos += size
+
+    def complete(self) -> dict:
+        """ Функция отправляет оставшиеся части, завершает upload и проверяет ETag объекта
+
+        :return: {uri, etag, size}
+        """
+        with self.__lock:
+            parts = sorted(self.__buffers.items())
+            self.__buffers = {}
+        # Неполной может остаться только последняя часть
+        for number, (filled, pieces) in parts:
+            if number != -(-self.size // self.part_size) or \
+                    filled != self.size - (number - 1) * self.part_size:
+                self.abort()
+                raise RuntimeError(f'{self.uri}: часть {number} собрана не полностью')
+            self.__put(number, pieces)
+        self.__stop()
+        self.__raise_error()
+        numbers = sorted(self.__parts)
+        if not numbers:
+            # S3 не завершает multipart upload без частей - пустой объект кладётся обычным put_object
+            return self.__put_empty()
+        if numbers != list(range(1, len(numbers) + 1)):
+            raise RuntimeError(f'{self.uri}: пропущены части загрузки')
+        response = self.client.complete_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+            MultipartUpload={'Parts': [{'PartNumber': number, 'ETag': self.__parts[number][0]}
+                                       for number in numbers]})
+        expected = hashlib.md5(b''.join(self.__parts[number][1] for number in numbers)).hexdigest()
+        expected = f'{expected}-{len(numbers)}'
+        etag = response.get('ETag', '').strip('"')
+        if etag != expected:
+            # Объект собрался не из тех частей - удаляем его, задача перезапустится
+            self.client.delete_object(Bucket=self.bucket, Key=self.key)
+            raise RuntimeError(f'{self.uri}: ETag {etag} не совпал с ожидаемым {expected}')
+        return {'uri': self.uri, 'etag': etag, 'size': self.size}
+
+    def abort(self):
+        """ Функция прерывает upload и удаляет уже загруженные части
+        """
+        with self.__lock:
+            self.__buffers = {}
+            if self.__error is None:
+                self.__error = RuntimeError(f'{self.uri}: загрузка прервана')
+        self.__stop()
+        try:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+        except Exception:
+            # upload уже завершён или удалён - незавершённые части всё равно подчистит lifecycle бакета
+            pass
+
+    def __put_empty(self) -> dict:
+        self.abort()
+        response = self.client.put_object(Bucket=self.bucket, Key=self.key, Body=b'',
+                                          ContentMD5=base64.b64encode(hashlib.md5(b'').digest()).decode())
+        etag = response.get('ETag', '').strip('"')
+        return {'uri': self.uri, 'etag': etag, 'size': 0}
+
+    def __enter__(self) -> 'MultipartUpload':
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.abort()
+
+    def __put(self, number: int, pieces: dict):
+        body = b''.join(pieces[offset] for offset in sorted(pieces))
+        # Пока очередь полна, запись ждёт - так в памяти не больше max_queued_parts частей
+        while True:
+            self.__raise_error()
+            try:
+                self.__queue.put((number, body), timeout=1.0)
+                return
+            except queue.Full:
+                continue
+
+    def __stop(self):
+        if self.__closed:
+            return
+        self.__closed = True
+        for _ in self.__threads:
+            self.__queue.put(None)
+        for thread in self.__threads:
+            thread.join()
+
+    def __upload_parts(self):
+        while True:
+            item = self.__queue.get()
+            if item is None:
+                return
+            if self.__error is not None:
+                # После ошибки части только вычитываются, чтобы не заблокировать пишущих
+                continue
+            number, body = item
+            digest = hashlib.md5(body).digest()
+            try:
+                response = self.client.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                                   PartNumber=number, Body=body,
+                                                   ContentMD5=base64.b64encode(digest).decode())
+                etag = response['ETag'].strip('"')
+                if etag != digest.hex():
+                    raise RuntimeError(f'{self.uri}: ETag части {number} не совпал с md5')
+            except BaseException as e:
+                with self.__lock:
+                    if self.__error is None:
+                        self.__error = e
+                continue
+            with self.__lock:
+                self.__parts[number] = (etag, digest)
+
+    def __raise_error(self):
+        if self.__error is not None:
+            raise RuntimeError(f'{self.uri}: ошибка загрузки на S3: {self.__error}') from self.__error
+
+
+def object_matches(client, bucket: str, key: str, path: str, size: int, part_size: int,
+                   checksum: Optional[str] = None) -> bool:
+    """ Функция проверяет, что объект на S3 - это уже загруженный локальный файл (размер и ETag)
+
+    :param client: клиент boto3 s3
+    :param bucket: бакет
+    :param key: ключ объекта
+    :param path: локальный файл
+    :param size: размер локального файла
+    :param part_size: размер части, с которым файл загружался multipart upload
+    :param checksum: известная контрольная сумма файла (MD5 или ETag прошлой загрузки) - тогда файл не читается
+    :return: True - объект есть и совпадает с файлом
+    """
+    from botocore.exceptions import ClientError
+    try:
+        head = client.head_object(Bucket=bucket, Key=key)
+    except ClientError:
+        return False
+    etag = head.get('ETag', '').strip('"')
+    if head.get('ContentLength') != size or not etag:
+        return False
+    if checksum is not None and etag == checksum:
+        return True
+    if '-' not in etag:
+        # Объект загружен одним PUT - ETag равен MD5 файла (известный MD5 уже с ним не совпал)
+        if checksum is not None and '-' not in checksum:
+            return False
+        return etag == _file_digest(path, size, 0)
+    if etag.rsplit('-', 1)[1] != str(max(1, -(-size // part_size))):
+        # Загружен с другим размером части - ETag не пересчитать, считаем объект чужим
+        return False
+    return etag == _file_digest(path, size, part_size)
+
+
+def _file_digest(path: str, size: int, part_size: int) -> str:
+    """ Функция считает ETag, который S3 дал бы файлу: MD5 (part_size=0) или MD5 от MD5 частей с числом частей
+    """
+    digests = []
+    with open(path, 'rb') as f:
+        for _ in range(max(1, -(-size // part_size)) if part_size else 1):
+            md5 = hashlib.md5()
+            remaining = part_size or size
+            while remaining > 0:
+                chunk = f.read(min(remaining, 1024 * 1024))
+                if not chunk:
+                    break
+                md5.update(chunk)
+                remaining -= len(chunk)
+            digests.append(md5.digest())
+    if not part_size:
+        return digests[0].hex()
+    return f'{hashlib.md5(b"".join(digests)).hexdigest()}-{len(digests)}'
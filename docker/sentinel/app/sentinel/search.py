@@ -0,0 +1,344 @@
+"""
+Поиск датасетов sentinel по полям и датам с учётом уже выполненных поисков.
+
+Каждая пара (поле, дата) ищется один раз: после поиска она записывается в search_coverage, даже если ничего
+не нашлось, и при следующих запусках пропускается. Поля, которые попадают в одну ячейку сетки (примерно
+тайл sentinel-2), ищутся одним запросом по их общему охвату, непрерывные диапазоны дат - тоже одним запросом.
+Страницы результатов скачиваются параллельно, найденное регистрируется в БД пачками в одной транзакции.
+"""
+import math
+import re
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from typing import Dict, Iterable, List, NamedTuple, Optional, Sequence, Set, Tuple
+
+import requests
+
+from db_service import DBConnection
+
+# Таблицы создаются при первом поиске в процессе
+SCHEMA_QUERY = [
+    """
+    CREATE TABLE IF NOT EXISTS search_coverage (
+        field_uuid uuid NOT NULL,
+        date date NOT NULL,
+        products integer NOT NULL,
+        searched_at timestamptz NOT NULL DEFAULT now(),
+        PRIMARY KEY (field_uuid, date)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS field_datasets (
+        field_uuid uuid NOT NULL,
+        dataset_guid uuid NOT NULL,
+        date date NOT NULL,
+        PRIMARY KEY (field_uuid, dataset_guid)
+    )
+    """,
+]
+# Охват полей в градусах (WGS 84), геометрия полей - PostGIS
+FIELDS_QUERY = """
+    SELECT uuid::text AS uuid, ST_XMin(box) AS xmin, ST_YMin(box) AS ymin, ST_XMax(box) AS xmax, ST_YMax(box) AS ymax
+    FROM (SELECT uuid, ST_Transform(geometry, 4326)::box2d AS box FROM fields WHERE uuid = ANY(%(uuids)s::uuid[])) f
+"""
+COVERED_QUERY = """
+    SELECT field_uuid::text AS field_uuid, date
+    FROM search_coverage
+    WHERE field_uuid = ANY(%(uuids)s::uuid[]) AND date BETWEEN %(date_from)s AND %(date_to)s
+"""
+KNOWN_DATASETS_QUERY = """
+    SELECT guid::text AS guid FROM datasets WHERE guid = ANY(%(guids)s::uuid[])
+"""
+
+ROWS_LIMIT = 100
+_NUMBER_RE = re.compile(r'-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?')
+_SIZE_UNITS = {'B': 1, 'KB': 1024, 'MB': 1024 ** 2, 'GB': 1024 ** 3, 'TB': 1024 ** 4}
+
+_schema_ready = False
+
+
+class BBox(NamedTuple):
+    xmin: float
+    ymin: float
+    xmax: float
+    ymax: float
+
+    def intersects(self, other: 'BBox') -> bool:
+        return self.xmin <= other.xmax and other.xmin <= self.xmax and \
+            self.ymin <= other.ymax and other.ymin <= self.ymax
+
+    def union(self, other: 'BBox') -> 'BBox':
+        return BBox(min(self.xmin, other.xmin), min(self.ymin, other.ymin),
+                    max(self.xmax, other.xmax), max(self.ymax, other.ymax))
+
+    def wkt(self) -> str:
+        return (f'POLYGON(({self.xmin} {self.ymin}, {self.xmax} {self.ymin}, {self.xmax} {self.ymax}, '
+                f'{self.xmin} {self.ymax}, {self.xmin} {self.ymin}))')
+
+
+class Field(NamedTuple):
+    uuid: str
+    bbox: BBox
+
+
+class Product(NamedTuple):
+    guid: str
+    title: str
+    size: Optional[int]
+    date: date
+    bbox: BBox
+
+
+class SearchResult(NamedTuple):
+    # (поле, дата) -> количество найденных датасетов, для всех пар, которые искались
+    searched: Dict[Tuple[str, date], int]
+    # Датасеты, которых раньше не было в datasets
+    new_datasets: List[Product]
+    # Количество запросов к серверу поиска
+    requests: int
+
+
+def ensure_schema(db: DBConnection):
+    """ Функция создаёт таблицы индекса поиска, если их нет
+    """
+    global _schema_ready
+    if not _schema_ready:
+        db.execute(SCHEMA_QUERY)
+        _schema_ready = True
+
+
+def load_fields(db: DBConnection, uuids: Sequence[str]) -> List[Field]:
+    """ Функция читает охваты полей
+
+    :param db: подключение к БД
+    :param uuids: идентификаторы полей
+    :return: поля (неизвестные идентификаторы пропускаются)
+    """
+    rows = db.fetch_all(FIELDS_QUERY, as_dict=True, params={'uuids': list(uuids)})
+    return [Field(row['uuid'], BBox(row['xmin'], row['ymin'], row['xmax'], row['ymax'])) for row in rows]
+
+
+def missing_pairs(db: DBConnection, uuids: Sequence[str], dates: Sequence[date]) -> Set[Tuple[str, date]]:
+    """ Функция возвращает пары (поле, дата), по которым поиск ещё не выполнялся
+
+    :param db: подключение к БД
+    :param uuids: идентификаторы полей
+    :param dates: даты
+    :return: пары без записи в search_coverage
+    """
+    if not uuids or not dates:
+        return set()
+    covered = db.fetch_all(COVERED_QUERY, as_dict=True,
+                           params={'uuids': list(uuids), 'date_from': min(dates), 'date_to': max(dates)})
+    covered = {(row['field_uuid'], row['date']) for row in covered}
+    return {(uuid, day) for uuid in uuids for day in dates} - covered
+
+
+def group_fields(fields: Iterable[Field], cell_degrees: float) -> Dict[Tuple[int, int], List[Field]]:
+    """ Функция группирует поля по ячейкам сетки по центру охвата
+
+    :param fields: поля
+    :param cell_degrees: размер ячейки, градусов (1 градус - примерно тайл sentinel-2 110x110 км)
+    :return: ячейка -> поля
+    """
+    groups = {}
+    for field in fields:
+        x = (field.bbox.xmin + field.bbox.xmax) / 2
+        y = (field.bbox.ymin + field.bbox.ymax) / 2
+        groups.setdefault((math.floor(x / cell_degrees), math.floor(y / cell_degrees)), []).append(field)
+    return groups
+
+
+def date_spans(dates: Iterable[date]) -> List[Tuple[date, date]]:
+    """ Функция собирает даты в непрерывные диапазоны
+
+    :param dates: даты
+    :return: [(первая, последняя), ...] по возрастанию
+    """
+    spans = []
+    for day in sorted(set(dates)):
+        if spans and day - spans[-1][1] == timedelta(days=1):
+            spans[-1] = (spans[-1][0], day)
+        else:
+            spans.append((day, day))
+    return spans
+
+
+def build_query(bbox: BBox, date_from: date, date_to: date, platform: str, product_types: Sequence[str]) -> str:
+    """ Функция собирает запрос OpenSearch (синтаксис solr) по охвату и диапазону дат съёмки
+    """
+    query = [f'platformname:{platform}',
+             f'beginposition:[{date_from.isoformat()}T00:00:00.000Z TO {date_to.isoformat()}T23:59:59.999Z]',
+             f'footprint:"Intersects({bbox.wkt()})"']
+    if product_types:
+        query.insert(1, '(' + ' OR '.join(f'producttype:{product_type}' for product_type in product_types) + ')')
+    return ' AND '.join(query)
+
+
+def parse_size(size: Optional[str]) -> Optional[int]:
+    """ Функция переводит размер из ответа поиска ("1.08 GB") в байты
+    """
+    if not size:
+        return None
+    parts = size.split()
+    if len(parts) != 2 or parts[1].upper() not in _SIZE_UNITS:
+        return None
+    return int(float(parts[0]) * _SIZE_UNITS[parts[1].upper()])
+
+
+def footprint_bbox(wkt: str) -> BBox:
+    """ Функция возвращает охват геометрии WKT (координаты "долгота широта")
+    """
+    numbers = [float(n) for n in _NUMBER_RE.findall(wkt)]
+    xs, ys = numbers[0::2], numbers[1::2]
+    return BBox(min(xs), min(ys), max(xs), max(ys))
+
+
+def _as_list(value) -> list:
+    # В JSON OpenSearch единственный элемент приходит объектом, а не списком
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+
+def parse_entry(entry: dict) -> Product:
+    """ Функция разбирает датасет из ответа OpenSearch (format=json)
+    """
+    fields = {item['name']: item['content']
+              for key in ('str', 'date', 'int', 'double') for item in _as_list(entry.get(key))}
+    begin = datetime.strptime(fields['beginposition'][:19], '%Y-%m-%dT%H:%M:%S')
+    return Product(entry['id'], entry['title'], parse_size(fields.get('size')), begin.date(),
+                   footprint_bbox(fields['footprint']))
+
+
+def _fetch_page(session: requests.Session, url: str, query: str, start: int, rows: int) -> Tuple[int, List[dict]]:
+    with session.get(url, params={'q': query, 'start': start, 'rows': rows, 'format': 'json',
+                                  'orderby': 'beginposition asc'}) as resp:
+        resp.raise_for_status()
+        feed = resp.json()['feed']
+    return int(feed.get('opensearch:totalResults', 0)), _as_list(feed.get('entry'))
+
+
+def search_products(session: requests.Session, url: str, query: str, executor: ThreadPoolExecutor,
+                    rows: int = ROWS_LIMIT) -> Tuple[List[Product], int]:
+    """ Функция выполняет поиск и скачивает все страницы результатов
+
+    :param session: сессия requests
+    :param url: адрес OpenSearch (.../dhus/search)
+    :param query: запрос
+    :param executor: пул потоков для страниц после первой
+    :param rows: размер страницы (сервер отдаёт не больше 100)
+    :return: датасеты, количество запросов
+    """
+    total, entries = _fetch_page(session, url, query, 0, rows)
+    # Количество результатов известно из первой страницы - остальные запрашиваются параллельно
+    for page in executor.map(lambda start: _fetch_page(session, url, query, start, rows)[1],
+                             range(rows, total, rows)):
+        entries.extend(page)
+    products = {}
+    for entry in entries:
+        product = parse_entry(entry)
+        products[product.guid] = product
+    return list(products.values()), 1 + len(range(rows, total, rows))
+
+
+def search(db: DBConnection, session: requests.Session, url: str, field_uuids: Sequence[str],
+           dates: Sequence[date], logger, platform: str = 'Sentinel-2', product_types: Sequence[str] = (),
+           cell_degrees: float = 1.0, threads: int = 4) -> SearchResult:
+    """ Функция ищет датасеты по полям и датам, по которым поиск ещё не выполнялся, и регистрирует найденное
+
+    :param db: подключение к БД
+    :param session: сессия requests
+    :param url: адрес OpenSearch (.../dhus/search)
+    :param field_uuids: идентификаторы полей
+    :param dates: даты съёмки
+    :param logger: логгер
+    :param platform: платформа (platformname)
+    :param product_types: типы продуктов (S2MSI1C, S2MSI2A), пусто - любые
+    :param cell_degrees: размер ячейки сетки, в которой поля ищутся одним запросом, градусов
+    :param threads: количество параллельных запросов к серверу поиска
+    :return: SearchResult
+    """
+    if not field_uuids or not dates:
+        logger.info('Поиск: нет полей или дат')
+        return SearchResult({}, [], 0)
+    ensure_schema(db)
+    missing = missing_pairs(db, field_uuids, dates)
+    if not missing:
+        logger.info(f'Поиск по {len(field_uuids)} полям и {len(dates)} датам уже выполнен')
+        return SearchResult({}, [], 0)
+    missing_dates = {}
+    for uuid, day in missing:
+        missing_dates.setdefault(uuid, set()).add(day)
+    fields = load_fields(db, sorted(missing_dates))
+    unknown = set(missing_dates) - {field.uuid for field in fields}
+    if unknown:
+        logger.warning(f'Поля не найдены: {", ".join(sorted(unknown))}')
+
+    # Запрос: охват группы полей и непрерывный диапазон дат, по которым хотя бы одно поле группы не искалось
+    queries = []
+    for group in group_fields(fields, cell_degrees).values():
+        bbox = group[0].bbox
+        for field in group[1:]:
+            bbox = bbox.union(field.bbox)
+        group_dates = set().union(*(missing_dates[field.uuid] for field in group))
+        for date_from, date_to in date_spans(group_dates):
+            queries.append((group, build_query(bbox, date_from, date_to, platform, product_types)))
+
+    # Отдельные пулы для запросов и страниц: задачи страниц не ждут других задач, так что пул не заблокируется
+    with ThreadPoolExecutor(max_workers=max(1, threads)) as query_executor, \
+            ThreadPoolExecutor(max_workers=max(1, threads)) as page_executor:
+        results = list(query_executor.map(lambda q: search_products(session, url, q[1], page_executor), queries))
+
+    searched = {(field.uuid, day): 0 for field in fields for day in missing_dates[field.uuid]}
+    links = set()
+    products = {}
+    for (group, _), (found, _) in zip(queries, results):
+        for product in found:
+            for field in group:
+                key = (field.uuid, product.date)
+                if key in searched and (field.uuid, product.guid) not in links and \
+                        field.bbox.intersects(product.bbox):
+                    links.add((field.uuid, product.guid))
+                    searched[key] += 1
+                    products[product.guid] = product
+    new_datasets = register(db, searched, links, products)
+    request_count = sum(count for _, count in results)
+    logger.info(f'Поиск: {len(searched)} пар (поле, дата) за {len(queries)} запросов поиска '
+                f'({request_count} страниц), найдено {len(products)} датасетов, новых {len(new_datasets)}')
+    return SearchResult(searched, new_datasets, request_count)
+
+
+def register(db: DBConnection, searched: Dict[Tuple[str, date], int], links: Set[Tuple[str, str]],
+             products: Dict[str, Product]) -> List[Product]:
+    """ Функция регистрирует результаты поиска одной транзакцией: новые датасеты, связи поле-датасет и пары
+    (поле, дата), по которым поиск выполнен (в том числе без результатов)
+
+    :param db: подключение к БД
+    :param searched: (поле, дата) -> количество найденных датасетов
+    :param links: пары (поле, guid датасета)
+    :param products: guid -> датасет
+    :return: датасеты, которых раньше не было в datasets
+    """
+    known = set()
+    if products:
+        known = {row['guid'] for row in db.fetch_all(KNOWN_DATASETS_QUERY, as_dict=True,
+                                                     params={'guids': list(products)})}
+    db.open_transaction()
+    try:
+        if products:
+            db.bulk_upsert('datasets', ('guid', 'title', 'size'),
+                           [(p.guid, p.title, p.size) for p in products.values()],
+                           conflict_columns=('guid',), update_columns=[], in_transaction=True)
+            db.bulk_upsert('field_datasets', ('field_uuid', 'dataset_guid', 'date'),
+                           [(uuid, guid, products[guid].date) for uuid, guid in sorted(links)],
+                           conflict_columns=('field_uuid', 'dataset_guid'), update_columns=[], in_transaction=True)
+        db.bulk_upsert('search_coverage', ('field_uuid', 'date', 'products'),
+                       [(uuid, day, count) for (uuid, day), count in sorted(searched.items())],
+                       conflict_columns=('field_uuid', 'date'), in_transaction=True)
+    except BaseException:
+        db.rollback_transaction()
+        db.close_transaction()
+        raise
+    db.close_transaction()
+    return [product for guid, product in products.items() if guid not in known]
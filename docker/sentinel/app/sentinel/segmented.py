@@ -0,0 +1,190 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
+
+import requests
+
+from sentinel.file_sink import FileSink
+from sentinel.partial import contiguous_offset, save_part_state
+from sentinel.progress import DownloadProgress
+from sentinel.s3_upload import MultipartUpload
+from tools.web import get_filename_from_content_disposition, parse_content_range
+
+SEGMENT_CHUNK_SIZE = 1024 * 1024
+SEGMENT_MIN_SIZE = 16 * 1024 * 1024
+STATE_SAVE_STEP = 10 * 1024 * 1024
+
+
+def probe_ranges(session: requests.Session, url: str) -> Optional[Tuple[Optional[str], int, Optional[str]]]:
+    """ Функция проверяет, умеет ли сервер отдавать файл по кускам
+
+    :param session: сессия requests
+    :param url: адрес файла
+    :return: (название файла из Content-Disposition, размер файла, ETag) или None, если Range не поддерживается
+    """
+    with session.get(url, allow_redirects=True, stream=True, headers={'Range': 'bytes=0-0'}) as resp:
+        if resp.status_code != 206:
+            return None
+        content_range = parse_content_range(resp.headers.get('content-range'))
+        if content_range is None or content_range[2] is None:
+            return None
+        return (get_filename_from_content_disposition(resp.headers.get('content-disposition')),
+                content_range[2],
+                resp.headers.get('ETag'))
+
+
+def split_segments(size: int, segments: int, align: int = 1) -> list:
+    """ Функция разбивает файл на диапазоны байт
+
+    :param size: размер файла
+    :param segments: желаемое количество диапазонов
+    :param align: границы диапазонов кратны align (размер части multipart upload)
+    :return: список сегментов [начало, конец (включительно), текущая позиция]
+    """
+    segments = max(1, min(segments, size // SEGMENT_MIN_SIZE or 1))
+    step = -(-size // segments)
+    step = -(-step // align) * align
+    return [[start, min(start + step, size) - 1, start] for start in range(0, size, step)]
+
+
+def download_segmented(session: requests.Session,
+                       url: str,
+                       part_filename: str,
+                       state_filename: str,
+                       state: dict,
+                       segments: int,
+                       logger,
+                       progress: Optional[DownloadProgress] = None,
+                       sink: Optional[MultipartUpload] = None,
+                       hasher: Optional[FileSink] = None):
+    """ Функция выкачивает файл в несколько соединений.
+    Файл заранее создаётся нужного размера, каждый поток пишет свой диапазон через os.pwrite.
+    Прогресс каждого диапазона сохраняется в файл состояния, так что после падения загрузка продолжится
+    с того же места.
+
+    :param session: сессия requests
+    :param url: адрес файла
+    :param part_filename: путь к .part файлу
+    :param state_filename: путь к файлу состояния
+    :param state: состояние загрузки {size, etag[, segments]}
+    :param segments: количество параллельных соединений
+    :param logger: логгер
+    :param progress: прогресс загрузки
+    :param sink: multipart upload на S3, в который параллельно уходят скачанные куски
+    :param hasher: MD5 файла (FileSink без файла), считается вслед за непрерывным началом файла
+    """
+    size = state['size']
+    if not state.get('segments'):
+        state['segments'] = split_segments(size, segments, sink.part_size if sink is not None else 1)
+    state['offset'] = 0
+    save_part_state(state_filename, state)
+
+    fd = os.open(part_filename, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        if os.fstat(fd).st_size != size:
+            os.ftruncate(fd, size)
+            try:
+                os.posix_fallocate(fd, 0, size)
+            except (AttributeError, OSError):
+                pass
+
+        if sink is not None:
+            # Уже скачанное до обрыва лежит только на диске - отправляем его на S3 заново
+            for start, _, pos in state['segments']:
+                replay_part(fd, start, pos, sink)
+
+        lock = threading.Lock()
+        # Сигнал для подсчёта MD5: сдвинулся один из сегментов или закончился поток
+        changed = threading.Condition(lock)
+        done = {'done': sum(pos - start for start, _, pos in state['segments']), 'saved': 0}
+        if progress is not None:
+            progress.start(done['done'], size)
+
+        def fetch(segment: list):
+            start, end, pos = segment
+            if pos > end:
+                return
+            headers = {'Range': f'bytes={pos}-{end}'}
+            if state.get('etag'):
+                headers['If-Range'] = state['etag']
+            if progress is not None:
+                progress.request_started()
+            with session.get(url, allow_redirects=True, stream=True, headers=headers) as resp:
+                content_range = parse_content_range(resp.headers.get('content-range'))
+                if resp.status_code != 206 or content_range is None or content_range[0] != pos:
+                    raise RuntimeError(f'Сервер вернул неожиданный ответ на диапазон {pos}-{end}: '
+                                       f'{resp.status_code} {resp.headers.get("content-range")}')
+                for chunk in resp.iter_content(chunk_size=SEGMENT_CHUNK_SIZE):
+                    chunk = chunk[:end + 1 - pos]
+                    os.pwrite(fd, chunk, pos)
+                    if sink is not None:
+                        sink.write_at(pos, chunk)
+                    pos += len(chunk)
+                    if progress is not None:
+                        progress.advance(len(chunk))
+                    with changed:
+                        segment[2] = pos
+                        changed.notify_all()
+                        done['done'] += len(chunk)
+                        if done['done'] - done['saved'] >= STATE_SAVE_STEP:
+                            done['saved'] = done['done']
+                            os.fsync(fd)
+                            save_part_state(state_filename, state)
+                            logger.info(f'[{part_filename}] {done["done"] / size * 100.0:.2f} %')
+                    if pos > end:
+                        break
+            if pos <= end:
+                raise RuntimeError(f'Диапазон {start}-{end} прерван на {pos} байт')
+
+        with ThreadPoolExecutor(max_workers=len(state['segments'])) as executor:
+            futures = [executor.submit(fetch, segment) for segment in state['segments']]
+            if hasher is not None:
+                for future in futures:
+                    future.add_done_callback(lambda _: _notify(changed))
+                _hash_prefix(hasher, fd, state['segments'], changed, futures)
+        errors = [future.exception() for future in futures if future.exception() is not None]
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+        save_part_state(state_filename, state)
+        if progress is not None:
+            progress.finish()
+
+    if errors:
+        raise RuntimeError(f'[{part_filename}] Загрузка прервана: {errors[0]}')
+
+
+def _notify(changed: threading.Condition):
+    with changed:
+        changed.notify_all()
+
+
+def _hash_prefix(hasher: FileSink, fd: int, segments: list, changed: threading.Condition, futures: list):
+    """ Функция считает MD5 вслед за непрерывным началом файла, пока идёт загрузка сегментов.
+    Выходит, когда начало файла посчитано целиком или один из сегментов упал
+    """
+    while True:
+        with changed:
+            while contiguous_offset(segments) <= hasher.pos and not all(future.done() for future in futures):
+                changed.wait()
+            frontier = contiguous_offset(segments)
+        if frontier <= hasher.pos or any(future.done() and future.exception() is not None for future in futures):
+            return
+        hasher.update_from(fd, frontier)
+
+
+def replay_part(fd: int, start: int, end: int, sink: MultipartUpload):
+    """ Функция отправляет в multipart upload уже скачанный диапазон .part файла
+
+    :param fd: дескриптор .part файла
+    :param start: начало диапазона
+    :param end: конец диапазона (не включительно)
+    :param sink: multipart upload
+    """
+    while start < end:
+        chunk = os.pread(fd, min(SEGMENT_CHUNK_SIZE, end - start), start)
+        if not chunk:
+            raise RuntimeError(f'.part файл короче {end} байт')
+        sink.write_at(start, chunk)
+        start += len(chunk)
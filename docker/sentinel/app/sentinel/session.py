@@ -0,0 +1,50 @@
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+POOL_CONNECTIONS = 4
+POOL_MAXSIZE = 16
+
+_sessions = {}
+_sessions_pid = None
+_lock = threading.Lock()
+
+
+def get_session(cred: str, pool_maxsize: int = POOL_MAXSIZE) -> requests.Session:
+    """ Функция возвращает долгоживущую сессию для учётной записи copernicus.
+    Сессия создаётся лениво при первом обращении в каждом процессе (после fork у дочернего процесса будут
+    свои соединения), авторизация и пул соединений настраиваются один раз.
+
+    :param cred: авторизационные данные вида user:password
+    :param pool_maxsize: максимальное количество соединений с одним хостом
+    :return: сессия requests
+    """
+    global _sessions_pid
+    with _lock:
+        if _sessions_pid != os.getpid():
+            # Сокеты родительского процесса не трогаем, просто забываем про них
+            _sessions.clear()
+            _sessions_pid = os.getpid()
+        session = _sessions.get(cred)
+        if session is None:
+            session = requests.Session()
+            user, password = cred.split(':', 1)
+            session.auth = (user, password)
+            session.headers['Connection'] = 'keep-alive'
+            adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=pool_maxsize, pool_block=True)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _sessions[cred] = session
+        return session
+
+
+def close_sessions():
+    """ Функция закрывает все сессии текущего процесса
+    """
+    with _lock:
+        if _sessions_pid == os.getpid():
+            for session in _sessions.values():
+                session.close()
+        _sessions.clear()
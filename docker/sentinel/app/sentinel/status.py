@@ -0,0 +1,162 @@
+"""
+Буферизованная запись состояния загрузок в таблицу datasets.
+
+Задачи не ходят в БД на каждое изменение (размер, прогресс, путь, статус): изменения складываются в буфер процесса,
+фоновый поток объединяет их по guid (от каждого поля остаётся последнее значение) и пишет одним
+UPDATE ... FROM (VALUES ...) раз в interval секунд или сразу, как только набралось batch_size датасетов.
+Количество запросов к БД не зависит от количества одновременных загрузок.
+"""
+import os
+import threading
+from typing import Callable, Dict, Optional
+
+from psycopg2 import sql
+
+from db_service import DBConnection
+
+# Колонки datasets, которые пишет StatusWriter, и их типы для VALUES
+COLUMNS = {'size': 'bigint', 'progress': 'real', 'path': 'text', 'status': 'text'}
+
+# Колонки состояния загрузки создаются при первой записи в процессе, если их нет
+# (ALTER TABLE берёт исключительную блокировку таблицы даже с IF NOT EXISTS - без нужды не выполняем)
+SCHEMA_COLUMNS = {
+    'progress': 'ALTER TABLE datasets ADD COLUMN IF NOT EXISTS progress real',
+    'status': 'ALTER TABLE datasets ADD COLUMN IF NOT EXISTS status text',
+    'status_updated_at': 'ALTER TABLE datasets ADD COLUMN IF NOT EXISTS status_updated_at timestamptz',
+}
+COLUMNS_QUERY = """
+    SELECT column_name FROM information_schema.columns WHERE table_name = 'datasets'
+"""
+
+# Поле, которого нет в изменении (NULL в VALUES), сохраняет прежнее значение
+_UPDATE_QUERY = sql.SQL("""
+    UPDATE datasets AS d
+    SET {assignments}, status_updated_at = now()
+    FROM (VALUES {rows}) AS v (guid, {columns})
+    WHERE d.guid = v.guid
+""")
+
+STATUS_DOWNLOADING = 'downloading'
+STATUS_DOWNLOADED = 'downloaded'
+STATUS_OFFLINE = 'offline'
+STATUS_ERROR = 'error'
+
+
+def update_query(count: int) -> sql.Composed:
+    """ Функция собирает UPDATE на count датасетов, параметры - (guid, size, progress, path, status) подряд
+    """
+    row = sql.SQL('({})').format(sql.SQL(', ').join(
+        [sql.SQL('%s::uuid')] + [sql.SQL('%s::' + column_type) for column_type in COLUMNS.values()]))
+    return _UPDATE_QUERY.format(
+        assignments=sql.SQL(', ').join(sql.SQL('{column} = COALESCE(v.{column}, d.{column})').format(
+            column=sql.Identifier(column)) for column in COLUMNS),
+        rows=sql.SQL(', ').join([row] * count),
+        columns=sql.SQL(', ').join(sql.Identifier(column) for column in COLUMNS))
+
+
+class StatusWriter:
+    """
+    Буфер изменений состояния датасетов с фоновой записью в БД.
+    """
+
+    def __init__(self, get_db: Callable[[], DBConnection], interval: float = 1.0, batch_size: int = 500, logger=None):
+        """
+        :param get_db: функция, возвращающая подключение (пул) к БД текущего процесса
+        :param interval: как часто фоновый поток пишет накопленные изменения, с
+        :param batch_size: при скольких датасетах в буфере писать сразу; столько же строк в одном UPDATE
+        :param logger: логгер
+        """
+        self.get_db = get_db
+        self.interval = interval
+        self.batch_size = batch_size
+        self.logger = logger
+        self.__lock = threading.Lock()
+        # Запись идёт по одной: иначе более старая пачка могла бы лечь в БД после более новой
+        self.__flush_lock = threading.Lock()
+        self.__wakeup = threading.Event()
+        self.__stop = threading.Event()
+        self.__pending: Dict[str, dict] = {}
+        self.__thread: Optional[threading.Thread] = None
+        self.__pid = None
+        self.__schema_ready = False
+
+    def update(self, guid: str, **values):
+        """ Функция добавляет изменение состояния датасета в буфер
+
+        :param guid: идентификатор датасета
+        :param values: size, progress, path, status (None - не менять)
+        """
+        unknown = set(values) - set(COLUMNS)
+        if unknown:
+            raise ValueError(f'Неизвестные поля состояния датасета: {", ".join(sorted(unknown))}')
+        with self.__lock:
+            self.__ensure_thread()
+            self.__pending.setdefault(guid, {}).update(
+                {column: value for column, value in values.items() if value is not None})
+            full = len(self.__pending) >= self.batch_size
+        if full:
+            self.__wakeup.set()
+
+    def flush(self) -> int:
+        """ Функция сразу пишет накопленные изменения
+
+        :return: количество обновлённых датасетов
+        """
+        with self.__flush_lock:
+            with self.__lock:
+                pending, self.__pending = self.__pending, {}
+            if not pending:
+                return 0
+            try:
+                self.__write(pending)
+            except BaseException:
+                # Возвращаем пачку в буфер под более новые изменения - запишется следующим проходом
+                with self.__lock:
+                    for guid, values in pending.items():
+                        self.__pending[guid] = dict(values, **self.__pending.get(guid, {}))
+                raise
+            return len(pending)
+
+    def close(self):
+        """ Функция останавливает фоновый поток и пишет то, что осталось в буфере
+        """
+        if self.__thread is not None and self.__pid == os.getpid():
+            self.__stop.set()
+            self.__wakeup.set()
+            self.__thread.join()
+            self.__thread = None
+        self.flush()
+
+    def __ensure_thread(self):
+        if self.__pid != os.getpid():
+            # После fork поток родителя в процессе не существует, а его буфер - не наш
+            self.__pending = {}
+            self.__thread = None
+            self.__pid = os.getpid()
+            self.__stop.clear()
+        if self.__thread is None and not self.__stop.is_set():
+            self.__thread = threading.Thread(target=self.__run, name='status-writer', daemon=True)
+            self.__thread.start()
+
+    def __run(self):
+        while not self.__stop.is_set():
+            self.__wakeup.wait(self.interval)
+            self.__wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                if self.logger is not None:
+                    self.logger.warning(f'Не удалось записать состояние датасетов: {e}')
+
+    def __write(self, pending: Dict[str, dict]):
+        db = self.get_db()
+        if not self.__schema_ready:
+            existing = {row[0] for row in db.fetch_all(COLUMNS_QUERY)}
+            missing = [query for column, query in SCHEMA_COLUMNS.items() if column not in existing]
+            if missing:
+                db.execute(missing)
+            self.__schema_ready = True
+        rows = [(guid,) + tuple(values.get(column) for column in COLUMNS) for guid, values in pending.items()]
+        for start in range(0, len(rows), self.batch_size):
+            chunk = rows[start:start + self.batch_size]
+            db.execute(update_query(len(chunk)), params=[value for row in chunk for value in row])
@@ -15,9 +15,17 @@ app.conf.update(
         "result_backend": config.CELERY_BACKEND_URL,
         "imports": (
             "tasks.worker",
+            "tasks.processing",
+            "tasks.pipeline",
             "tasks.task_router"
         ),
-        "task_routes": ("tasks.task_router.TaskRouter",)
+        "task_routes": ("tasks.task_router.TaskRouter",),
+        "beat_schedule": {
+            "restore-poller": {
+                "task": "scheduler:restore",
+                "schedule": config.RESTORE_POLL_INTERVAL,
+            },
+        },
     }
 )
 
@@ -0,0 +1,191 @@
+import os
+from typing import Dict, Optional
+from celery import shared_task
+from celery.signals import celeryd_after_setup, task_failure, task_prerun, task_success, worker_ready, \
+    worker_shutdown
+from sentinel.pipeline import FOLLOW_UP_TASKS, HostHeartbeat, fetch_product, host_queue, is_host_alive, \
+    parse_s3_uri, release_refs, remove_local, touch_host
+from tools.metrics import TASK_REDELIVERIES, TASK_RETRIES
+from tools.redis_pool import get_redis
+
+try:
+    from tasks.celery_app import app, config
+    from tasks.worker import dataset_s3_key, product_index
+except:
+    from .celery_app import app, config
+    from .worker import dataset_s3_key, product_index
+
+from celery.utils.log import get_task_logger
+
+logger = get_task_logger(__name__)
+
+# Задачи цепочки, которые оставляют файлы на хосте (индексы, нарезка)
+LOCAL_OUTPUT_TASKS = ('processing:indices', 'cutter:fields')
+
+_heartbeat = None
+
+
+@celeryd_after_setup.connect
+def setup_host_queue(sender, instance, **kwargs):
+    # Кроме общих очередей, воркер разбирает очередь своего хоста - туда идут задачи по датасетам, которые здесь
+    if config.HOST_AFFINITY:
+        instance.app.amqp.queues.select_add(host_queue(config.HOST_ID))
+
+
+@worker_ready.connect
+def start_host_heartbeat(sender=None, **kwargs):
+    global _heartbeat
+    if config.HOST_AFFINITY:
+        _heartbeat = HostHeartbeat(get_redis(config.REDIS_URL), config.HOST_ID, sender.hostname,
+                                   config.HOST_HEARTBEAT_TTL)
+        _heartbeat.start()
+
+
+@worker_shutdown.connect
+def stop_host_heartbeat(**kwargs):
+    if _heartbeat is not None:
+        _heartbeat.stop()
+
+
+@task_prerun.connect
+def mark_local_outputs(sender=None, kwargs=None, **kw):
+    if sender.name in LOCAL_OUTPUT_TASKS and (kwargs or {}).get('pipeline'):
+        touch_host(get_redis(config.REDIS_URL), kwargs['dataset_guid'], config.HOST_ID,
+                   int(config.PIPELINE_REFS_TTL.total_seconds()))
+
+
+@task_success.connect
+def release_on_success(sender=None, **kwargs):
+    task_kwargs = sender.request.kwargs or {}
+    if sender.name in FOLLOW_UP_TASKS and task_kwargs.get('pipeline'):
+        _release(task_kwargs['dataset_guid'], task_kwargs['dataset_title'], 1)
+
+
+@task_failure.connect
+def release_on_failure(sender=None, kwargs=None, **kw):
+    if sender.name in FOLLOW_UP_TASKS and (kwargs or {}).get('pipeline'):
+        # Цепочка на упавшей задаче обрывается - снимаем и ссылки задач, которые уже не запустятся
+        _release(kwargs['dataset_guid'], kwargs['dataset_title'], 1 + len(sender.request.chain or []))
+
+
+def _release(dataset_guid: str, dataset_title: str, count: int):
+    r = get_redis(config.REDIS_URL)
+    hosts = release_refs(r, dataset_guid, count)
+    if not hosts or not config.PIPELINE_CLEANUP:
+        return
+    for host in hosts:
+        if host == config.HOST_ID:
+            cleanup_local(dataset_guid, dataset_title)
+        elif is_host_alive(r, host):
+            app.send_task(name='pipeline:cleanup', args=[dataset_guid, dataset_title], queue=host_queue(host))
+        else:
+            logger.warning(f'[{dataset_guid}] Хост {host} не разбирает свою очередь, локальные файлы датасета '
+                           f'{dataset_title} на нём остаются')
+
+
+def cleanup_local(dataset_guid: str, dataset_title: str):
+    """
+    Удаление локальных файлов датасета на этом хосте: архив (копия есть на S3), индексы, нарезка.
+    """
+    cached = product_index.get(dataset_guid)
+    removed = remove_local(dataset_title, cached['path'] if cached else None,
+                           [config.PROCESSING_DIR, config.CUTTER_DIR])
+    product_index.remove(dataset_guid)
+    logger.info(f'[{dataset_guid}] Цепочка завершена, удалено локально: {len(removed)}')
+
+
+def local_product(dataset_guid: str, dataset_title: str, path: Optional[str] = None) -> str:
+    """
+    Путь к датасету на этом хосте. Если датасета здесь нет (задача пришла из общей очереди или скачивание
+    было сразу на S3), архив забирается с S3 - один раз на хост.
+
+    :param dataset_guid: идентификатор датасета
+    :param dataset_title: название датасета
+    :param path: результат скачивания: локальный путь или адрес на S3 (None - искать в индексе)
+    :return: локальный путь к архиву или каталогу .SAFE
+    """
+    if path and not path.startswith('s3://') and os.path.exists(path):
+        return path
+    cached = product_index.get(dataset_guid)
+    if cached is not None and os.path.exists(cached['path']):
+        return cached['path']
+    if path and path.startswith('s3://'):
+        bucket, key = parse_s3_uri(path)
+    elif config.S3_BUCKET:
+        bucket, key = config.S3_BUCKET, dataset_s3_key(dataset_title)
+    else:
+        raise FileNotFoundError(f'[{dataset_guid}] Датасета {dataset_title} нет на хосте {config.HOST_ID}, '
+                                f'а S3 не настроен')
+    from sentinel.downloader import _get_dataset_dir
+    from tools.s3 import get_s3_client
+    client = get_s3_client(config.S3_ENDPOINT_URL, config.S3_ACCESS_KEY, config.S3_SECRET_KEY, config.S3_REGION)
+    target = os.path.join(config.DATA_DIR, _get_dataset_dir(dataset_title), f'{dataset_title}.zip')
+    return fetch_product(get_redis(config.REDIS_URL), client, dataset_guid, dataset_title, bucket, key, target,
+                         product_index, config.HOST_ID, logger, wait=config.S3_FETCH_WAIT)
+
+
+@shared_task(name="pipeline:cleanup", ignore_result=True)
+def cleanup(dataset_guid: str, dataset_title: str):
+    # Приходит в очередь хоста от задачи, которая сняла последнюю ссылку на датасет на другом хосте
+    cleanup_local(dataset_guid, dataset_title)
+
+
+@shared_task(bind=True, name="publisher:geoserver", acks_late=True, reject_on_worker_lost=True,
+             autoretry_for=(RuntimeError,), retry_kwargs={"countdown": 60, "max_retries": 5})
+def publisher(self, cuts: Dict[str, Dict[str, str]], dataset_guid: str, dataset_title: str,
+              pipeline: bool = False) -> Dict[str, Dict[str, str]]:
+    """
+    Публикация нарезки: файлы полей загружаются на S3 (если задан S3_BUCKET) и регистрируются слоями
+    в GeoServer (если задан GEOSERVER_URL).
+
+    :param cuts: поле -> {слой: путь} (результат cutter:fields)
+    :param dataset_guid: идентификатор датасета
+    :param dataset_title: название датасета
+    :param pipeline: задача - часть цепочки по датасету
+    :return: поле -> {слой: адрес на S3 или локальный путь, если S3 не настроен}
+    """
+    import requests
+    from sentinel.geoserver import publish_geotiff
+    if self.request.retries:
+        TASK_RETRIES.labels(self.name).inc()
+    if (self.request.delivery_info or {}).get('redelivered'):
+        TASK_REDELIVERIES.labels(self.name).inc()
+    missing = [path for layers in cuts.values() for path in layers.values() if not os.path.exists(path)]
+    if missing:
+        # Задача пришла из общей очереди на хост, где нарезки нет: режем здесь заново
+        logger.info(f'[{dataset_guid}] Нарезки нет на хосте {config.HOST_ID}: {missing[0]} '
+                    f'и ещё {len(missing) - 1}')
+        try:
+            from tasks.processing import cut_locally
+        except ImportError:
+            from .processing import cut_locally
+        if pipeline:
+            # Файлы датасета появятся и на этом хосте - их удалит снятие последней ссылки цепочки
+            touch_host(get_redis(config.REDIS_URL), dataset_guid, config.HOST_ID,
+                       int(config.PIPELINE_REFS_TTL.total_seconds()))
+        layers = sorted({layer for field_layers in cuts.values() for layer in field_layers})
+        cuts = cut_locally(dataset_guid, dataset_title, layers, list(cuts))
+    client = None
+    if config.S3_BUCKET:
+        from tools.s3 import get_s3_client
+        client = get_s3_client(config.S3_ENDPOINT_URL, config.S3_ACCESS_KEY, config.S3_SECRET_KEY,
+                               config.S3_REGION)
+    result = {}
+    published = 0
+    with requests.Session() as session:
+        session.auth = (config.GEOSERVER_USER, config.GEOSERVER_PASSWORD)
+        for field, layers in cuts.items():
+            result[field] = {}
+            for layer, path in layers.items():
+                filename = os.path.basename(path)
+                result[field][layer] = path
+                if client is not None:
+                    key = '/'.join(part for part in (config.PUBLISH_S3_PREFIX, dataset_title, field, filename) if part)
+                    client.upload_file(path, config.S3_BUCKET, key)
+                    result[field][layer] = f's3://{config.S3_BUCKET}/{key}'
+                if config.GEOSERVER_URL:
+                    store = f'{field}_{os.path.splitext(filename)[0]}'
+                    published += publish_geotiff(session, config.GEOSERVER_URL, config.GEOSERVER_WORKSPACE, store,
+                                                 path, logger)
+    logger.info(f'[{dataset_guid}] Опубликовано полей: {len(result)}, слоёв в GeoServer: {published}')
+    return result
@@ -0,0 +1,130 @@
+import os
+import time
+from typing import Dict, List, Optional
+from celery import shared_task
+from tools.metrics import PROCESSING_SECONDS, TASK_REDELIVERIES, TASK_RETRIES
+
+try:
+    from tasks.celery_app import config
+    from tasks.pipeline import local_product
+    from tasks.worker import get_db_connection
+except:
+    from .celery_app import config
+    from .pipeline import local_product
+    from .worker import get_db_connection
+
+from celery.utils.log import get_task_logger
+
+logger = get_task_logger(__name__)
+
+# Кэш масок полей создаётся при первой резке: processing.masks тянет numpy
+_mask_cache = None
+
+
+def get_mask_cache():
+    global _mask_cache
+    if _mask_cache is None:
+        from processing.masks import MaskCache
+        _mask_cache = MaskCache(config.MASK_CACHE_DIR, config.MASK_CACHE_SIZE)
+    return _mask_cache
+
+
+def _compute_indices(dataset_guid: str, dataset_title: str, path: str, index_names: List[str]) -> Dict[str, str]:
+    # numpy и rasterio нужны только воркерам очереди processing
+    from processing.raster import compute_indices
+    logger.info(f'[{dataset_guid}] Считаем {", ".join(index_names)} по {path}')
+    started = time.perf_counter()
+    result = compute_indices(path, index_names, os.path.join(config.PROCESSING_DIR, dataset_title), dataset_title,
+                             resolution=config.PROCESSING_RESOLUTION,
+                             tile=config.PROCESSING_TILE_SIZE,
+                             threads=config.PROCESSING_THREADS)
+    elapsed = time.perf_counter() - started
+    PROCESSING_SECONDS.observe(elapsed)
+    logger.info(f'[{dataset_guid}] Индексы посчитаны за {elapsed:.1f} s')
+    return result
+
+
+@shared_task(bind=True, name="processing:indices", acks_late=True, reject_on_worker_lost=True,
+             autoretry_for=(RuntimeError,), retry_kwargs={"countdown": 30, "max_retries": 3})
+def indices(self, path: Optional[str], dataset_guid: str, dataset_title: str,
+            index_names: Optional[List[str]] = None, pipeline: bool = False) -> Dict[str, str]:
+    """
+    Расчёт индексов по скачанному датасету: все индексы за один проход по каналам.
+
+    :param path: результат downloader:sentinel - zip-архив, каталог .SAFE или адрес на S3
+                 (None - архив из индекса скачанных датасетов)
+    :param dataset_guid: идентификатор датасета
+    :param dataset_title: название датасета
+    :param index_names: индексы (None - config.PROCESSING_INDICES)
+    :param pipeline: задача - часть цепочки по датасету
+    :return: индекс -> путь к GeoTIFF
+    """
+    if self.request.retries:
+        TASK_RETRIES.labels(self.name).inc()
+    if (self.request.delivery_info or {}).get('redelivered'):
+        TASK_REDELIVERIES.labels(self.name).inc()
+    path = local_product(dataset_guid, dataset_title, path)
+    return _compute_indices(dataset_guid, dataset_title, path, index_names or config.PROCESSING_INDICES)
+
+
+@shared_task(bind=True, name="cutter:fields", acks_late=True, reject_on_worker_lost=True,
+             autoretry_for=(RuntimeError,), retry_kwargs={"countdown": 30, "max_retries": 3})
+def cutter(self, rasters: Dict[str, str], dataset_guid: str, dataset_title: str,
+           field_uuids: Optional[List[str]] = None, pipeline: bool = False) -> Dict[str, Dict[str, str]]:
+    """
+    Резка растров датасета по контурам полей с кэшированными масками.
+
+    :param rasters: слой -> путь к GeoTIFF (результат processing:indices)
+    :param dataset_guid: идентификатор датасета
+    :param dataset_title: название датасета (из него берётся тайл)
+    :param field_uuids: поля (None - все поля, для которых найден датасет)
+    :param pipeline: задача - часть цепочки по датасету
+    :return: поле -> {слой: путь}
+    """
+    from processing.cutter import dataset_fields
+    if self.request.retries:
+        TASK_RETRIES.labels(self.name).inc()
+    if (self.request.delivery_info or {}).get('redelivered'):
+        TASK_REDELIVERIES.labels(self.name).inc()
+    db = get_db_connection()
+    if field_uuids is None:
+        field_uuids = dataset_fields(db, dataset_guid)
+    if not field_uuids:
+        logger.info(f'[{dataset_guid}] Нет полей для резки')
+        return {}
+    if not all(os.path.exists(path) for path in rasters.values()):
+        # Задача пришла из общей очереди на хост, где индексов нет: считаем их здесь заново
+        logger.info(f'[{dataset_guid}] Индексов нет на хосте {config.HOST_ID}')
+        rasters = _compute_indices(dataset_guid, dataset_title, local_product(dataset_guid, dataset_title),
+                                   list(rasters))
+    return _cut(db, rasters, dataset_guid, dataset_title, field_uuids)
+
+
+def cut_locally(dataset_guid: str, dataset_title: str, index_names: List[str],
+                field_uuids: List[str]) -> Dict[str, Dict[str, str]]:
+    """
+    Повторная нарезка на этом хосте: архив (с S3, если его здесь нет) -> индексы -> резка.
+    Нужна задачам цепочки, пришедшим из общей очереди на хост без результатов предыдущих задач.
+
+    :param dataset_guid: идентификатор датасета
+    :param dataset_title: название датасета
+    :param index_names: индексы
+    :param field_uuids: поля
+    :return: поле -> {слой: путь}
+    """
+    rasters = _compute_indices(dataset_guid, dataset_title, local_product(dataset_guid, dataset_title),
+                               index_names)
+    return _cut(get_db_connection(), rasters, dataset_guid, dataset_title, field_uuids)
+
+
+def _cut(db, rasters: Dict[str, str], dataset_guid: str, dataset_title: str,
+         field_uuids: List[str]) -> Dict[str, Dict[str, str]]:
+    from processing.cutter import cut_fields, field_geometries, field_hashes, tile_id
+    hashes = field_hashes(db, field_uuids)
+    started = time.perf_counter()
+    result = cut_fields(rasters, hashes, lambda uuids, srid: field_geometries(db, uuids, srid),
+                        get_mask_cache(), tile_id(dataset_title),
+                        os.path.join(config.CUTTER_DIR, dataset_title), threads=config.CUTTER_THREADS,
+                        logger=logger)
+    logger.info(f'[{dataset_guid}] Вырезано {len(result)} полей за {time.perf_counter() - started:.1f} s')
+    return result
@@ -1,13 +1,74 @@
 #!/usr/local/bin/python3
 # -*- coding: utf-8 -*-
 
+import time
+
+import config
+
 
 # Этот класс позволяет отправлять задачу в очередь с названием, текст которого стоит в параметре name декоратора @celery.task, @shared_task, ... до двоеточия
 # Например, "name=queue_name:task_name" отправит задачу в очередь queue_name
+# Задачи скачивания дополнительно раскладываются по полосам queue_name.fast / queue_name.bulk по ожидаемому размеру
+# датасета, чтобы маленькие датасеты не стояли в очереди за гигабайтными
+# Задачи цепочки по датасету (pipeline=True) отправляются в очередь host.<HOST_ID> - на хост, где предыдущая задача
+# оставила файлы, если там жив воркер этой очереди; иначе - в общую очередь
 class TaskRouter(object):
-    def route_for_task(self, task, *args, **kwargs):
-        if ":" not in task:
-            return {"queue": "default"}
-        namespace, _ = task.split(":")
-        print(f'Send task to {namespace} queue')
-        return {"queue": namespace}
+    SIZED_TASKS = {'downloader:sentinel'}
+    AFFINITY_TASKS = {'processing:indices', 'cutter:fields', 'publisher:geoserver'}
+    # Сколько секунд помнить, жив ли воркер очереди хоста
+    HOST_CHECK_INTERVAL = 5
+
+    def __init__(self):
+        # Память решений по имени задачи: имя задачи -> очередь
+        self.__queues = {}
+        # Хост -> (жив ли, когда проверяли)
+        self.__hosts = {}
+
+    def route_for_task(self, task, args=None, kwargs=None, options=None, **kw):
+        queue = self.__queues.get(task)
+        if queue is None:
+            queue = task.split(":")[0] if ":" in task else "default"
+            self.__queues[task] = queue
+        if task in self.SIZED_TASKS:
+            return {"queue": f'{queue}.{self.__lane(args, kwargs, options)}'}
+        if task in self.AFFINITY_TASKS and (kwargs or {}).get('pipeline'):
+            return {"queue": self.__affinity(queue)}
+        return {"queue": queue}
+
+    def __affinity(self, queue: str) -> str:
+        from sentinel.pipeline import host_queue, is_host_alive
+        from tools.metrics import PIPELINE_ROUTES
+        from tools.redis_pool import get_redis
+        alive, checked = self.__hosts.get(config.HOST_ID, (False, 0))
+        if time.monotonic() - checked > self.HOST_CHECK_INTERVAL:
+            try:
+                alive = is_host_alive(get_redis(config.REDIS_URL), config.HOST_ID)
+            except Exception:
+                # redis недоступен - общая очередь всегда разбирается
+                alive = False
+            self.__hosts[config.HOST_ID] = (alive, time.monotonic())
+        PIPELINE_ROUTES.labels('host' if alive else 'shared').inc()
+        return host_queue(config.HOST_ID) if alive else queue
+
+    @staticmethod
+    def __lane(args, kwargs, options) -> str:
+        """
+        Полоса для задачи скачивания: выборочные каналы - всегда fast, иначе по размеру из заголовка size
+        или аргумента size, иначе по уровню обработки из названия датасета (S2A_MSIL2A_...).
+        """
+        if (kwargs or {}).get('bands'):
+            # Отдельные каналы - это десятки-сотни мегабайт, а не весь архив
+            return 'fast'
+        headers = (options or {}).get('headers') or {}
+        size = headers.get('size') or (kwargs or {}).get('size')
+        if size is not None:
+            try:
+                return 'bulk' if int(size) >= config.DOWNLOAD_BULK_SIZE else 'fast'
+            except (TypeError, ValueError):
+                # Кривой размер не должен ронять публикацию задачи - выбираем полосу по названию
+                pass
+        if args and len(args) > 1 and args[1]:
+            title_parts = str(args[1]).split('_')
+            if len(title_parts) > 1:
+                return config.DOWNLOAD_LEVEL_LANES.get(title_parts[1], 'bulk')
+        return 'bulk'
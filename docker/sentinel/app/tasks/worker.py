@@ -1,7 +1,16 @@
+import datetime
+import importlib
+import os
+import threading
 from time import sleep
+from typing import List, Optional, Union
 from celery import shared_task
-from db_service import DBConnection
-from sentinel.downloader import download_dataset
+from celery.signals import task_postrun, worker_init, worker_process_init, worker_process_shutdown, worker_shutdown
+from sentinel.limiter import acquire_account
+from sentinel.product_cache import ProductIndex, acquire_product
+from tools.metrics import TASK_REDELIVERIES, TASK_RETRIES, mark_process_dead, reset_multiprocess_dir, \
+    start_metrics_server
+from tools.redis_pool import get_redis
 
 try:
     from tasks.celery_app import app, config
@@ -12,32 +21,318 @@ from celery.utils.log import get_task_logger
 
 logger = get_task_logger(__name__)
 
-db_connection = DBConnection(dbname=config.DB_NAME,
-                             user=config.DB_USER,
-                             password=config.DB_PASSWORD,
-                             host=config.DB_IP,
-                             port=config.DB_PORT)
+product_index = ProductIndex(config.DATA_DIR)
+
+# Модули с requests импортируются не при загрузке модуля - его импортируют и flower,
+# и клиенты, которым задачи не нужны, - а в главном процессе воркера до fork, так что дочерние процессы
+# получают их уже загруженными
+PRELOAD_MODULES = ('sentinel.downloader', 'sentinel.restore', 'sentinel.search', 'sentinel.session')
+# boto3 грузится долго - только если загрузка на S3 включена
+S3_PRELOAD_MODULES = ('tools.s3',)
+# numpy и rasterio - только воркерам очереди processing
+PROCESSING_PRELOAD_MODULES = ('processing.raster',)
+
+# Пул подключений к БД создаётся при первом обращении в каждом процессе: импорт модуля (воркер, flower, run_task)
+# не открывает подключений, а дочерние процессы prefork не делят сокет с родителем
+_db_connection = None
+_db_connection_pid = None
+_db_lock = threading.Lock()
+
+
+def get_db_connection():
+    """
+    Пул подключений к БД текущего процесса.
+
+    :return: DBConnectionPool
+    """
+    global _db_connection, _db_connection_pid
+    with _db_lock:
+        if _db_connection is None or _db_connection_pid != os.getpid():
+            # psycopg2 нужен только задачам, которые ходят в БД
+            from db_service import DBConnectionPool
+            _db_connection = DBConnectionPool(dbname=config.DB_NAME,
+                                              user=config.DB_USER,
+                                              password=config.DB_PASSWORD,
+                                              host=config.DB_IP,
+                                              port=config.DB_PORT,
+                                              min_size=config.DB_POOL_MIN_SIZE,
+                                              max_size=config.DB_POOL_MAX_SIZE,
+                                              idle_timeout=config.DB_POOL_IDLE_TIMEOUT,
+                                              max_retry_count=config.MAX_QUERY_RETRY_COUNT,
+                                              prepared_cache_size=config.DB_PREPARED_CACHE_SIZE,
+                                              query_cache_size=config.DB_CACHE_SIZE,
+                                              query_cache_ttl=config.DB_CACHE_TTL)
+            _db_connection_pid = os.getpid()
+        return _db_connection
+
+
+# Состояние загрузок (размер, прогресс, путь, статус) пишется в БД пачками из фонового потока процесса
+_status_writer = None
+_status_lock = threading.Lock()
+
+
+def get_status_writer():
+    """
+    Буфер состояния датасетов текущего процесса.
+
+    :return: StatusWriter
+    """
+    global _status_writer
+    with _status_lock:
+        if _status_writer is None:
+            from sentinel.status import StatusWriter
+            _status_writer = StatusWriter(get_db_connection,
+                                          interval=config.STATUS_FLUSH_INTERVAL,
+                                          batch_size=config.STATUS_BATCH_SIZE,
+                                          logger=logger)
+        return _status_writer
+
+
+def flush_status_writer(close: bool = False):
+    """
+    Записывает накопленное состояние датасетов в БД (close - и останавливает фоновый поток).
+    """
+    if _status_writer is None:
+        return
+    try:
+        if close:
+            _status_writer.close()
+        else:
+            _status_writer.flush()
+    except Exception as e:
+        logger.warning(f'Не удалось записать состояние датасетов: {e}')
+
+
+def close_db_connection():
+    """
+    Закрывает пул подключений к БД, если он был создан в этом процессе.
+    Подключения, унаследованные от родителя после fork, не закрываются - это сокеты родителя.
+    """
+    global _db_connection, _db_connection_pid
+    with _db_lock:
+        if _db_connection is not None and _db_connection_pid == os.getpid():
+            _db_connection.close()
+        _db_connection = None
+        _db_connection_pid = None
+
+
+@worker_init.connect
+def init_worker(**kwargs):
+    for module in PRELOAD_MODULES + (S3_PRELOAD_MODULES if config.S3_BUCKET else ()) + \
+            (PROCESSING_PRELOAD_MODULES if config.PROCESSING_PRELOAD else ()):
+        importlib.import_module(module)
+    # Главный процесс воркера собирает метрики всех дочерних процессов и отдаёт их на /metrics
+    if config.METRICS_PORT:
+        reset_multiprocess_dir()
+        start_metrics_server(config.METRICS_PORT)
+
+
+@worker_process_init.connect
+def init_worker_process(**kwargs):
+    from sentinel.session import close_sessions
+    # HTTP-сессии и подключения к БД родительского процесса дочернему не нужны, свои создадутся при первой задаче
+    close_sessions()
+    close_db_connection()
+
+
+@worker_process_shutdown.connect
+def shutdown_worker_process(**kwargs):
+    from sentinel.session import close_sessions
+    close_sessions()
+    # Состояние загрузок дописываем, пока подключения к БД ещё открыты
+    flush_status_writer(close=True)
+    close_db_connection()
+    mark_process_dead(os.getpid())
+
+
+@worker_shutdown.connect
+def shutdown_worker(**kwargs):
+    # Пул solo выполняет задачи в главном процессе - worker_process_shutdown там не приходит
+    flush_status_writer(close=True)
+
+
+@task_postrun.connect
+def flush_task_status(sender=None, **kwargs):
+    # Итог задачи (путь, статус) не ждёт следующего прохода фонового потока
+    if sender is not None and sender.name == 'downloader:sentinel':
+        flush_status_writer()
 
 
 @shared_task(bind=True, name="downloader:sentinel", acks_late=True, reject_on_worker_lost=True,
              autoretry_for=(RuntimeError,), retry_kwargs={"countdown": 2, "max_retries": 3})
-def downloader(self, dataset_guid: str, dataset_title: str):
-    # Скачиваем датасет
+def downloader(self, dataset_guid: str, dataset_title: str, size: Optional[int] = None,
+               bands: Optional[List[str]] = None, resolution: Optional[str] = None):
+    # Скачиваем датасет (или только каналы bands из него)
     logger.info(
         f'now I\'m downloading dataset {dataset_title} with GUID {dataset_guid} and i am {self.request.id} - {self.name}')
-    download_dataset(self,
-                     dataset_guid, dataset_title, config.COPERNICUS_CREDENTIALS, "/data", logger)
+    if self.request.retries:
+        TASK_RETRIES.labels(self.name).inc()
+    if (self.request.delivery_info or {}).get('redelivered'):
+        TASK_REDELIVERIES.labels(self.name).inc()
+    task_kwargs = {'size': size, 'bands': bands, 'resolution': resolution}
+    r = get_redis(config.REDIS_URL)
+    if not bands:
+        cached = product_index.get(dataset_guid)
+        if cached is not None:
+            logger.info(f'[{dataset_guid}] Датасет уже скачан')
+            return _follow_up(self, r, dataset_guid, cached['path'])
+    # Один датасет одновременно качает только одна задача
+    product_lease = acquire_product(r, dataset_guid, self.request.id)
+    if product_lease is None:
+        logger.info(f'[{dataset_guid}] Датасет уже качает другая задача, повтор через '
+                    f'{config.DOWNLOAD_LIMIT_RETRY_DELAY} s')
+        _defer(self, dataset_guid, dataset_title, task_kwargs, config.DOWNLOAD_LIMIT_RETRY_DELAY)
+        return
+    with product_lease:
+        return _follow_up(self, r, dataset_guid, _download(self, r, dataset_guid, dataset_title, task_kwargs))
+
+
+def _defer(task, dataset_guid: str, dataset_title: str, task_kwargs: dict, countdown: float):
+    """
+    Возврат задачи скачивания в очередь с задержкой. Оставшаяся часть цепочки уходит вместе с ней.
+    """
+    task.apply_async(args=[dataset_guid, dataset_title], kwargs=task_kwargs, countdown=countdown,
+                     chain=task.request.chain)
+    # Иначе celery продолжит цепочку сразу, с результатом None
+    task.request.chain = None
+
+
+def _follow_up(task, r, dataset_guid: str, path: Optional[str]) -> Optional[str]:
+    """
+    Перед тем как цепочка пойдёт дальше, заводим ссылки на локальные файлы датасета - по одной на каждую
+    оставшуюся задачу. Последняя завершившаяся задача удаляет файлы (tasks.pipeline).
+    """
+    if path is not None and task.request.chain:
+        from sentinel.pipeline import add_refs
+        add_refs(r, dataset_guid, len(task.request.chain), None if path.startswith('s3://') else config.HOST_ID,
+                 int(config.PIPELINE_REFS_TTL.total_seconds()))
+    return path
+
+
+def _download(task, r, dataset_guid: str, dataset_title: str, task_kwargs: dict) -> Optional[str]:
+    """
+    Загрузка датасета под уже захваченной блокировкой датасета.
+
+    :return: путь к файлу датасета (или к каталогу с каналами), None - задача отложена
+    """
+    from sentinel.downloader import download_bands, download_dataset, ProductOfflineError
+    from sentinel.restore import add_pending
+    from sentinel.status import STATUS_OFFLINE
+    # Берём наименее загруженную учётную запись, лимит соединений общий для всех контейнеров с воркерами
+    lease, retry_after = acquire_account(r, config.COPERNICUS_ACCOUNTS,
+                                         max_connections=config.COPERNICUS_MAX_CONNECTIONS,
+                                         segments=config.COPERNICUS_SEGMENTS,
+                                         default_segments=config.COPERNICUS_DEFAULT_SEGMENTS,
+                                         rate=config.COPERNICUS_DOWNLOADS_PER_SECOND,
+                                         burst=config.COPERNICUS_DOWNLOADS_BURST)
+    if lease is None:
+        # Все учётные записи заняты - не держим воркер, возвращаем задачу в очередь с задержкой
+        countdown = max(retry_after, config.DOWNLOAD_LIMIT_RETRY_DELAY)
+        logger.info(f'[{dataset_guid}] Нет свободных соединений, повтор через {countdown:.0f} s')
+        _defer(task, dataset_guid, dataset_title, task_kwargs, countdown)
+        return
+    try:
+        with lease:
+            if task_kwargs.get('bands'):
+                # Только нужные каналы: через Range выкачиваются отдельные файлы архива
+                return download_bands(task,
+                                      dataset_guid, dataset_title, lease.cred, config.DATA_DIR, logger,
+                                      task_kwargs['bands'], task_kwargs.get('resolution'),
+                                      segments=lease.permits, index=product_index, status=get_status_writer())
+            sink = _start_upload(dataset_title)
+            try:
+                return download_dataset(task,
+                                        dataset_guid, dataset_title, lease.cred, config.DATA_DIR, logger,
+                                        segments=lease.permits, index=product_index,
+                                        sink=sink, keep_local=config.DOWNLOAD_KEEP_LOCAL or sink is None,
+                                        status=get_status_writer())
+            except BaseException:
+                if sink is not None:
+                    sink.abort()
+                raise
+    except ProductOfflineError as e:
+        # Датасет в архиве - не держим воркер, отдаём его планировщику восстановления
+        logger.info(f'[{dataset_guid}] Датасет не в онлайне, ждём восстановления из архива')
+        get_status_writer().update(dataset_guid, status=STATUS_OFFLINE)
+        add_pending(r, dataset_guid, dataset_title, e.restore_triggered,
+                    config.RESTORE_POLL_INTERVAL, task_kwargs, chain=task.request.chain)
+        task.request.chain = None
+        return
     # logger.info('Connect to db?')
     # try:
-    #     res = db_connection.fetch_one(
+    #     res = get_db_connection().fetch_one(
     #         "SELECT  count(*) as a FROM datasets;", True)
     #     logger.info(f"Ok: {res['a']}")
     # except Exception as e:
     #     logger.info(f'Error: {e}')
 
-    return
 
+def _start_upload(dataset_title: str):
+    """
+    Multipart upload датасета на S3, в который загрузчик пишет по ходу скачивания.
+
+    :return: MultipartUpload или None, если S3 не настроен
+    """
+    if not config.S3_BUCKET:
+        return None
+    from sentinel.s3_upload import MultipartUpload
+    from tools.s3 import get_s3_client
+    client = get_s3_client(config.S3_ENDPOINT_URL, config.S3_ACCESS_KEY, config.S3_SECRET_KEY, config.S3_REGION,
+                           max_pool_connections=config.S3_UPLOAD_THREADS * 2)
+    return MultipartUpload(client, config.S3_BUCKET, dataset_s3_key(dataset_title),
+                           part_size=config.S3_PART_SIZE,
+                           threads=config.S3_UPLOAD_THREADS,
+                           max_queued_parts=config.S3_QUEUE_PARTS)
+
+
+def dataset_s3_key(dataset_title: str) -> str:
+    return '/'.join(part for part in (config.S3_PREFIX, f'{dataset_title}.zip') if part)
+
+
+@shared_task(name="scheduler:restore", ignore_result=True)
+def restore_poller():
+    from sentinel.restore import poll_pending
+    from sentinel.session import get_session
+    # Проверяем пачкой датасеты, ожидающие восстановления из архива, и отправляем на скачивание те, что уже в онлайне
+    poll_pending(get_redis(config.REDIS_URL),
+                 get_session(config.COPERNICUS_ACCOUNTS[0]),
+                 lambda guid, title, kwargs, chain: app.send_task(name='downloader:sentinel', args=[guid, title],
+                                                                  kwargs=kwargs, chain=chain),
+                 logger,
+                 batch_size=config.RESTORE_BATCH_SIZE,
+                 check_interval=config.RESTORE_POLL_INTERVAL,
+                 retrigger_interval=config.RESTORE_RETRIGGER_INTERVAL)
+
+
+@shared_task(name="searcher:fields")
+def searcher(field_uuid: Union[str, List[str]], date: str, date_to: Optional[str] = None) -> dict:
+    """
+    Поиск датасетов по полям на дату (или диапазон дат). Пары (поле, дата), по которым поиск уже был,
+    пропускаются, новые датасеты ставятся на скачивание.
 
-@app.task
-def searcher(field_uuid: str, date: str):
-    print(f'Now I\'m searching data for field {field_uuid} and date {date}')
+    :param field_uuid: идентификатор поля или список идентификаторов
+    :param date: дата съёмки (YYYY-MM-DD)
+    :param date_to: последняя дата диапазона (включительно), None - только date
+    :return: {searched, found, new, requests}
+    """
+    from sentinel.enqueuer import enqueue_datasets
+    from sentinel.search import search
+    from sentinel.session import get_session
+    field_uuids = [field_uuid] if isinstance(field_uuid, str) else list(field_uuid)
+    first = datetime.date.fromisoformat(date)
+    last = datetime.date.fromisoformat(date_to) if date_to else first
+    dates = [first + datetime.timedelta(days=i) for i in range((last - first).days + 1)]
+    result = search(get_db_connection(),
+                    get_session(config.COPERNICUS_ACCOUNTS[0]),
+                    config.COPERNICUS_SEARCH_URL,
+                    field_uuids, dates, logger,
+                    platform=config.SEARCH_PLATFORM,
+                    product_types=config.SEARCH_PRODUCT_TYPES,
+                    cell_degrees=config.SEARCH_CELL_DEGREES,
+                    threads=config.SEARCH_THREADS)
+    if result.new_datasets:
+        enqueue_datasets(app, get_redis(config.REDIS_URL),
+                         [{'guid': p.guid, 'title': p.title, 'size': p.size} for p in result.new_datasets],
+                         ttl=int(config.ENQUEUE_TTL.total_seconds()), follow_up=config.PIPELINE)
+    return {'searched': len(result.searched), 'found': sum(result.searched.values()),
+            'new': len(result.new_datasets), 'requests': result.requests}
@@ -0,0 +1,85 @@
+"""
+Prometheus metrics for downloader, processing and DB.
+
+Prefork children write their values to PROMETHEUS_MULTIPROC_DIR, the worker main process aggregates them
+and serves /metrics. The env variable has to be set before prometheus_client is imported.
+"""
+import os
+import re
+import shutil
+import socket
+import time
+from contextlib import contextmanager
+
+if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+    os.makedirs(os.environ['PROMETHEUS_MULTIPROC_DIR'], exist_ok=True)
+
+from prometheus_client import CollectorRegistry, Counter, Histogram, start_http_server
+from prometheus_client import multiprocess
+
+WORKER = socket.gethostname()
+
+_BYTES_BUCKETS = (256 * 1024, 1024 * 1024, 4 * 1024 * 1024, 16 * 1024 * 1024, 64 * 1024 * 1024,
+                  128 * 1024 * 1024, float('inf'))
+
+ONLINE_CHECK_SECONDS = Histogram('sentinel_online_check_seconds', 'Online/$value request latency')
+TIME_TO_FIRST_BYTE_SECONDS = Histogram('sentinel_download_ttfb_seconds', 'Time to first byte of product download')
+DOWNLOAD_SPEED = Histogram('sentinel_download_bytes_per_second', 'Download speed of a single product',
+                           buckets=_BYTES_BUCKETS)
+DOWNLOAD_BYTES = Counter('sentinel_download_bytes', 'Downloaded bytes', ['worker'])
+DOWNLOADS = Counter('sentinel_downloads', 'Finished downloads', ['worker', 'result'])
+TASK_RETRIES = Counter('sentinel_task_retries', 'Task retries', ['task'])
+TASK_REDELIVERIES = Counter('sentinel_task_redeliveries', 'Tasks redelivered by broker', ['task'])
+PROCESSING_SECONDS = Histogram('sentinel_processing_seconds', 'Index computation time of a single product',
+                               buckets=(1, 5, 10, 30, 60, 120, 300, 600, float('inf')))
+PIPELINE_ROUTES = Counter('sentinel_pipeline_routes', 'Follow-up tasks routed to host or shared queue', ['route'])
+S3_FETCHES = Counter('sentinel_s3_fetches', 'Products fetched from S3 to a host without local copy')
+DB_QUERY_SECONDS = Histogram('sentinel_db_query_seconds', 'DB query latency', ['statement'])
+
+_WHITESPACE_RE = re.compile(r'\s+')
+_LITERAL_RE = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+
+
+def statement_label(query: str) -> str:
+    """
+    Short label for rendered query text: literals replaced with '?', whitespace collapsed, cut to 80 chars.
+    Composed queries are rendered with values inlined, so literals are masked to keep cardinality low
+    """
+    return _WHITESPACE_RE.sub(' ', _LITERAL_RE.sub('?', query)).strip()[:80]
+
+
+@contextmanager
+def observe_db_query(query: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        DB_QUERY_SECONDS.labels(statement_label(query)).observe(time.perf_counter() - start)
+
+
+def reset_multiprocess_dir():
+    """
+    Clean multiprocess dir, has to be called in the main process before children are forked
+    """
+    path = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+    if not path:
+        return
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path, exist_ok=True)
+
+
+def start_metrics_server(port: int):
+    """
+    Serve /metrics aggregated from all processes of the worker
+    """
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        start_http_server(port, registry=registry)
+    else:
+        start_http_server(port)
+
+
+def mark_process_dead(pid: int):
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        multiprocess.mark_process_dead(pid)
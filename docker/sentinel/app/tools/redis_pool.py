@@ -0,0 +1,25 @@
+import os
+import threading
+
+import redis
+
+_clients = {}
+_clients_pid = None
+_lock = threading.Lock()
+
+
+def get_redis(url: str) -> redis.Redis:
+    """
+    Get redis client for url. Client (and its connection pool) is created once per process,
+    forked children get their own connections
+    """
+    global _clients_pid
+    with _lock:
+        if _clients_pid != os.getpid():
+            _clients.clear()
+            _clients_pid = os.getpid()
+        client = _clients.get(url)
+        if client is None:
+            client = redis.Redis.from_url(url)
+            _clients[url] = client
+        return client
@@ -0,0 +1,35 @@
+import os
+import threading
+from typing import Optional
+
+import boto3
+from botocore.config import Config
+
+_clients = {}
+_clients_pid = None
+_lock = threading.Lock()
+
+
+def get_s3_client(endpoint_url: Optional[str], access_key: Optional[str], secret_key: Optional[str],
+                  region: Optional[str] = None, max_pool_connections: int = 16):
+    """
+    Get boto3 S3 client. Client is created once per process (boto3 clients are thread-safe,
+    but must not be shared between forked processes)
+    """
+    global _clients_pid
+    key = (endpoint_url, access_key, region)
+    with _lock:
+        if _clients_pid != os.getpid():
+            _clients.clear()
+            _clients_pid = os.getpid()
+        client = _clients.get(key)
+        if client is None:
+            client = boto3.client('s3',
+                                  endpoint_url=endpoint_url,
+                                  aws_access_key_id=access_key,
+                                  aws_secret_access_key=secret_key,
+                                  region_name=region,
+                                  config=Config(max_pool_connections=max_pool_connections,
+                                                s3={'addressing_style': 'path'}))
+            _clients[key] = client
+        return client
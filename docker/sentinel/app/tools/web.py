@@ -12,3 +12,19 @@ def get_filename_from_content_disposition(cd):
     if len(fname) == 0:
         return None
     return fname[0].removeprefix('"').removesuffix('"')
+
+
+def parse_content_range(cr):
+    """
+    Parse content-range header ("bytes 100-199/1000") into (start, end, total).
+    Unknown parts ("*") are returned as None
+    """
+    if not cr:
+        return None
+    match = re.match(r'\s*bytes\s+(\*|(\d+)-(\d+))/(\*|\d+)', cr)
+    if match is None:
+        return None
+    start = int(match.group(2)) if match.group(2) is not None else None
+    end = int(match.group(3)) if match.group(3) is not None else None
+    total = int(match.group(4)) if match.group(4) != '*' else None
+    return start, end, total